@@ -0,0 +1,52 @@
+"""
+Blocked readers benchmark
+
+Measures the time per communication on a channel, where many reader processes
+are blocked, as in a pool of workers reading tasks from one channel, and the time
+for the readers to retire and leave the channel. The number of blocked readers is
+scaled, while every communication and every leave should take constant time.
+
+Usage:
+  python BlockedReaders.py [ parallel | greenlets ]
+
+Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
+      Brian Vinter <vinter@nbi.dk>, Rune M. Friborg <rune.m.friborg@gmail.com>.
+See LICENSE.txt for licensing details (MIT License).
+"""
+
+from pycsp_import import *
+import time
+
+READERS = [1, 10, 100, 1000, 2000]
+N = 2000
+
+@process
+def Reader(ready, cin):
+    ready(True)
+    while True:
+        cin()
+
+@process
+def Writer(ready, cout, readers):
+    # Wait for the readers to start
+    for i in range(readers):
+        ready()
+
+    t1 = time.time()
+    for i in range(N):
+        cout(i)
+    dt = time.time() - t1
+    retire(cout)
+    return (dt, time.time())
+
+print "Running blocked readers benchmark (%d communications)" % (N)
+for readers in READERS:
+    ready = Channel()
+    tasks = Channel()
+    (dt, t1), = Parallel(Writer(+ready, -tasks, readers),
+                         [Reader(-ready, +tasks) for i in range(readers)])[:1]
+    t2 = time.time()
+    print "%5d readers: %7.1f us per communication, %7.1f ms to retire and leave" % \
+        (readers, dt / N * 1000000, (t2 - t1) * 1000)
+
+shutdown()
@@ -0,0 +1,67 @@
+"""
+Startup benchmark
+
+Measures the startup of short-lived interpreters, each in a new OS process:
+  python                  interpreter without PyCSP
+  import pycsp            python -c "import pycsp"
+  first communication     import, create a channel and complete one communication
+
+Usage:
+  python Startup.py [ parallel | greenlets ] [runs]
+
+Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
+      Brian Vinter <vinter@nbi.dk>, Rune M. Friborg <rune.m.friborg@gmail.com>.
+See LICENSE.txt for licensing details (MIT License).
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+if len(sys.argv) > 1:
+    mod = sys.argv[1]
+else:
+    mod = 'parallel'
+
+if len(sys.argv) > 2:
+    N = int(sys.argv[2])
+else:
+    N = 20
+
+FIRST_COMMUNICATION = """
+from pycsp.%s import *
+
+@process
+def writer(cout):
+    cout(42)
+
+@process
+def reader(cin):
+    cin()
+
+A = Channel()
+Parallel(writer(A.writer()), reader(A.reader()))
+shutdown()
+""" % (mod)
+
+BENCHMARKS = [
+    ("python", "pass"),
+    ("import pycsp", "import pycsp"),
+    ("first communication", FIRST_COMMUNICATION)
+    ]
+
+# Import pycsp from this distribution, as the other examples do
+env = dict(os.environ)
+env['PYTHONPATH'] = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+def run(code):
+    t1 = time.time()
+    subprocess.check_call([sys.executable, "-c", code], env=env)
+    return time.time() - t1
+
+print "Running startup benchmark (%s, %d runs)" % (mod, N)
+for name, code in BENCHMARKS:
+    run(code)
+    times = sorted([run(code) for i in range(N)])
+    print "%-20s min %7.1f ms   median %7.1f ms" % (name, times[0] * 1000, times[N // 2] * 1000)
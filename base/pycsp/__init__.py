@@ -17,6 +17,40 @@ Modules available
 > import pycsp.common.toolkit
 """
 
-# Import parallel by default to enable "import pycsp"
+import sys
+import types
+
+class _Package(types.ModuleType):
+    """
+    The pycsp package provides the names of pycsp.parallel to enable "import pycsp".
+    pycsp.parallel is imported, when one of its names is used for the first time.
+    """
+    def __getattr__(self, name):
+        if name.startswith('__') and name != '__all__':
+            raise AttributeError(name)
+
+        import pycsp.parallel
+        parallel = sys.modules['pycsp.parallel']
+        if not hasattr(parallel, '__all__'):
+            # pycsp.parallel is being imported
+            raise AttributeError(name)
+
+        for key in parallel.__all__:
+            if not key in self.__dict__:
+                setattr(self, key, getattr(parallel, key))
+        if not '__all__' in self.__dict__:
+            self.__all__ = parallel.__all__
+
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+
 if not __name__ == '__main__':
-    from pycsp.parallel import *
+    _package = _Package(__name__, __doc__)
+    _package.__dict__.update(sys.modules[__name__].__dict__)
+
+    # The functions of this module use its globals, which are cleared, when the module
+    # is freed
+    _package._module = sys.modules[__name__]
+    sys.modules[__name__] = _package
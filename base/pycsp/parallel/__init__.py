@@ -12,13 +12,14 @@ from pycsp.parallel.guard import Skip, SkipGuard, Timeout, TimeoutGuard
 from pycsp.parallel.alternation import choice, Alternation
 from pycsp.parallel.altselect import FairSelect, PriSelect, AltSelect, InputGuard, OutputGuard
 from pycsp.parallel.channel import Channel, retire, poison
+from pycsp.parallel.codec import Codec, StructCodec, register_codec
 from pycsp.parallel.process import Process, process, Sequence, Parallel, Spawn, current_process_id, shutdown
 from pycsp.parallel.multiprocess import MultiProcess, multiprocess
 from pycsp.parallel.exceptions import ChannelRetireException, ChannelPoisonException, ChannelSocketException, ChannelConnectException, ChannelBindException, ChannelLostException, FatalException, InfoException
 from pycsp.parallel.configuration import *
 from pycsp.parallel.compat import *
 
-__all__ = ['Skip', 'SkipGuard', 'Timeout', 'TimeoutGuard', 'InputGuard', 'OutputGuard', 'choice', 'Alternation', 'FairSelect', 'PriSelect', 'AltSelect', 'Channel', 'retire', 'poison', 'Process', 'process', 'MultiProcess', 'multiprocess', 'Sequence', 'Parallel', 'Spawn', 'current_process_id', 'shutdown', 'ChannelRetireException', 'ChannelPoisonException', 'ChannelSocketException', 'ChannelConnectException', 'ChannelBindException', 'ChannelLostException', 'InfoException', 'FatalException', 'io', 'Io', 'Configuration', 'SOCKETS_CONNECT_TIMEOUT', 'SOCKETS_CONNECT_RETRY_DELAY', 'SOCKETS_BIND_TIMEOUT', 'SOCKETS_BIND_RETRY_DELAY', 'PYCSP_PORT', 'PYCSP_HOST', 'SOCKETS_STRICT_MODE', 'version']
+__all__ = ['Skip', 'SkipGuard', 'Timeout', 'TimeoutGuard', 'InputGuard', 'OutputGuard', 'choice', 'Alternation', 'FairSelect', 'PriSelect', 'AltSelect', 'Channel', 'retire', 'poison', 'Codec', 'StructCodec', 'register_codec', 'Process', 'process', 'MultiProcess', 'multiprocess', 'Sequence', 'Parallel', 'Spawn', 'current_process_id', 'shutdown', 'ChannelRetireException', 'ChannelPoisonException', 'ChannelSocketException', 'ChannelConnectException', 'ChannelBindException', 'ChannelLostException', 'InfoException', 'FatalException', 'io', 'Io', 'Configuration', 'SOCKETS_CONNECT_TIMEOUT', 'SOCKETS_CONNECT_RETRY_DELAY', 'SOCKETS_BIND_TIMEOUT', 'SOCKETS_BIND_RETRY_DELAY', 'PYCSP_PORT', 'PYCSP_HOST', 'SOCKETS_STRICT_MODE', 'SOCKETS_SHM_TRANSPORT', 'SOCKETS_HEARTBEAT_TIMEOUT', 'SOCKETS_POOL_SIZE', 'SOCKETS_POOL_IDLE_TIMEOUT', 'PYCSP_ENGINE', 'PYCSP_ENGINE_WORKERS', 'ENGINE_THREADS', 'ENGINE_EVENTS', 'ENGINE_POOL', 'version']
 
 version = (0,9,1, 'parallel')
 
@@ -7,14 +7,11 @@ See LICENSE.txt for licensing details (MIT License).
 """
 
 # Imports
-import inspect
+import sys
 import types
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
 from pycsp.parallel.guard import Guard
+from pycsp.parallel.dispatch import decode_payload
 from pycsp.parallel.exceptions import *
 from pycsp.parallel.const import *
 
@@ -190,6 +187,14 @@ class Alternation:
             retire=True
         return (act, poison, retire)
 
+    def __withdraw(self, reqs, act):
+        # The requests posted to the other channels are stale. The channel homes
+        # are told to drop them, instead of offering them to this process later.
+        p, _ = getThreadAndName()
+        for c in reqs.keys():
+            if not (c is act or isinstance(c, Guard)):
+                c._withdraw(p)
+
     def _choose(self):
         reqs={}
         act = None
@@ -197,8 +202,9 @@ class Alternation:
         retire = False
 
         p, _ = getThreadAndName()
-        p.state = READY
+        # The sequence number must change before the state. See RemoteLock.
         p.sequence_number += 1
+        p.state = READY
 
         try:
             idx = 0
@@ -226,11 +232,13 @@ class Alternation:
         except ChannelPoisonException:
             act, poison, retire = self.__result(reqs)
             if not act:
+                self.__withdraw(reqs, act)
                 raise ChannelPoisonException
 
         except ChannelRetireException:
             act, poison, retire = self.__result(reqs)
             if not act:
+                self.__withdraw(reqs, act)
                 raise ChannelRetireException
 
         # If noone have offered a channelrequest, we wait.
@@ -240,17 +248,19 @@ class Alternation:
         if not act:
             act, poison, retire = self.__result(reqs)
 
-            if not act:
-                if poison:
-                    raise ChannelPoisonException()
-                if retire:
-                    raise ChannelRetireException()
+        self.__withdraw(reqs, act)
+
+        if not act:
+            if poison:
+                raise ChannelPoisonException()
+            if retire:
+                raise ChannelRetireException()
 
-                print('We should not get here in choice!!!')
+            print('We should not get here in choice!!!')
 
         idx, op = reqs[act]
 
-        # unpickle msg if necessary
+        # decode msg if necessary
         msg = p.result_msg
         if msg == None:
             # Got successful write
@@ -263,7 +273,7 @@ class Alternation:
                 if msg == "":
                     msg = None
                 else:
-                    msg = pickle.loads(msg)[0]
+                    msg = decode_payload(msg, p.result_codec)
 
         return (idx, act, msg, op)
 
@@ -319,7 +329,7 @@ class Alternation:
             # Compiling and executing string
             elif type(action) == types.StringType:
                 # Fetch process frame and namespace
-                processframe= inspect.currentframe()
+                processframe= sys._getframe()
                 steps = self.execute_frame
                 while (steps < 0):
                     processframe = processframe.f_back
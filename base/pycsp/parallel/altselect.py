@@ -8,7 +8,7 @@ Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
 See LICENSE.txt for licensing details (MIT License). 
 """
 
-import inspect
+import sys
 
 from pycsp.parallel.alternation import Alternation
 from pycsp.parallel.process import current_process_id
@@ -352,7 +352,7 @@ def FairSelect(*guards):
     More detailed usage:
       see help(pycsp.AltSelect)
     """
-    alt_key = str(current_process_id()) + '_' + str(inspect.currentframe().f_back.f_lineno)
+    alt_key = str(current_process_id()) + '_' + str(sys._getframe(1).f_lineno)
     A = AltHistory()
     H = A.get_history(alt_key)
 
@@ -11,7 +11,10 @@ See LICENSE.txt for licensing details (MIT License).
 import os
 import sys
 import select, threading
+import time
 import errno
+import heapq
+import collections
 
 try:    
     import multiprocessing
@@ -19,16 +22,14 @@ try:
 except ImportError:
     MULTIPROCESSING_ENABLED=0
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 import struct
 
 
 from pycsp.parallel import ossocket
+from pycsp.parallel import shm
+from pycsp.parallel import engine
 from pycsp.parallel.header import *
+from pycsp.parallel.codec import get_codec
 from pycsp.parallel.exceptions import *
 from pycsp.parallel.const import *
 from pycsp.parallel.configuration import *
@@ -45,44 +46,90 @@ class Message:
         self.header = header
         self.payload = payload 
 
-        # transport for natfix
-        self.natfix = None
-
     def transmit(self, handler, addr):
+        transmit(handler, addr, [self])
 
+    def serialize(self):
+        """
+        Returns the payload as a string, buffer or list of buffers and updates the payload size in the header
+        """
         if not (self.header.cmd & HAS_PAYLOAD):
-
-            sock = handler.connect(addr)
-            sock = handler.sendall(sock, self.header)
-            handler.close(addr)
-
-            # NATFIX Update SocketThread with new sock
-            if (self.header.cmd == CHANTHREAD_ENTER):
-                SocketDispatcher().getThread().add_to_active_socket_list(sock)
-
+            return ""
+
+        # list is used as a marker, to detect whether
+        # the payload has already been encoded.
+        if type(self.payload) == list:
+            payload_bin_data = get_codec(self.header.codec).dumps(self.payload[0])
+        elif type(self.payload) == PayloadBuffer:
+            # received payload, which is forwarded without copying
+            payload_bin_data = self.payload.view()
         else:
-            # list is used as a marker, to detect whether
-            # the payload has already been pickled. 
-            if type(self.payload) == list:
-                payload_bin_data = pickle.dumps(self.payload, protocol = PICKLE_PROTOCOL)
-            else:
-                # payload is already pickled
-                payload_bin_data = self.payload
+            # payload is already encoded
+            payload_bin_data = self.payload
 
+        if type(payload_bin_data) == list:
+            # Sent as separate buffers
+            self.header.arg = sum([len(data) for data in payload_bin_data])
+        else:
             self.header.arg = len(payload_bin_data)
-            
-            # Connect or fetch connected socket
-            sock = handler.connect(addr)            
-
-            # Send header and payload
-            sock = handler.sendall(sock, self.header)
-            handler.sendallNOreconnect(sock, payload_bin_data)
-            handler.close(addr)            
+        return payload_bin_data
 
     def __repr__(self):
         return repr("<pycsp.dispatch.Message cmd:%s>" % (cmd2str(self.header.cmd)))
 
 
+def transmit(handler, addr, messages):
+    """
+    Send messages to addr in order, using as few system calls as possible
+    """
+    payloads = [m.serialize() for m in messages]
+
+    # Hold the send lock for addr, to avoid interleaving with messages from other threads
+    lock = handler.lock(addr)
+    lock.acquire()
+    try:
+        # Connect or fetch connected socket
+        sock = handler.connect(addr)
+        try:
+            handler.sendallvNOreconnect(sock, _encode(handler, sock, messages, payloads))
+        except SocketSendException:
+            # The cached connection has been closed. Reconnect once.
+            sock = handler.connect(addr)
+            handler.sendallvNOreconnect(sock, _encode(handler, sock, messages, payloads))
+        handler.close(addr)
+
+        # The peer replies on the same connection, thus the SocketThread must read it.
+        # Done while the connection can not be closed by the pool.
+        if not sock in handler.shared:
+            handler.share(sock)
+            SocketDispatcher().getThread().add_to_active_socket_list(sock)
+    finally:
+        lock.release()
+
+    for m in messages:
+        # Forwarded payloads have been consumed
+        if type(m.payload) == PayloadBuffer:
+            m.payload.release()
+
+def _encode(handler, sock, messages, payloads):
+    """
+    Returns the list of buffers to send on sock for messages and their serialized payloads
+    """
+    # The header encoding depends on the headers previously sent on sock
+    encoder = handler.connState.get(sock)
+    if encoder is None:
+        encoder = handler.connState[sock] = HeaderEncoder()
+
+    buffers = []
+    for i in xrange(len(messages)):
+        buffers.append(encoder.encode(messages[i].header))
+        if type(payloads[i]) == list:
+            buffers.extend(payloads[i])
+        elif payloads[i]:
+            buffers.append(payloads[i])
+    return buffers
+
+
 class SocketDispatcher(object):
     """
     SocketDispatcher singleton
@@ -151,16 +198,28 @@ class SocketDispatcher(object):
 
 class QueueBuffer:
     def __init__(self):
-        self.normal = []
-        self.reply = []
+        self.normal = collections.deque()
+        self.reply = collections.deque()
 
-        self.lock = threading.Condition()
+        # A channel home may wait for a normal message, while a thread handling a
+        # message for it waits for a reply (see ChannelHomeServer.post). Thus waiters
+        # for replies are woken through a separate condition sharing the lock.
+        lock = threading.Lock()
+        self.lock = threading.Condition(lock)
+        self.replied = threading.Condition(lock)
 
         self.waitingR = 0
         self.timeout = False
 
+        # Address of the peer expected to send the reply, while waitingR is set
+        self.waitingAddr = None
+
         self.waitingN = 0
 
+        # Tasks waiting for a normal message or a reply, instead of a thread
+        self.task = None
+        self.reply_task = None
+
     def __repr__(self):
         return repr("<pycsp.dispatch.QueueBuffer containing normal:%s reply:%s messages>" % (str(self.normal), str(self.reply)))
 
@@ -177,14 +236,14 @@ class QueueBuffer:
                     self.waitingR += 1
                 else:
                     self.timeout = True
-                    self.lock.notify()
+                    self._wake_reply()
             self.lock.release()
 
     def pop_normal(self):
 
         # Pre test
         if self.normal:
-            obj = self.normal.pop(0)
+            obj = self.normal.popleft()
             #print("POP:%s id:%s" % (str(obj), str(self.x)))
             return obj
 
@@ -193,50 +252,414 @@ class QueueBuffer:
             self.waitingN = 1
             self.lock.wait()
             
-        obj = self.normal.pop(0)
+        obj = self.normal.popleft()
         self.waitingN = 0
         self.lock.release()
 
         #print("POP:%s id:%s" % (str(obj), str(self.x)))
         return obj        
 
-    def pop_reply(self):
+    def pop_reply(self, addr=None):
+        """
+        Returns the next reply. Returns None, if no reply has arrived within two timeout
+        ticks or if the peer at addr has been lost.
+        """
 
         # Pre test
         if self.reply:
-            return self.reply.pop(0)
+            return self.reply.popleft()
 
         self.lock.acquire()
+        self.waitingAddr = addr
         while not self.reply and not self.timeout:
-            self.timeout = False
             self.waitingR = 1
-            self.lock.wait()                
+            self.replied.wait()
              
-        if self.timeout:
-            obj = None
-        else:
-            obj = self.reply.pop(0)        
-        self.waitingR = 0
+        obj = self._reply_done()
         self.lock.release()
 
         return obj
 
+    def _reply_done(self):
+        if self.reply:
+            obj = self.reply.popleft()
+        else:
+            obj = None
+        self.timeout = False
+        self.waitingR = 0
+        self.waitingAddr = None
+        return obj
+
+    def suspend(self, task, reply=False, addr=None):
+        """
+        Pops the next normal message or reply for a task. Returns (True, message), if
+        available. Otherwise (False, None) is returned and the task is woken, when the
+        message has arrived.
+
+        A reply is None, if it has timed out or the peer at addr has been lost.
+        """
+        self.lock.acquire()
+        try:
+            if reply:
+                if self.reply or self.timeout:
+                    return True, self._reply_done()
+                self.waitingAddr = addr
+                if not self.waitingR:
+                    self.waitingR = 1
+                self.reply_task = task
+            else:
+                if self.normal:
+                    self.waitingN = 0
+                    return True, self.normal.popleft()
+                self.waitingN = 1
+                self.task = task
+            return False, None
+        finally:
+            self.lock.release()
+
+    def _wake(self):
+        # Invoked with lock held
+        task = self.task
+        if task is None:
+            self.lock.notify()
+        else:
+            self.task = None
+            task.wake()
+
+    def _wake_reply(self):
+        # Invoked with lock held
+        task = self.reply_task
+        if task is None:
+            self.replied.notify()
+        else:
+            self.reply_task = None
+            task.wake()
+
+    def peer_lost(self, addr):
+        """
+        Wakes a thread waiting for a reply from addr, which then gets None
+        """
+        if self.waitingR and self.waitingAddr == addr:
+            self.lock.acquire()
+            if self.waitingR and self.waitingAddr == addr:
+                self.timeout = True
+                self._wake_reply()
+            self.lock.release()
+
     def put_normal(self, obj):
         self.lock.acquire()
         #print("PUT:%s waiting:%s id:%s" % (str(obj), str(self.waiting), str(self.x)))
         self.normal.append(obj)
         if self.waitingN:
-            self.lock.notify()
+            self._wake()
         self.lock.release()
     
     def put_reply(self, obj):
         self.lock.acquire()
         self.reply.append(obj)
         if self.waitingR:
-            self.lock.notify()
+            self._wake_reply()
         self.lock.release()
 
 
+class UnknownStore(object):
+    """
+    Messages to channels or processes, which have not been registered. The messages
+    are handed over in order, when a matching channel or process registers.
+
+    At most UNKNOWN_MAX_BYTES_PER_ID bytes are kept for every destination and
+    UNKNOWN_MAX_BYTES in total. Messages exceeding a limit are dropped. A destination,
+    which has not registered UNKNOWN_TTL seconds after its first message, is evicted
+    with all its messages.
+
+    Not thread-safe. Protected by the cond of SocketThreadData.
+    """
+    def __init__(self):
+        # name_id -> [expire time, bytes, messages] in the order of the first message
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        # Number of messages dropped by the limits and evicted by the TTL
+        self.dropped = 0
+        self.expired = 0
+
+    def __contains__(self, name_id):
+        return name_id in self.entries
+
+    def __repr__(self):
+        return repr("<pycsp.dispatch.UnknownStore destinations:%d bytes:%d dropped:%d expired:%d>" % (len(self.entries), self.size, self.dropped, self.expired))
+
+    def add(self, m):
+        """
+        Keeps m for its destination. Returns False, if m was dropped.
+        """
+        now = time.time()
+        self.expire(now)
+
+        size = _message_size(m)
+        entry = self.entries.get(m.header.id)
+        used = entry[1] if entry else 0
+        if used + size > UNKNOWN_MAX_BYTES_PER_ID or self.size + size > UNKNOWN_MAX_BYTES:
+            self.dropped += 1
+            _discard(m)
+            return False
+
+        if entry is None:
+            entry = self.entries[m.header.id] = [now + UNKNOWN_TTL, 0, collections.deque()]
+        entry[1] += size
+        entry[2].append(m)
+        self.size += size
+        return True
+
+    def pop(self, name_id):
+        """
+        Removes and returns the messages kept for name_id
+        """
+        entry = self.entries.pop(name_id, None)
+        if entry is None:
+            return ()
+        self.size -= entry[1]
+        return entry[2]
+
+    def expire(self, now=None):
+        """
+        Evicts the destinations, which have passed their TTL
+        """
+        if now is None:
+            now = time.time()
+        while self.entries:
+            name_id = next(iter(self.entries))
+            entry = self.entries[name_id]
+            if entry[0] > now:
+                break
+            del self.entries[name_id]
+            self.size -= entry[1]
+            self.expired += len(entry[2])
+            for m in entry[2]:
+                _discard(m)
+
+
+# Approximate size of the header and the objects of a message
+_MESSAGE_OVERHEAD = 256
+
+def _message_size(m):
+    """
+    Returns the number of bytes accounted for a kept message. A payload, which
+    has not been encoded yet, is not included.
+    """
+    if type(m.payload) == str or type(m.payload) == PayloadBuffer:
+        return _MESSAGE_OVERHEAD + len(m.payload)
+    return _MESSAGE_OVERHEAD
+
+def _discard(m):
+    if type(m.payload) == PayloadBuffer:
+        m.payload.release()
+
+
+class PayloadBuffer(object):
+    """
+    A payload received into a pooled buffer.
+
+    The buffer is returned to the pool by release, after which the payload
+    must not be used.
+    """
+    __slots__ = ['buf', 'size']
+
+    def __init__(self, buf, size):
+        self.buf = buf
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def view(self):
+        return memoryview(self.buf)[:self.size]
+
+    def release(self):
+        if self.buf is not None:
+            payload_pool.put(self.buf)
+            self.buf = None
+
+    def detach(self):
+        """
+        Returns the buffer, which is then owned by the caller and not returned to the pool
+        """
+        buf = self.buf
+        self.buf = None
+        return buf
+
+
+class PayloadPool(object):
+    """
+    Reusable buffers for receiving large payloads.
+
+    At most PAYLOAD_POOL_SIZE bytes are kept in the pool.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.free = []
+        self.size = 0
+
+    def get(self, size):
+        """
+        Returns a buffer of at least size bytes. A pooled buffer is only reused, if
+        it is less than twice the requested size.
+        """
+        self.lock.acquire()
+        try:
+            best = None
+            for i in xrange(len(self.free)):
+                n = len(self.free[i])
+                if size <= n < size*2 and (best is None or n < len(self.free[best])):
+                    best = i
+            if best is not None:
+                buf = self.free.pop(best)
+                self.size -= len(buf)
+                return buf
+        finally:
+            self.lock.release()
+
+        # Round up to improve reuse for payloads of similar size
+        return bytearray(-(-size // RECV_BUFFER_SIZE) * RECV_BUFFER_SIZE)
+
+    def put(self, buf):
+        self.lock.acquire()
+        try:
+            if self.size + len(buf) <= PAYLOAD_POOL_SIZE:
+                self.free.append(buf)
+                self.size += len(buf)
+        finally:
+            self.lock.release()
+
+payload_pool = PayloadPool()
+
+def decode_payload(payload, codec):
+    """
+    Decodes a received payload with the codec id from its header. A pooled payload
+    is decoded without copying and released afterwards.
+    """
+    codec = get_codec(codec)
+    if type(payload) == PayloadBuffer:
+        return codec.loads_buffer(payload)
+    return codec.loads(payload)
+
+
+class MessageReader(object):
+    """
+    Reassembles messages received on a single connection.
+
+    Every call to read performs at most one receive on the socket, thus a large
+    payload is received in parts, while messages on other connections are
+    dispatched in between.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+        # Received data, which has not yet been parsed
+        self.pending = ""
+        self.decoder = HeaderDecoder()
+
+        # Current header, if its payload has not yet been received
+        self.header = None
+
+        # Used for receiving large payloads directly into a preallocated buffer
+        self.payload = None
+        self.payload_view = None
+        self.payload_received = 0
+
+        # Address of the peer, set when the first message has been received
+        self.peer = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def buffered(self):
+        """
+        Returns True, if data is available outside of the socket. Such a connection must
+        be read again, as the Poller does not report it as ready.
+        """
+        return type(self.sock) == shm.ShmSocket and self.sock.buffered() > 0
+
+    def read(self):
+        """
+        Returns a list of complete messages. None is returned if the connection has been closed.
+        """
+        try:
+            if self.payload is None:
+                data = self.sock.recv(RECV_BUFFER_SIZE, ossocket.RECV_FLAGS)
+                if not data:
+                    return None
+                self.pending += data
+
+                if self.decoder.version is None and self.pending.startswith(shm.SHM_MAGIC):
+                    # Upgrade to a shared memory connection
+                    result = shm.accept(self.sock, self.pending)
+                    if result is None:
+                        return []
+                    self.sock, self.pending = result
+            else:
+                n = self.sock.recv_into(self.payload_view[self.payload_received:], 0, ossocket.RECV_FLAGS)
+                if n == 0:
+                    return None
+                self.payload_received += n
+        except ossocket.socket.error as e:
+            if e.errno in ossocket.WOULDBLOCK_ERRORS:
+                return []
+            elif e.errno == errno.ECONNRESET:
+                # Connection has been reset
+                return None
+            else:
+                raise
+
+        messages = []
+
+        if self.payload is not None:
+            if self.payload_received < self.header.arg:
+                return messages
+
+            payload = PayloadBuffer(self.payload, self.header.arg)
+            self.payload = self.payload_view = None
+            messages.append(Message(self.header, payload))
+            self.header = None
+
+        pending = self.pending
+        offset = 0
+        while True:
+            if self.header is None:
+                try:
+                    self.header, offset = self.decoder.decode(pending, offset)
+                except SocketProtocolException as e:
+                    sys.stderr.write("PyCSP closing connection: %s\n" % (str(e)))
+                    return None
+                if self.header is None:
+                    break
+
+            header = self.header
+            if header.cmd & HAS_PAYLOAD:
+                available = len(pending) - offset
+                if available >= header.arg:
+                    payload = pending[offset:offset+header.arg]
+                    offset += header.arg
+                elif header.arg - available > RECV_BUFFER_SIZE:
+                    # Large payload. Receive remaining part directly into a pooled buffer
+                    self.payload = payload_pool.get(header.arg)
+                    self.payload[:available] = pending[offset:]
+                    self.payload_view = memoryview(self.payload)[:header.arg]
+                    self.payload_received = available
+                    offset = len(pending)
+                    break
+                else:
+                    break
+            else:
+                payload = ""
+
+            messages.append(Message(header, payload))
+            self.header = None
+
+        self.pending = pending[offset:]
+        return messages
+
+
 class SocketThread(threading.Thread):
     def __init__(self, data):
         threading.Thread.__init__(self)
@@ -250,118 +673,243 @@ class SocketThread(threading.Thread):
 
         self.finished = False
 
+        self.poller = ossocket.Poller()
         
     def run(self):
 
         #print "Starting SocketThread"
-        handler = ossocket.ConnHandler()
+        poller = self.poller
+        poller.register(self.data.waker)
+        for reader in self.data.readers.values():
+            poller.register(reader)
+
+        # Readers with buffered data, which are read again without waiting. Includes
+        # data left by a previous SocketThread.
+        again = [reader for reader in self.data.readers.values() if reader.buffered()]
+
+        # Ticks are only invoked, when no messages have been received for SOCKETTHREAD_TIMEOUT
+        next_tick = time.time() + SOCKETTHREAD_TIMEOUT
+
+        # Set, when the server sockets have been bound by listen
+        listening = False
 
         while(not self.finished):
-            ready, _, exceptready = select.select(self.data.active_socket_list, [], [], 10.0)
-            if not ready and not exceptready:
-                # Timeout. Invoke ticks
-                self.cond.acquire()
-                for c in self.channels.values():
-                    c.timeout_tick()
-                self.cond.release()
+            if not listening and self.data.server_socket:
+                listening = True
+                poller.register(self.data.server_socket)
+                if self.data.unix_socket:
+                    poller.register(self.data.unix_socket)
+
+            if again:
+                timeout = 0
+                ready = poller.poll(0)
+                for s in again:
+                    if not s in ready:
+                        ready.append(s)
+                again = []
+            else:
+                timeout = self.data.loop_timeout()
+                ready = poller.poll(timeout)
+            if not ready:
+                if timeout == SOCKETTHREAD_TIMEOUT or time.time() >= next_tick:
+                    # Timeout. Invoke ticks
+                    next_tick = time.time() + SOCKETTHREAD_TIMEOUT
+                    for c in self.channels.values():
+                        c.timeout_tick()
+                    self.data.expire_unknown()
+                    self.data.handler.expire()
 
             else:
+                next_tick = time.time() + SOCKETTHREAD_TIMEOUT
                 for s in ready:
-                    if s == self.data.server_socket:
-                        conn, _ = self.data.server_socket.accept()
-                        self.data.active_socket_list.append(conn)
-                    else:
-                        header = Header()
-                        header.cmd = ERROR_CMD
+                    if s is self.data.server_socket or s is self.data.unix_socket:
+                        # Accept all pending connections at once
+                        for conn in ossocket.accept_all(s):
+                            reader = MessageReader(conn)
+                            self.data.readers[conn.fileno()] = reader
+                            poller.register(reader)
+
+                    elif s is self.data.waker:
+                        self.data.waker.drain()
+
+                        # Register new sockets
+                        while self.data.readers_add:
+                            sock = self.data.readers_add.popleft()
+                            if not sock.fileno() in self.data.readers:
+                                reader = MessageReader(sock)
+                                self.data.readers[sock.fileno()] = reader
+                                poller.register(reader)
+
                         self.cond.acquire()
                         try:
-                            s.recv_into(header)
-                        except ossocket.socket.error as e:
-                            if e.errno == errno.ECONNRESET:
-                                # Connection has been reset
-                                header.cmd = ERROR_CMD
-                            else:
-                                raise
-                        self.cond.release()
-
-                        if header.cmd == ERROR_CMD:
-                            # connection disconnected
-                            if s in self.data.active_socket_list:
-                                self.data.active_socket_list.remove(s)
-                            s.close()
-                        else:
-                            if (header.cmd & HAS_PAYLOAD):
-                                self.cond.acquire()
-                                payload = ossocket.recvall(s, header.arg)
-                                self.cond.release()
-                            else:
-                                payload = ""
-
-
-                            m = Message(header, payload)
-
-                            if (header.cmd & NATFIX):
-                                # save reverse socket as payload
-                                m.natfix = s
-
-                            self.cond.acquire()
-                            if (header.cmd == SOCKETTHREAD_PING):
-                                if self.data.active_socket_list_add:
-                                    self.data.active_socket_list.extend(self.data.active_socket_list_add)
-                                    self.data.active_socket_list_add = []
-
-                            elif (header.cmd == SOCKETTHREAD_SHUTDOWN):
+                            if self.data.shutdown_requested:
+                                self.data.shutdown_requested = False
                                 if self.channels or self.processes:
                                     # Socketthread is still busy. Thus ignore and expect a later call to deregister to invoke stopThread.
                                     pass
                                 else:
                                     self.finished = True
 
-                                    # Remove thread reference
+                                    # Remove thread reference. The server sockets are left bound.
                                     self.data.thread = None
+                                    self.data.listening = False
 
-                                # Do not close sockets as the socketthread may be restarted at a later time
+                                    # Stop the Heartbeat
+                                    self.cond.notify_all()
+                        finally:
+                            self.cond.release()
 
-                            elif (header.cmd & PROCESS_CMD):
-                                if header.id in self.processes:
-                                    self.processes[header.id].handle(m)                                
-                                elif (header.cmd & REQ_REPLY):
-                                    raise FatalException("A REQ_REPLY message should always be valid!")
-                                elif (header.cmd & IGN_UNKNOWN):
-                                    raise FatalException("IGN_UNKNOWN should never occur!")
-                                else:
-                                    if not header.id in self.data.processes_unknown:
-                                        self.data.processes_unknown[header.id] = []
-                                    self.data.processes_unknown[header.id].append(m)
-                            else:
-                                if header.id in self.channels:
-                                    if (header.cmd & IS_REPLY):
-                                        self.channels[header.id].put_reply(m)
-                                    else:
-                                        self.channels[header.id].put_normal(m)
-                                elif (header.cmd & IGN_UNKNOWN):
+                    else:
+                        messages = s.read()
+                        if messages:
+                            # All messages on a connection are sent by the same peer
+                            if s.peer is None:
+                                s.peer = (messages[0].header._source_host, messages[0].header._source_port)
+                                self.data.add_reverse_socket(s.peer, s.sock)
+                            if self.data.heartbeat:
+                                self.data.seen(messages[-1].header)
+                        if messages is None:
+                            # connection disconnected
+                            poller.unregister(s)
+                            del self.data.readers[s.fileno()]
+                            self.data.connection_closed(s.sock)
+                            s.sock.close()
+                        else:
+                            # Replies sent by the remote locks are coalesced per destination
+                            self.data.begin_batch()
+                            try:
+                                for m in messages:
+                                    self.deliver(m)
+                            finally:
+                                try:
+                                    self.data.flush_batch()
+                                except AddrUnavailableException:
+                                    # Replies to unreachable channel homes are dropped
                                     pass
-                                else:                                
-                                    if not header.id in self.data.channels_unknown:
-                                        self.data.channels_unknown[header.id] = QueueBuffer()
-
-                                    if (header.cmd & IS_REPLY):
-                                        self.data.channels_unknown[header.id].put_reply(m)
-                                    else:
-                                        self.data.channels_unknown[header.id].put_normal(m)
-                            self.cond.release()
+                            if s.buffered():
+                                again.append(s)
+
+            # Tasks of the events engine
+            if self.data.ready or self.data.timers:
+                self.data.run_ready()
+
+        # Do not close sockets as the socketthread may be restarted at a later time
+        poller.close()
+
+        # No channel homes are left. Workers are started again by the next task.
+        if self.data.engine == ENGINE_POOL:
+            self.data.executor.stop()
+
+    def deliver(self, m):
+        header = m.header
+
+        if (header.cmd & PROCESS_CMD):
+            remotelock = self.processes.get(header.id)
+            if remotelock is None:
+                if (header.cmd & REQ_REPLY):
+                    raise FatalException("A REQ_REPLY message should always be valid!")
+                elif (header.cmd & IGN_UNKNOWN):
+                    raise FatalException("IGN_UNKNOWN should never occur!")
+                else:
+                    remotelock = self.data.store_unknown_process(m)
+            if remotelock:
+                remotelock.handle(m)
+        elif (header.cmd & SOCKETTHREAD_CMD):
+            if header.cmd == SOCKETTHREAD_PING:
+                self.data.reply(header, Header(SOCKETTHREAD_PONG))
+        else:
+            q = self.channels.get(header.id)
+            if q is None and not (header.cmd & IGN_UNKNOWN):
+                q = self.data.store_unknown_channel(m)
+
+            if q is not None:
+                if (header.cmd & IS_REPLY):
+                    q.put_reply(m)
+                else:
+                    q.put_normal(m)
+
+class Heartbeat(threading.Thread):
+    """
+    Detects lost peers, when SOCKETS_HEARTBEAT_TIMEOUT is set.
+
+    The peers of all cached connections are pinged HEARTBEATS_PER_TIMEOUT times within
+    the timeout. Any message received from a peer, including the answer to a ping,
+    proves that it is alive. A peer, which has been silent for longer than the
+    timeout, is lost.
+
+    Stops when the SocketThread has stopped.
+    """
+    def __init__(self, data, timeout):
+        threading.Thread.__init__(self)
+        self.daemon = False
+        self.data = data
+        self.timeout = timeout
+
+    def run(self):
+        while self.wait():
+            self.beat()
+
+    def wait(self):
+        """
+        Waits for the next beat. Returns False, when the SocketThread has stopped.
+        """
+        data = self.data
+        data.cond.acquire()
+        try:
+            if data.thread is not None:
+                data.cond.wait(self.timeout / HEARTBEATS_PER_TIMEOUT)
+            if data.thread is None:
+                data.heartbeat = None
+                return False
+            return True
+        finally:
+            data.cond.release()
+
+    def beat(self):
+        data = self.data
+        now = time.time()
+
+        # Forget peers, which are no longer connected, such that a new connection
+        # is given the full timeout
+        for addr in data.last_seen.keys():
+            if not addr in data.handler.cacheSockets:
+                data.last_seen.pop(addr, None)
+
+        for addr in data.handler.cacheSockets.keys():
+            if now - data.last_seen.setdefault(addr, now) > self.timeout:
+                data.peer_lost(addr)
+                continue
+
+            # A connection in use is not pinged, as the send may block
+            lock = data.handler.lock(addr)
+            if lock.acquire(False):
+                try:
+                    data.send(addr, Header(SOCKETTHREAD_PING))
+                except SocketException:
+                    data.peer_lost(addr)
+                finally:
+                    lock.release()
+
+class MessageBatch(threading.local):
+    def __init__(self):
+        self.depth = 0
+
+        # Messages per (handler, addr) in the order of the first message
+        self.pending = collections.OrderedDict()
 
 class SocketThreadData:
     def __init__(self, cond):
 
+        # Registry of local destinations. Lookups are done without locking, as a dict
+        # lookup is atomic. Modifications and the handling of unknown destinations are
+        # protected by cond.
         self.channels = {}
         self.processes = {}
         self.guards = {}
 
         # Unknown messages, which is moved to known messages, if a channel or processes with a matching name registers.
-        # TODO: This must be capped.
-        self.channels_unknown = {}
-        self.processes_unknown = {}
+        self.channels_unknown = UnknownStore()
+        self.processes_unknown = UnknownStore()
 
         self.cond = cond        
 
@@ -371,44 +919,228 @@ class SocketThreadData:
             port = int(os.environ[ENVVAL_PORT])
         if host == '' and ENVVAL_HOST in os.environ:
             host = os.environ[ENVVAL_HOST]
-        addr = (host, port)
-
-        self.server_socket, self.server_addr = ossocket.start_server(addr)
-
-        self.active_socket_list = [self.server_socket]
-        self.active_socket_list_add = []
+        self.bind_addr = (host, port)
+
+        # The server sockets are bound by listen, when another interpreter must be able
+        # to connect. Until then, messages between the threads of this interpreter are
+        # addressed to local_addr.
+        self.local_addr = LOCAL_ADDR
+        self.server_addr = self.local_addr
+        self.server_socket = None
+        self.unix_socket = None
+        self.listening = False
+
+        # A configured port is bound at once, as other interpreters may connect to it,
+        # and to report bind errors here
+        if port != 0:
+            self._bind()
+
+        # Connections read by the SocketThread. Kept here, as the SocketThread may be restarted.
+        self.readers = {}
+        self.readers_add = collections.deque()
+
+        # Used to wake the SocketThread, when sockets are added or a shutdown is requested
+        self.waker = ossocket.Waker()
+        self.shutdown_requested = False
 
         self.thread = None
+        self.pid = os.getpid()
 
         self.handler = ossocket.ConnHandler()
 
+        # Messages collected by begin_batch, per thread
+        self.batch = MessageBatch()
+
+        # Time of the last message received from every peer, used by the Heartbeat
+        self.heartbeat = None
+        self.last_seen = {}
+
+        # Event loop of the SocketThread, which runs the tasks of the events engine
+        # and the timers of the events and pool engines
+        self.engine = conf.get(PYCSP_ENGINE)
+        if self.engine == ENGINE_POOL:
+            self.executor = engine.WorkerPool(conf.get(PYCSP_ENGINE_WORKERS))
+        elif self.engine in (ENGINE_THREADS, ENGINE_EVENTS):
+            self.executor = self
+        else:
+            raise InfoException("Unknown engine %s" % repr(self.engine))
+        self.ready = collections.deque()
+        self.timers = []
+        self.timers_seq = 0
+        self.timers_lock = threading.Lock()
+
+        if self.server_socket:
+            self.listen()
+
     def is_alive(self):
         """
-        If the thread is stale (which may happen when channel ends are communicated between OS processes), a new thread must be started.
+        If the dispatcher is stale (which may happen when channel ends are communicated between OS processes), the dispatcher of this interpreter must be used.
         """
-        if self.thread and self.thread.is_alive():
-            return True
-        else:
-            return False
+        return self.pid == os.getpid()
+
+    def _bind(self):
+        server_socket, server_addr = ossocket.start_server(self.bind_addr)
+
+        # The server socket is non-blocking, to accept all pending connections at once
+        server_socket.setblocking(0)
+
+        # Processes on the same host connect through the unix domain socket, if available
+        self.unix_socket = ossocket.start_unix_server(server_addr)
+        if self.unix_socket:
+            self.unix_socket.setblocking(0)
+
+        self.server_addr = server_addr
+        self.server_socket = server_socket
+
+    def listen(self):
+        """
+        Binds the server sockets and starts the SocketThread, if not done already, such
+        that other interpreters can connect to this interpreter.
+
+        Returns the address of this interpreter.
+        """
+        if not self.listening:
+            self.cond.acquire()
+            try:
+                if not self.listening:
+                    if self.server_socket is None:
+                        self._bind()
+                    if self.thread == None:
+                        self.startThread()
+                    else:
+                        # Let the SocketThread accept connections
+                        self.waker.wake()
+                    self.listening = True
+            finally:
+                self.cond.release()
+        return self.server_addr
+
+    def spawn(self, coroutine):
+        """
+        Runs coroutine as a task on the SocketThread, or on the WorkerPool of the
+        pool engine. Returns the task.
+        """
+        task = engine.Task(self.executor, coroutine)
+        self.executor.call_soon(task.step)
+        return task
+
+    def start_timer(self, seconds, coroutine):
+        """
+        Runs coroutine after seconds, as a task or on a new thread depending on the
+        engine. Returns a timer, which may be cancelled.
+        """
+        if self.engine != ENGINE_THREADS:
+            return self.call_later(seconds, lambda: self.spawn(coroutine))
+
+        timer = threading.Timer(seconds, engine.run, [coroutine])
+        timer.start()
+        return timer
+
+    def call_soon(self, fn):
+        """
+        Runs fn on the SocketThread. May be called from any thread.
+        """
+        self.ready.append(fn)
+        self._notify_loop()
+
+    def call_later(self, seconds, fn):
+        """
+        Runs fn on the SocketThread after seconds. Returns a Timer, which may be cancelled.
+        """
+        self.timers_lock.acquire()
+        try:
+            self.timers_seq += 1
+            timer = engine.Timer(time.time() + seconds, self.timers_seq, fn)
+            heapq.heappush(self.timers, timer)
+        finally:
+            self.timers_lock.release()
+        self._notify_loop()
+        return timer
+
+    def _notify_loop(self):
+        thread = self.thread
+        if thread is None:
+            self.cond.acquire()
+            try:
+                if self.thread == None:
+                    self.startThread()
+            finally:
+                self.cond.release()
+        elif not threading.current_thread() is thread:
+            self.waker.wake()
+
+    def loop_timeout(self):
+        """
+        Returns the seconds the SocketThread may wait for incoming messages
+        """
+        if self.ready:
+            return 0
+        if self.timers:
+            return max(0, min(SOCKETTHREAD_TIMEOUT, self.timers[0].when - time.time()))
+        return SOCKETTHREAD_TIMEOUT
+
+    def run_ready(self):
+        """
+        Runs the timers, which are due, and the callbacks scheduled until now.
+        Invoked by the SocketThread.
+        """
+        if self.timers:
+            now = time.time()
+            self.timers_lock.acquire()
+            try:
+                while self.timers and self.timers[0].when <= now:
+                    fn = heapq.heappop(self.timers).fn
+                    if fn is not None:
+                        self.ready.append(fn)
+            finally:
+                self.timers_lock.release()
+
+        # Callbacks scheduled by these callbacks are run in the next round
+        for i in xrange(len(self.ready)):
+            self.ready.popleft()()
 
     def add_reverse_socket(self, addr, sock):
+        """
+        Sends replies and later messages to addr on the connection opened by addr,
+        unless a connection to addr is cached already.
+        """
         #print "added", addr, sock
         self.handler.updateCache(addr, sock)
-        
-    def add_to_active_socket_list(self, sock):
-        if not (sock in self.active_socket_list or sock in self.active_socket_list_add):
-            
-            self.cond.acquire()
+
+    def connection_closed(self, sock):
+        """
+        Removes a connection closed by the peer from the pool. A connection in use
+        is left to the sending thread, which reconnects when the send fails.
+        """
+        addr = self.handler.cacheAddrs.get(sock)
+        if addr is None:
+            return
+        lock = self.handler.lock(addr)
+        if lock.acquire(False):
             try:
-                if not (sock in self.active_socket_list or sock in self.active_socket_list_add):
-                    self.active_socket_list_add.append(sock)
-                    h = Header(SOCKETTHREAD_PING)
-                    # This connection is made only to the local server
-                    sock = self.handler.connect(self.server_addr)
-                    self.handler.sendall(sock, h)
-                    self.handler.close(sock)
+                if self.handler.cacheSockets.get(addr) is sock:
+                    self.handler.forceclose(addr)
             finally:
-                self.cond.release()
+                lock.release()
+        
+    def preconnect(self, addrs):
+        """
+        Connects to the remote addresses in advance and concurrently, such that the
+        following sends do not connect one address at a time.
+        """
+        addrs = [addr for addr in addrs if addr != self.server_addr and addr != self.local_addr]
+        if addrs:
+            self.handler.preconnect(addrs)
+
+    def add_to_active_socket_list(self, sock):
+        """
+        Let the SocketThread read incoming messages on a connection, which was
+        created by this interpreter.
+        """
+        if not sock.fileno() in self.readers:
+            # Duplicates are ignored by the SocketThread
+            self.readers_add.append(sock)
+            self.waker.wake()
 
     def startThread(self):
         self.cond.acquire()
@@ -416,6 +1148,11 @@ class SocketThreadData:
             if self.thread == None:
                 self.thread = SocketThread(self)
                 self.thread.start()
+
+            timeout = conf.get(SOCKETS_HEARTBEAT_TIMEOUT)
+            if timeout and self.heartbeat == None:
+                self.heartbeat = Heartbeat(self, timeout)
+                self.heartbeat.start()
         finally:
             self.cond.release()
 
@@ -424,11 +1161,11 @@ class SocketThreadData:
         self.cond.acquire()
         try:
             if not self.thread == None:
-                h = Header(SOCKETTHREAD_SHUTDOWN)
-                # This connection is made only to the local server
-                sock = ossocket.connectNOcache(self.server_addr)
-                ossocket.sendallNOcache(sock, h)
-                ossocket.closeNOcache(sock)
+                self.shutdown_requested = True
+                self.waker.wake()
+            elif self.engine == ENGINE_POOL:
+                # No channel homes are left. Workers are started again by the next task.
+                self.executor.stop()
         finally:
             self.cond.release()
                 
@@ -442,28 +1179,75 @@ class SocketThreadData:
     def registerChannel(self, name_id):
         self.cond.acquire()
         try:
-            if name_id in self.channels_unknown:
-                #print "GOT UNKNOWN MESSAGE"
-                q = self.channels_unknown.pop(name_id)
-            else:
-                q = QueueBuffer()
+            q = QueueBuffer()
+            for m in self.channels_unknown.pop(name_id):
+                if (m.header.cmd & IS_REPLY):
+                    q.put_reply(m)
+                else:
+                    q.put_normal(m)
 
             self.channels[name_id] = q
-            if self.thread == None:
-                self.startThread()
         finally:
             self.cond.release()
         return q
 
     def getChannelQueue(self, name_id):
-        self.cond.acquire()
-        if name_id in self.channels:
-            q = self.channels[name_id]
-        else:
+        q = self.channels.get(name_id)
+        if q is None:
             q = self.guards[name_id]
-        self.cond.release()
         return q
 
+    def store_unknown_channel(self, m):
+        """
+        Saves a message for a channel, which has not been registered yet.
+
+        If the channel has been registered in the meantime, then the message is
+        not saved and the queue of the channel is returned.
+        """
+        self.cond.acquire()
+        try:
+            q = self.channels.get(m.header.id)
+            if q is None:
+                self.channels_unknown.add(m)
+        finally:
+            self.cond.release()
+        return q
+
+    def seen(self, header):
+        self.last_seen[(header._source_host, header._source_port)] = time.time()
+
+    def peer_lost(self, addr):
+        """
+        Closes the cached connection to a lost peer and wakes the threads waiting for
+        a reply from it.
+        """
+        self.last_seen.pop(addr, None)
+        if ossocket.STDERR_OUTPUT:
+            sys.stderr.write("PyCSP lost peer %s\n" % str(addr))
+
+        # A thread blocked sending to the peer holds the lock. Its connection is left
+        # to fail by itself.
+        lock = self.handler.lock(addr)
+        if lock.acquire(False):
+            try:
+                self.handler.forceclose(addr)
+            finally:
+                lock.release()
+
+        for q in self.channels.values() + self.guards.values():
+            q.peer_lost(addr)
+
+    def expire_unknown(self):
+        """
+        Evicts messages to unknown channels and processes, which have passed their TTL
+        """
+        self.cond.acquire()
+        try:
+            self.channels_unknown.expire()
+            self.processes_unknown.expire()
+        finally:
+            self.cond.release()
+
     def deregisterChannel(self, name_id):
         self.cond.acquire()
         try:
@@ -478,8 +1262,6 @@ class SocketThreadData:
         self.cond.acquire()
         try:
             self.guards[name_id] = QueueBuffer()
-            if self.thread == None:
-                self.startThread()
         finally:
             self.cond.release()
 
@@ -496,18 +1278,28 @@ class SocketThreadData:
     def registerProcess(self, name_id, remotelock):
         self.cond.acquire()
         try:
-            if name_id in self.processes_unknown:
-                for m in self.processes_unknown[name_id]:
-                    remotelock.handle(m)
-                del self.processes_unknown[name_id]
-
+            for m in self.processes_unknown.pop(name_id):
+                remotelock.handle(m)
 
             self.processes[name_id] = remotelock
+        finally:
+            self.cond.release()
 
-            if self.thread == None:
-                self.startThread()
+    def store_unknown_process(self, m):
+        """
+        Saves a message for a process, which has not been registered yet.
+
+        If the process has been registered in the meantime, then the message is
+        not saved and the remote lock of the process is returned.
+        """
+        self.cond.acquire()
+        try:
+            remotelock = self.processes.get(m.header.id)
+            if remotelock is None:
+                self.processes_unknown.add(m)
         finally:
             self.cond.release()
+        return remotelock
 
     def deregisterProcess(self, name_id):
 
@@ -522,52 +1314,56 @@ class SocketThreadData:
 
 
     def send(self, addr, header, payload="", otherhandler=None):
+        # is destination address the same as my own address? 
+        local = addr == self.server_addr or addr == self.local_addr
+        if not local and not self.listening:
+            # The peer must be able to reply
+            self.listen()
+
         # Update message source
         header._source_host, header._source_port = self.server_addr
         
         m = Message(header, payload)
         
-        # is destination address the same as my own address? 
-        self.cond.acquire()
-        try:
-            if addr == self.server_addr:
-                if (header.cmd & PROCESS_CMD):
-                    # Process message
-                    if header.id in self.processes:
-                        self.processes[header.id].handle(m)
-                    elif (header.cmd & REQ_REPLY):
+        if local:
+            if (header.cmd & PROCESS_CMD):
+                # Process message
+                remotelock = self.processes.get(header.id)
+                if remotelock is None:
+                    if (header.cmd & REQ_REPLY):
                         self.reply(header, Header(LOCKTHREAD_UNAVAILABLE, header._source_id), payload="", otherhandler=otherhandler)
                     elif (header.cmd & IGN_UNKNOWN):
                         pass
                     else:
-                        if not header.id in self.processes_unknown:
-                            self.processes_unknown[header.id] = []
-                        self.processes_unknown[header.id].append(m)
-                elif (header.cmd & GUARD_CMD and header.id in self.guards):
-                    # Guard message
-                    raise FatalException("Guard should never receive a normal message")
-                else:
-                    # Channel message
-                    if header.id in self.channels:
-                        self.channels[header.id].put_normal(m)
-                    elif (header.cmd & IGN_UNKNOWN):
-                        pass
-                    else:
-                        if not header.id in self.channels_unknown:
-                            self.channels_unknown[header.id] = QueueBuffer()
-                        self.channels_unknown[header.id].put_normal(m)
+                        remotelock = self.store_unknown_process(m)
+                if remotelock:
+                    remotelock.handle(m)
+            elif (header.cmd & GUARD_CMD and header.id in self.guards):
+                # Guard message
+                raise FatalException("Guard should never receive a normal message")
             else:
-                if otherhandler:
-                    m.transmit(otherhandler, addr)
-                else:
-                    m.transmit(self.handler, addr)
-        finally:
-            self.cond.release()
+                # Channel message
+                q = self.channels.get(header.id)
+                if q is None and not (header.cmd & IGN_UNKNOWN):
+                    q = self.store_unknown_channel(m)
+                if q is not None:
+                    q.put_normal(m)
+        else:
+            # Sends to different destinations are only serialized by the per-destination locks in the handler
+            if otherhandler:
+                self._transmit(m, otherhandler, addr)
+            else:
+                self._transmit(m, self.handler, addr)
 
 
     def reply(self, source_header, header, payload="", otherhandler=None):
         addr = (source_header._source_host, source_header._source_port)
 
+        # is destination address the same as my own address? 
+        local = addr == self.server_addr or addr == self.local_addr
+        if not local and not self.listening:
+            self.listen()
+
         # Update message source
         header._source_host, header._source_port = self.server_addr        
 
@@ -576,41 +1372,74 @@ class SocketThreadData:
 
         m = Message(header, payload)
     
-        # is destination address the same as my own address? 
-        self.cond.acquire()
-        try:
-            if addr == self.server_addr:
-                if (header.cmd & PROCESS_CMD):
-                    # Process message
-                    if header.id in self.processes:
-                        self.processes[header.id].handle(m)
-                    elif (header.cmd & IGN_UNKNOWN):
-                        pass
-                    else:
-                        if not header.id in self.processes_unknown:
-                            self.processes_unknown[header.id] = []
-                        self.processes_unknown[header.id].append(m)
-                elif (header.cmd & GUARD_CMD and header.id in self.guards):
-                    # Guard message
-                    self.guards[header.id].put_reply(m)
-                else:
-                    # Channel message
-                    if header.id in self.channels:
-                        self.channels[header.id].put_reply(m)
-                    elif (header.cmd & IGN_UNKNOWN):
-                        pass
-                    else:
-                        if not header.id in self.channels_unknown:
-                            self.channels_unknown[header.id] = QueueBuffer()
-                        self.channels_unknown[header.id].put_reply(m)                
+        if local:
+            if (header.cmd & PROCESS_CMD):
+                # Process message
+                remotelock = self.processes.get(header.id)
+                if remotelock is None and not (header.cmd & IGN_UNKNOWN):
+                    remotelock = self.store_unknown_process(m)
+                if remotelock:
+                    remotelock.handle(m)
+            elif (header.cmd & GUARD_CMD and header.id in self.guards):
+                # Guard message
+                self.guards[header.id].put_reply(m)
             else:
-                if otherhandler:
-                    m.transmit(otherhandler, addr)
-                else:
-                    m.transmit(self.handler, addr)
-        finally:
-            self.cond.release()
-        
+                # Channel message
+                q = self.channels.get(header.id)
+                if q is None and not (header.cmd & IGN_UNKNOWN):
+                    q = self.store_unknown_channel(m)
+                if q is not None:
+                    q.put_reply(m)
+        else:
+            if otherhandler:
+                self._transmit(m, otherhandler, addr)
+            else:
+                self._transmit(m, self.handler, addr)
+
+    def _transmit(self, m, handler, addr):
+        batch = self.batch
+        if batch.depth:
+            # Sent when the batch is flushed
+            key = (handler, addr)
+            if key in batch.pending:
+                batch.pending[key].append(m)
+            else:
+                batch.pending[key] = [m]
+        else:
+            m.transmit(handler, addr)
 
-        
+    def begin_batch(self):
+        """
+        Collect the messages sent to remote destinations by the current thread, until
+        the matching call to flush_batch. Batches may be nested.
+
+        Messages are delayed until the batch is flushed, thus the current thread must
+        not wait for a reply to a message sent within the batch.
+        """
+        self.batch.depth += 1
+
+    def flush_batch(self):
+        """
+        Ends a batch. When the outermost batch ends, the collected messages are sent
+        with one coalesced send per destination.
+
+        All destinations are attempted. Raises AddrUnavailableException for a
+        destination, which could not be reached.
+        """
+        batch = self.batch
+        batch.depth -= 1
+        if batch.depth > 0 or not batch.pending:
+            return
+
+        pending = batch.pending
+        batch.pending = collections.OrderedDict()
+
+        unavailable = None
+        for (handler, addr), messages in pending.iteritems():
+            try:
+                transmit(handler, addr, messages)
+            except SocketException:
+                unavailable = addr
 
+        if unavailable:
+            raise AddrUnavailableException(unavailable)
@@ -0,0 +1,262 @@
+"""
+Engine module
+
+Channel homes and timers are written as coroutines: generators, which yield a Wait
+when they must wait for a message, or yield another coroutine to call it. A coroutine
+returns a value by raising Return(value).
+
+The engine is selected with Configuration().set(PYCSP_ENGINE, ...), before the first
+channel is created:
+
+  ENGINE_THREADS  Every channel home and timer runs on its own thread, which blocks
+                  in every Wait.
+  ENGINE_EVENTS   Channel homes and timers run as tasks on the event loop of the
+                  SocketThread. A waiting task is suspended and resumed, when its
+                  message has arrived, thus no thread is needed per channel home.
+  ENGINE_POOL     Channel homes run as tasks on a WorkerPool of PYCSP_ENGINE_WORKERS
+                  threads, while timers are scheduled by the SocketThread. A task is
+                  run by one worker at a time, thus the messages to a channel home
+                  are handled in order. (default)
+
+CSP processes are threads or OS processes with all engines.
+
+Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
+      Brian Vinter <vinter@nbi.dk>, Rune M. Friborg <rune.m.friborg@gmail.com>.
+See LICENSE.txt for licensing details (MIT License).
+"""
+
+# Imports
+import sys
+import types
+import collections
+import threading
+import traceback
+
+from pycsp.parallel.const import *
+
+
+class Return(Exception):
+    """ Return(value)
+
+    Raised by a coroutine to return value to its caller
+    """
+    pass
+
+
+class Wait(object):
+    """ Wait(queue, reply=False, addr=None)
+
+    Yielded by a coroutine to get the next normal message of a QueueBuffer, or the
+    next reply from the peer at addr.
+    """
+    __slots__ = ['queue', 'reply', 'addr']
+
+    def __init__(self, queue, reply=False, addr=None):
+        self.queue = queue
+        self.reply = reply
+        self.addr = addr
+
+    def block(self):
+        """
+        Waits on the calling thread. Returns the message.
+        """
+        if self.reply:
+            return self.queue.pop_reply(self.addr)
+        return self.queue.pop_normal()
+
+    def suspend(self, task):
+        """
+        Returns (True, message) if available. Otherwise (False, None) is returned and
+        the task is woken, when the message has arrived.
+        """
+        return self.queue.suspend(task, self.reply, self.addr)
+
+
+_generator = types.GeneratorType
+
+def _advance(stack, value=None):
+    """
+    Resumes the coroutine on top of stack with value, until a Wait is yielded or the
+    coroutine at the bottom has finished.
+
+    Returns (Wait, None) or (None, value returned by the bottom coroutine). Exceptions
+    are propagated to the caller of the failing coroutine.
+    """
+    exc = None
+    gen = stack[-1]
+    while True:
+        try:
+            if exc is None:
+                item = gen.send(value)
+            else:
+                item = gen.throw(*exc)
+                exc = None
+        except Return as r:
+            stack.pop()
+            if r.args:
+                value = r.args[0]
+            else:
+                value = None
+        except StopIteration:
+            stack.pop()
+            value = None
+        except:
+            stack.pop()
+            value, exc = None, sys.exc_info()
+        else:
+            if type(item) is _generator:
+                # Call
+                stack.append(item)
+                gen = item
+                value = None
+                continue
+            return item, None
+
+        if not stack:
+            if exc:
+                raise exc[0], exc[1], exc[2]
+            return None, value
+        gen = stack[-1]
+
+
+def run(coroutine):
+    """
+    Runs coroutine to completion on the calling thread, blocking in every Wait.
+    Returns the value returned by the coroutine.
+    """
+    stack = [coroutine]
+    wait, value = _advance(stack)
+    while wait is not None:
+        wait, value = _advance(stack, wait.block())
+    return value
+
+
+class Task(object):
+    """ Task(loop, coroutine)
+
+    Runs coroutine on the event loop of the SocketThread or on a WorkerPool.
+    loop must provide call_soon(fn).
+    """
+    def __init__(self, loop, coroutine):
+        self.loop = loop
+        self.stack = [coroutine]
+        self.wait = None
+        self.value = None
+        self.done = threading.Event()
+
+    def wake(self):
+        """
+        Schedules the task to run. May be called from any thread.
+        """
+        self.loop.call_soon(self.step)
+
+    def step(self):
+        """
+        Runs the task, until it waits for a message, which has not arrived.
+        """
+        value = None
+        for i in xrange(TASK_STEPS):
+            if self.wait is not None:
+                ready, value = self.wait.suspend(self)
+                if not ready:
+                    return
+            try:
+                self.wait, self.value = _advance(self.stack, value)
+            except Exception:
+                sys.stderr.write("PyCSP task failed:\n" + traceback.format_exc())
+                self.wait = None
+                self.stack = []
+            if self.wait is None:
+                self.done.set()
+                return
+
+        # Let the loop handle other tasks and connections
+        self.wake()
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+
+class Timer(object):
+    """
+    A call scheduled on the event loop. Cancelled with cancel().
+    """
+    __slots__ = ['when', 'seq', 'fn']
+
+    def __init__(self, when, seq, fn):
+        self.when = when
+        self.seq = seq
+        self.fn = fn
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.fn = None
+
+
+class WorkerPool(object):
+    """ WorkerPool(size)
+
+    Runs the callbacks given to call_soon on at most size threads. Workers are
+    started when needed and stopped with stop().
+    """
+    def __init__(self, size):
+        self.size = size
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.workers = 0
+        self.idle = 0
+
+        # Incremented by stop(). Workers of an older generation quit.
+        self.generation = 0
+
+    def call_soon(self, fn):
+        """
+        Runs fn on a worker. May be called from any thread.
+        """
+        self.cond.acquire()
+        try:
+            self.queue.append(fn)
+            if self.idle:
+                self.cond.notify()
+            elif self.workers < self.size:
+                self.workers += 1
+                worker = threading.Thread(target=self._work, args=(self.generation,))
+                worker.daemon = False
+                worker.start()
+        finally:
+            self.cond.release()
+
+    def _work(self, generation):
+        self.cond.acquire()
+        try:
+            while generation == self.generation:
+                if self.queue:
+                    fn = self.queue.popleft()
+                    self.cond.release()
+                    try:
+                        fn()
+                    finally:
+                        self.cond.acquire()
+                else:
+                    self.idle += 1
+                    self.cond.wait()
+                    if generation == self.generation:
+                        self.idle -= 1
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        """
+        Stops the workers, when they have finished their current callback. Callbacks
+        given to call_soon later are run by new workers.
+        """
+        self.cond.acquire()
+        try:
+            self.generation += 1
+            self.workers = 0
+            self.idle = 0
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
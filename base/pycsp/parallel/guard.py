@@ -8,8 +8,8 @@ See LICENSE.txt for licensing details (MIT License).
 
 # Imports
 import threading
-import uuid
 
+from pycsp.parallel import engine
 from pycsp.parallel.process import Process
 from pycsp.parallel.const import *
 from pycsp.parallel.protocol import AddrID, ChannelReq, LockMessenger
@@ -25,7 +25,7 @@ class Guard:
         self.g = (self, action)
 
         # Id similar to channel name, to correctly select the chosen guard among the guard set.
-        self.id = uuid.uuid1().hex
+        self.id = unique_id()
 
         # Necessary to allow for correct locking
         self.dispatch = SocketDispatcher().getThread()
@@ -33,9 +33,12 @@ class Guard:
         self.LM = LockMessenger(self.id)
 
     def _offer(self, req):
+        """
+        Coroutine. Commits req, if it is still active.
+        """
         try:
             # Acquire lock
-            conn, state, seq = self.LM.remote_acquire_and_get_state(req.process)
+            conn, state, seq = yield self.LM.remote_acquire_and_get_state(req.process)
             
             # Check sequence number
             if seq != req.seq_check:
@@ -106,9 +109,9 @@ class SkipGuard(Guard):
     # Offer instantly
     def _post_read(self, process, ack=False):
         proc_addr_id = AddrID(process.addr, process.id)
-        self._offer(ChannelReq(self.LM, proc_addr_id,
-                                       process.sequence_number,
-                                       self.id))
+        engine.run(self._offer(ChannelReq(self.LM, proc_addr_id,
+                                          process.sequence_number,
+                                          self.id)))
 
         # Send acknowledgement to process. (used to ensure prioritized select)
         if ack:
@@ -122,10 +125,11 @@ class SkipGuard(Guard):
 class TimeoutGuard(Guard):
     """ TimeoutGuard(seconds, action=None)
 
-    TimeoutGuard spawns a timer thread, when posted. If removed
-    before timeout, then the timer thread is cancelled.
+    TimeoutGuard starts a timer, when posted. If removed
+    before timeout, then the timer is cancelled.
 
-    When the timer expires, the timer thread will commit a successful communication.
+    When the timer expires, the timer will commit a successful communication. The timer
+    runs on a thread, on the event loop or on a worker, depending on the engine.
 
     Usage:
       >>> C = Channel()
@@ -168,14 +172,17 @@ class TimeoutGuard(Guard):
         self.seconds = seconds
         self.posted_req = None
         self.timer_cancelled=False
+        self.timer = None
         self.lock = threading.Lock()
 
     # Timer expired, offer an active Channel Request
     def _expire(self):
         self.lock.acquire()
-        if not self.timer_cancelled:        
-            self._offer(self.posted_req)
-        self.lock.release()
+        try:
+            if not self.timer_cancelled:        
+                yield self._offer(self.posted_req)
+        finally:
+            self.lock.release()
 
     def _post_read(self, process, ack=False):
         proc_addr_id = AddrID(process.addr, process.id)
@@ -187,12 +194,13 @@ class TimeoutGuard(Guard):
         self.posted_req = ChannelReq(self.LM, proc_addr_id,
                                      process.sequence_number,
                                      self.id)
-        self.timer = threading.Timer(self.seconds, self._expire)
-        self.timer.start()
+        self.timer = self.dispatch.start_timer(self.seconds, self._expire())
   
     def _close(self):
         self.lock.acquire()
         self.timer_cancelled=True
+        if self.timer:
+            self.timer.cancel()
         Guard._close(self)
         self.lock.release()
         
@@ -8,12 +8,11 @@ See LICENSE.txt for licensing details (MIT License).
 
 # Imports
 import types
-import uuid
 import threading
 
 from pycsp.parallel.dispatch import SocketDispatcher
 from pycsp.parallel.protocol import RemoteLock, ChannelMessenger
-from pycsp.parallel.channel import Channel, ChannelEndRead, ChannelEndWrite
+from pycsp.parallel.channel import Channel, ChannelEndRead, ChannelEndWrite, channel_home_addresses
 from pycsp.parallel.const import *
 from pycsp.parallel.exceptions import *
 
@@ -70,13 +69,14 @@ class Process(threading.Thread):
         self.kwargs = kwargs
         self.return_value = None
 
-        # Create 64 byte unique id based on network address, sequence number and time sample.
-        self.id = uuid.uuid1().hex + "." + fn.func_name[:31]
+        # Create unique id from the interpreter prefix, a counter and the function name.
+        self.id = unique_id() + "." + fn.func_name[:31]
         
         # Channel request state
         self.state = FAIL        
         self.result_ch_idx = None
         self.result_msg = None
+        self.result_codec = 0
 
         # Used to wait for acknowledgements from the RemoteLock
         self.ack = False
@@ -92,7 +92,7 @@ class Process(threading.Thread):
         self.registeredChanConnectList = []
 
         # Protect against early termination of processes leaving channelhomes in an invalid state
-        self.activeChanList = []
+        self.activeChanSet = set()
         self.closedChanList = []
 
         # Identify this as a wrapped pycsp process, which must not be terminated by shutdown
@@ -136,6 +136,9 @@ class Process(threading.Thread):
         self.addr = dispatch.server_addr
         dispatch.registerProcess(self.id, RemoteLock(self))
 
+        # Hide the connect latency from the first communication on every channel
+        dispatch.preconnect(channel_home_addresses([self.args, self.kwargs]))
+
         try:
             self.return_value = self.fn(*self.args, **self.kwargs)
         except ChannelPoisonException as e:
@@ -152,12 +155,12 @@ class Process(threading.Thread):
             p.join_report()
 
         # Initiate clean up and waiting for channels to finish outstanding operations.
-        for channel in self.activeChanList:
+        for channel in self.activeChanSet:
             channel._CM.leave(channel, self)
 
         # Wait for channels        
         self.cond.acquire()
-        X = len(self.activeChanList)
+        X = len(self.activeChanSet)
         while len(self.closedChanList) < X:
             self.cond.wait()
         self.cond.release()
@@ -419,11 +422,12 @@ def init():
         if not current_proc in init_procs:
             init_procs.append(current_proc)
 
-        current_proc.id = uuid.uuid1().hex + ".__INIT__"
+        current_proc.id = unique_id() + ".__INIT__"
         current_proc.fn = None
         current_proc.state = FAIL
         current_proc.result_ch_idx = None
         current_proc.result_msg = None
+        current_proc.result_codec = 0
         current_proc.ack = False
 
         current_proc.sequence_number = 1
@@ -436,7 +440,7 @@ def init():
         current_proc.registeredChanConnectList = []
 
         # Protect against early termination of processes leaving channelhomes in an invalid state
-        current_proc.activeChanList = []
+        current_proc.activeChanSet = set()
         current_proc.closedChanList = []
 
         current_proc.cond = threading.Condition()
@@ -496,12 +500,12 @@ def shutdown():
             p.join_report()
 
         # Initiate clean up and waiting for channels to finish outstanding operations.
-        for channel in current_proc.activeChanList:
+        for channel in current_proc.activeChanSet:
             channel._CM.leave(channel, current_proc)
 
         # Wait for channels        
         current_proc.cond.acquire()
-        X = len(current_proc.activeChanList)
+        X = len(current_proc.activeChanSet)
         while len(current_proc.closedChanList) < X:
             current_proc.cond.wait()
         current_proc.cond.release()
@@ -522,11 +526,12 @@ def shutdown():
         current_proc.spawned = []
         current_proc.registeredChanHomeList = []
         current_proc.registeredChanConnectList = []
-        current_proc.activeChanList = []
+        current_proc.activeChanSet = set()
         current_proc.closedChanList = []
 
         # Reset current_proc id, to force a new init(), if required
         del current_proc.id
+        resetProcessContext()
 
 
     except AttributeError:
@@ -0,0 +1,393 @@
+"""
+Shared memory transport module
+
+Connections between interpreters on the same host may be upgraded to a pair of
+single-producer/single-consumer ring buffers in a shared memory mapping, one for
+every direction. Enabled with Configuration().set(SOCKETS_SHM_TRANSPORT, True).
+
+The unix domain socket of the connection is kept as doorbell. A byte is only written
+to it, when the reader has found its ring empty and waits in the Poller, thus busy
+connections transfer messages without system calls. A ShmSocket provides the socket
+methods used by ossocket and dispatch, such that it replaces the socket transparently.
+
+Handshake, sent by the connecting side on a new unix domain socket connection:
+  SHM_MAGIC (4 bytes), length of path (2 bytes), path of the mapped file.
+The accepting side maps the file and answers with SHM_ACK or SHM_NACK. The file is
+removed by the connecting side, when answered.
+
+Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
+      Brian Vinter <vinter@nbi.dk>, Rune M. Friborg <rune.m.friborg@gmail.com>.
+See LICENSE.txt for licensing details (MIT License).
+"""
+
+# Imports
+import os
+import sys
+import mmap
+import time
+import errno
+import socket
+import struct
+import threading
+
+from pycsp.parallel.const import *
+
+SHM_MAGIC = "PSHM"
+SHM_ACK, SHM_NACK = "\1", "\0"
+_path_len = struct.Struct("!H")
+
+# Shared memory files are created in a memory backed file system, if available.
+# Otherwise in the default directory of tempfile.
+if os.path.isdir("/dev/shm"):
+    SHM_DIR = "/dev/shm"
+else:
+    SHM_DIR = None
+
+# Ring layout. The counters are placed on separate cache lines.
+_u64 = struct.Struct("Q")
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+WAITING_OFFSET = 128
+DATA_OFFSET = 4096
+
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# Acquiring a lock executes an atomic instruction, which is a full memory barrier.
+_fence_lock = threading.Lock()
+
+def _fence():
+    """
+    Orders a write to shared memory before a following read. Used when the writer and
+    the reader of a ring both store a value and then load the value stored by the other.
+    """
+    _fence_lock.acquire()
+    _fence_lock.release()
+
+
+class Ring(object):
+    """
+    Single-producer/single-consumer byte ring at offset in a shared memory mapping.
+
+    head and tail are the number of bytes written and read since the ring was created.
+    head is only written by the producer, while tail and waiting are only written by
+    the consumer.
+    """
+    def __init__(self, mm, offset, capacity):
+        import ctypes
+
+        self.capacity = capacity
+        self.mem = (ctypes.c_char * (DATA_OFFSET + capacity)).from_buffer(mm, offset)
+        self.data = memoryview(self.mem)[DATA_OFFSET:]
+
+        # Private copies of the counters owned by this side
+        self.head = _u64.unpack_from(self.mem, HEAD_OFFSET)[0]
+        self.tail = _u64.unpack_from(self.mem, TAIL_OFFSET)[0]
+
+    def _get(self, offset):
+        return _u64.unpack_from(self.mem, offset)[0]
+
+    def _set(self, offset, value):
+        _u64.pack_into(self.mem, offset, value)
+
+    # Producer
+    def write(self, data):
+        """
+        Writes as much of data as fits into the ring. Returns the number of bytes written.
+        """
+        free = self.capacity - (self.head - self._get(TAIL_OFFSET))
+        n = min(free, len(data))
+        if n == 0:
+            return 0
+        pos = self.head % self.capacity
+        first = min(n, self.capacity - pos)
+        self.data[pos:pos+first] = data[:first]
+        if first < n:
+            self.data[:n-first] = data[first:n]
+        self.head += n
+        self._set(HEAD_OFFSET, self.head)
+        return n
+
+    def reader_waiting(self):
+        _fence()
+        return self._get(WAITING_OFFSET)
+
+    # Consumer
+    def available(self):
+        return self._get(HEAD_OFFSET) - self.tail
+
+    def read_into(self, view, nbytes):
+        """
+        Moves up to nbytes from the ring into view. Returns the number of bytes read.
+        """
+        n = min(nbytes, self.available())
+        if n == 0:
+            return 0
+        pos = self.tail % self.capacity
+        first = min(n, self.capacity - pos)
+        view[:first] = self.data[pos:pos+first]
+        if first < n:
+            view[first:n] = self.data[:n-first]
+        self.tail += n
+        self._set(TAIL_OFFSET, self.tail)
+        return n
+
+    def read(self, nbytes):
+        n = min(nbytes, self.available())
+        pos = self.tail % self.capacity
+        first = min(n, self.capacity - pos)
+        data = self.data[pos:pos+first].tobytes()
+        if first < n:
+            data += self.data[:n-first].tobytes()
+        self.tail += n
+        self._set(TAIL_OFFSET, self.tail)
+        return data
+
+    def set_waiting(self, waiting):
+        """
+        Announces whether the consumer waits for the doorbell. After announcing, the
+        ring must be checked again, as the producer may have written in between.
+        """
+        self._set(WAITING_OFFSET, waiting)
+        if waiting:
+            _fence()
+
+
+class ShmSocket(object):
+    """
+    Connection transferring data through shared memory rings. Provides the methods
+    of socket objects used by pycsp.
+
+    All reads must be done by a single thread. Sends are serialized by send_lock.
+
+    The rings keep the mapping alive, thus it is unmapped when the connection has
+    been closed and is no longer referenced by any thread.
+    """
+    def __init__(self, sock, tx, rx):
+        self.sock = sock
+        self.tx = tx
+        self.rx = rx
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+        # True when the rx ring has been announced as empty, thus the doorbell may ring
+        self.waiting = True
+        self.peer_closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def setsockopt(self, *args):
+        pass
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    # Sending
+    def sendall(self, data):
+        self.send_lock.acquire()
+        try:
+            self._check_open()
+            self._write(data)
+            self._ring()
+        finally:
+            self.send_lock.release()
+
+    def sendallv(self, buffers):
+        """
+        Sends all buffers in order, with one wakeup of the reader.
+        """
+        self.send_lock.acquire()
+        try:
+            self._check_open()
+            for data in buffers:
+                self._write(data)
+            self._ring()
+        finally:
+            self.send_lock.release()
+
+    def _check_open(self):
+        if self.closed:
+            raise socket.error(errno.EBADF, os.strerror(errno.EBADF))
+
+    def _write(self, data):
+        if type(data) != str:
+            data = memoryview(data)
+        written = self.tx.write(data)
+        delay = 0.00001
+        while written < len(data):
+            # The ring is full. Wake the reader and wait for it to make room.
+            self._ring()
+            time.sleep(delay)
+            delay = min(delay * 2, 0.001)
+            self._check_peer()
+            written += self.tx.write(data[written:])
+
+    def _ring(self):
+        if self.tx.reader_waiting():
+            try:
+                self.sock.send("\0", _MSG_DONTWAIT)
+            except socket.error as e:
+                # A full socket buffer means that the reader has already been woken.
+                if not e.errno in _WOULDBLOCK:
+                    raise
+
+    def _check_peer(self):
+        try:
+            if self.sock.recv(1, socket.MSG_PEEK | _MSG_DONTWAIT) == "":
+                raise socket.error(errno.EPIPE, os.strerror(errno.EPIPE))
+        except socket.error as e:
+            if not e.errno in _WOULDBLOCK:
+                raise
+
+    # Receiving
+    def _ready(self):
+        """
+        Returns the number of bytes available. If none are available, the doorbell is
+        armed and an EAGAIN socket.error is raised, or 0 is returned if the peer has closed.
+        """
+        self._check_open()
+        if self.waiting:
+            self._drain()
+        n = self.rx.available()
+        if n:
+            if self.waiting:
+                self.waiting = False
+                self.rx.set_waiting(0)
+            return n
+
+        if self.peer_closed:
+            return 0
+
+        n = self.buffered()
+        if n:
+            return n
+        raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+
+    def _drain(self):
+        try:
+            if self.sock.recv(4096, _MSG_DONTWAIT) == "":
+                self.peer_closed = True
+        except socket.error as e:
+            if e.errno == errno.ECONNRESET:
+                self.peer_closed = True
+            elif not e.errno in _WOULDBLOCK:
+                raise
+
+    def buffered(self):
+        """
+        Returns the number of bytes available. If none are available, the doorbell is armed.
+        """
+        if self.closed:
+            return 0
+        n = self.rx.available()
+        if n == 0 and not self.waiting:
+            self.waiting = True
+            self.rx.set_waiting(1)
+            n = self.rx.available()
+        return n
+
+    def recv(self, bufsize, flags=0):
+        if not self._ready():
+            return ""
+        return self.rx.read(bufsize)
+
+    def recv_into(self, view, nbytes=0, flags=0):
+        if not self._ready():
+            return 0
+        if nbytes == 0:
+            nbytes = len(view)
+        return self.rx.read_into(view, nbytes)
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+def _map(path, size, create):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        if create:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+def _rings(mm):
+    size = DATA_OFFSET + SHM_RING_SIZE
+    return Ring(mm, 0, SHM_RING_SIZE), Ring(mm, size, SHM_RING_SIZE)
+
+def connect(sock, timeout):
+    """
+    Upgrades a new unix domain socket connection. Returns a ShmSocket or None, if the
+    peer did not answer. On a refusal, the connection is returned unchanged.
+    """
+    import tempfile
+
+    try:
+        fd, path = tempfile.mkstemp(prefix="pycsp-", dir=SHM_DIR)
+        os.close(fd)
+    except (IOError, OSError) as e:
+        sys.stderr.write("PyCSP unable to create shared memory: %s\n" % (str(e)))
+        return sock
+
+    try:
+        mm = _map(path, 2 * (DATA_OFFSET + SHM_RING_SIZE), True)
+        tx, rx = _rings(mm)
+        # Both readers start out waiting for the doorbell
+        tx.set_waiting(1)
+        rx.set_waiting(1)
+        sock.settimeout(timeout)
+        try:
+            sock.sendall(SHM_MAGIC + _path_len.pack(len(path)) + path)
+            answer = sock.recv(1)
+        except socket.error:
+            answer = None
+        finally:
+            sock.settimeout(None)
+    finally:
+        os.unlink(path)
+
+    if answer == SHM_ACK:
+        return ShmSocket(sock, tx, rx)
+
+    if answer == SHM_NACK:
+        return sock
+    return None
+
+def accept(sock, data):
+    """
+    Answers the handshake at the start of data received on sock.
+
+    Returns (connection, remaining data) or None, if the handshake is incomplete.
+    """
+    start = len(SHM_MAGIC) + _path_len.size
+    if len(data) < start:
+        return None
+    length, = _path_len.unpack_from(data, len(SHM_MAGIC))
+    if len(data) < start + length:
+        return None
+    path = data[start:start+length]
+
+    try:
+        mm = _map(path, 2 * (DATA_OFFSET + SHM_RING_SIZE), False)
+    except (IOError, OSError, mmap.error) as e:
+        sys.stderr.write("PyCSP unable to map shared memory %s: %s\n" % (path, str(e)))
+        mm = None
+
+    try:
+        if mm:
+            sock.sendall(SHM_ACK)
+        else:
+            sock.sendall(SHM_NACK)
+    except socket.error:
+        # The peer has given up. The closed connection is detected by the next read.
+        pass
+
+    if mm:
+        rx, tx = _rings(mm)
+        sock = ShmSocket(sock, tx, rx)
+    return sock, data[start+length:]
@@ -1 +1,7 @@
 __all__ = ['toolkit', 'plugNplay','trace']
+
+# The modules use the pycsp version imported by the application, which is
+# pycsp.parallel, if no version has been imported yet
+import pycsp.current
+if not hasattr(pycsp.current, 'version'):
+    import pycsp.parallel
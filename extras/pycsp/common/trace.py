@@ -12,6 +12,7 @@ See LICENSE.txt for licensing details (MIT License).
 """
 
 import sys
+import threading
 import pycsp.current as pycsp
 from pycsp.current import *
 
@@ -21,8 +22,23 @@ from pycsp.common import toolkit as pycsp_toolkit
 # Set trace mode
 pycsp.trace = True
 
-# Setup gather system
-C = [pycsp.Channel('TraceChan_A'), pycsp.Channel('TraceChan_B')]
+# Setup gather system. The channels are created by TraceInit, as creating them at
+# import would start their channel homes.
+C = []
+_C_lock = threading.Lock()
+
+def _channels():
+    global _TraceQuit
+    if not C:
+        _C_lock.acquire()
+        try:
+            if not C:
+                channels = [pycsp.Channel('TraceChan_A'), pycsp.Channel('TraceChan_B')]
+                _TraceQuit = channels[0].writer().retire
+                C.extend(channels)
+        finally:
+            _C_lock.release()
+    return C
 
 @pycsp.process
 def Convert2Str(cin, cout):
@@ -30,7 +46,7 @@ def Convert2Str(cin, cout):
         cout(str(cin()) + '\n')
 
 def sendTrace(msg):
-    cout = C[0].writer()
+    cout = _channels()[0].writer()
     cout(msg)
     pycsp.retire(cout)
 
@@ -59,12 +75,11 @@ def TraceInit(file=None, stdout=False):
         file = 'pycsp_trace.log'
 
 
-    pycsp.Spawn(Convert2Str(C[0].reader(), C[1].writer()),
-                pycsp_toolkit.file_w(C[1].reader(), file)) 
+    A, B = _channels()
+    pycsp.Spawn(Convert2Str(A.reader(), B.writer()),
+                pycsp_toolkit.file_w(B.reader(), file)) 
 
 
-_TraceQuit = C[0].writer().retire
-
 def TraceQuit():
     """ TraceQuit()
     Shutdown collecting trace process, by retiring the
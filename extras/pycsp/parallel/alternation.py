@@ -7,14 +7,11 @@ See LICENSE.txt for licensing details (MIT License).
 """
 
 # Imports
-import inspect
+import sys
 import types
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
 from pycsp.parallel.guard import Guard
+from pycsp.parallel.dispatch import decode_payload
 from pycsp.parallel.exceptions import *
 from pycsp.parallel.const import *
 
@@ -197,8 +194,9 @@ class Alternation:
         retire = False
 
         p, _ = getThreadAndName()
-        p.state = READY
+        # The sequence number must change before the state. See RemoteLock.
         p.sequence_number += 1
+        p.state = READY
 
         try:
             idx = 0
@@ -250,7 +248,7 @@ class Alternation:
 
         idx, op = reqs[act]
 
-        # unpickle msg if necessary
+        # decode msg if necessary
         msg = p.result_msg
         if msg == None:
             # Got successful write
@@ -263,7 +261,7 @@ class Alternation:
                 if msg == "":
                     msg = None
                 else:
-                    msg = pickle.loads(msg)[0]
+                    msg = decode_payload(msg, p.result_codec)
 
         return (idx, act, msg, op)
 
@@ -319,7 +317,7 @@ class Alternation:
             # Compiling and executing string
             elif type(action) == types.StringType:
                 # Fetch process frame and namespace
-                processframe= inspect.currentframe()
+                processframe= sys._getframe()
                 steps = self.execute_frame
                 while (steps < 0):
                     processframe = processframe.f_back
@@ -7,14 +7,9 @@ See LICENSE.txt for licensing details (MIT License).
 """
 
 # Imports
-import uuid
-
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 from pycsp.parallel import protocol
+from pycsp.parallel.dispatch import decode_payload
+from pycsp.parallel.codec import get_codec
 from pycsp.parallel.exceptions import *
 from pycsp.parallel.const import *
 
@@ -49,6 +44,26 @@ def retire(*list_of_channelEnds):
         else:
             channelEnd.retire()
 
+def channel_home_addresses(args):
+    """
+    Returns the addresses of the channel homes of the channels and channel ends in args.
+    Lists, tuples and dicts are searched recursively.
+    """
+    addrs = set()
+    for arg in args:
+        if type(arg) == list or type(arg) == tuple:
+            addrs.update(channel_home_addresses(arg))
+        elif type(arg) == dict:
+            addrs.update(channel_home_addresses(arg.keys()))
+            addrs.update(channel_home_addresses(arg.values()))
+        elif isinstance(arg, ChannelEnd):
+            if arg.channel and not arg.channel._channelhomethread:
+                addrs.add(arg.channel.address)
+        elif isinstance(arg, Channel):
+            if not arg._channelhomethread:
+                addrs.add(arg.address)
+    return addrs
+
 def poison(*list_of_channelEnds):
     """ poison(C1, [C2, .. , CN])
 
@@ -79,7 +94,7 @@ def poison(*list_of_channelEnds):
 
 # Classes
 class Channel(object):
-    """ Channel(name=None, buffer=0, connect=None)
+    """ Channel(name=None, buffer=0, connect=None, codec="pickle")
 
     Any-2-any channel for communication between both local and remote processes.
     
@@ -99,7 +114,7 @@ class Channel(object):
     >>> print(A.name)
     A
 
-    Channel(name=None, buffer=0, connect=None):
+    Channel(name=None, buffer=0, connect=None, codec="pickle"):
     name
       is a string used for identifying the Channel and must be unique for every Channel instance.
       The name is limited to maximum 32 characters. If name=None then a unique name is generated.
@@ -110,17 +125,24 @@ class Channel(object):
       If provided with (host, port), the channel will not create a host, but instead try to connect
       to (host, port) and register at the channel here.
       A name must be provided when connect is set.
+    codec
+      Name or object of a registered codec (see pycsp.parallel.codec), used for encoding messages
+      written through this channel reference. The builtin codecs are "pickle", "marshal" and "bytes".
+      Messages are decoded with the codec selected by the writer.
 
     Public variables:
       Channel.address    (host, port) where the channel is hosted
       Channel.name       name to identify the hosted channel
+      Channel.codec      codec used for writing
     """
 
     # Constructor
-    def __init__(self, name=None, buffer=0, connect=None):
+    def __init__(self, name=None, buffer=0, connect=None, codec="pickle"):
 
         self._ispoisoned=False
         self._isretired=False
+
+        self.codec = get_codec(codec)
         
         # Check args
         if name == None and connect != None:
@@ -133,8 +155,8 @@ class Channel(object):
 
         # Set name
         if name == None:
-            # Create 32 byte unique name based on network address, sequence number and time sample.
-            self.name = uuid.uuid1().hex
+            # Create unique name from the interpreter prefix and a counter.
+            self.name = unique_id()
         else:
             if len(name) > 32:
                 raise Exception("Channel names are limited to 32 characters")
@@ -160,15 +182,13 @@ class Channel(object):
                         raise InfoException("Reusing channel name in same process namespace")
 
                 # Get local channel home
-                self._channelhomethread = protocol.ChannelHomeThread(self.name, self.buffer)
+                self._channelhomethread = protocol.create_channel_home(self.name, self.buffer)
                 self._channelhomethread.start()
-                self.address = self._channelhomethread.addr
 
             except SocketBindException as e:
                 raise ChannelBindException("PyCSP (create channel) unable to bind channel (%s) to address (%s)" % (e.addr))
 
-        else:
-            self.address = connect
+        self._address = connect
 
         # Register channel reference at channelhomethread
         self._registered = False            
@@ -188,8 +208,8 @@ class Channel(object):
         # Clear everything
         odict = {}
         
-        # Only save address and name
-        odict['_restore_info'] = (self.address, self.name)
+        # Only save address, name and codec
+        odict['_restore_info'] = (self.address, self.name, self.codec.name)
 
         return odict
 
@@ -201,9 +221,17 @@ class Channel(object):
         self.__dict__.update(dict)
 
         # Reconnect to channel
-        Channel.__init__(self, name=self._restore_info[1], connect=self._restore_info[0])
+        Channel.__init__(self, name=self._restore_info[1], connect=self._restore_info[0], codec=self._restore_info[2])
 
 
+    @property
+    def address(self):
+        # A channel hosted by this interpreter is reachable from other interpreters,
+        # once its address has been given out
+        if self._channelhomethread:
+            return self._channelhomethread.server.dispatch.listen()
+        return self._address
+
     def _register(self):
         # Register this channel reference at the channel home thread
         # and at the current process. The current process will call deregister,
@@ -241,21 +269,22 @@ class Channel(object):
         self._check_registration()
 
         p,_ = getThreadAndName()
-        p.state = READY
+        # The sequence number must change before the state. See RemoteLock.
         p.sequence_number += 1
+        p.state = READY
 
-        self._CM.post_read(self, p)
+        self._CM.post_read(self, p, direct=True)
 
         if p.state == READY:
             p.wait()
 
         if p.state == SUCCESS:
-            # unpickle msg if necessary
+            # decode msg if necessary
             msg = p.result_msg
             if type(msg) == list:
                 return msg[0]
             else:
-                return pickle.loads(msg)[0]
+                return decode_payload(msg, p.result_codec)
 
         elif p.state == POISON:
             self._ispoisoned = True
@@ -273,10 +302,11 @@ class Channel(object):
         self._check_registration()
 
         p,_ = getThreadAndName()
-        p.state = READY
+        # The sequence number must change before the state. See RemoteLock.
         p.sequence_number += 1
+        p.state = READY
 
-        self._CM.post_write(self, p, msg)
+        self._CM.post_write(self, p, msg, direct=True)
 
         if p.state == READY:
             p.wait()
@@ -404,7 +434,7 @@ class ChannelEnd:
 
         odict = self.__dict__
         
-        odict['_restore_info'] = (self.channel.address, self.channel.name)
+        odict['_restore_info'] = (self.channel.address, self.channel.name, self.channel.codec.name)
 
         # Clear channel object
         del odict['channel']
@@ -420,7 +450,7 @@ class ChannelEnd:
 
         # restore Channel immediately, as the receiving end must register a new channel reference, before
         # execution is given back to the calling process
-        self.channel = Channel(name=self._restore_info[1], connect=self._restore_info[0])
+        self.channel = Channel(name=self._restore_info[1], connect=self._restore_info[0], codec=self._restore_info[2])
         
     def _poison(self, *ignore):
         raise ChannelPoisonException()
@@ -501,7 +531,7 @@ class ChannelEnd:
         p,_ = getThreadAndName()
 
         # Initiate clean up and wait for channel to finish outstanding operations.
-        if self.channel in p.activeChanList:
+        if self.channel in p.activeChanSet:
             self.channel._CM.leave(self.channel, p)
             
             # Wait for channel        
@@ -512,7 +542,7 @@ class ChannelEnd:
 
 
             p.closedChanList.remove(self.channel.name)
-            p.activeChanList.remove(self.channel)
+            p.activeChanSet.remove(self.channel)
 
         # Tell channel to disconnect
         self.channel.disconnect()
@@ -0,0 +1,271 @@
+"""
+Codec module
+
+Serializers for messages communicated on channels. A codec is selected per channel
+reference, with Channel(codec=...), and is used by the writing end. The codec id is
+sent along with the message, such that the reading end can decode it.
+
+Codecs must be registered in every interpreter which receives messages encoded with
+them, using the same codec id.
+
+Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
+      Brian Vinter <vinter@nbi.dk>, Rune M. Friborg <rune.m.friborg@gmail.com>.
+See LICENSE.txt for licensing details (MIT License).
+"""
+
+# Imports
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+import sys
+import marshal
+import struct
+
+from pycsp.parallel.exceptions import *
+from pycsp.parallel.const import *
+
+# Ids of the builtin codecs
+CODEC_PICKLE, CODEC_MARSHAL, CODEC_BYTES = range(3)
+
+class Codec(object):
+    """ Codec(name, id)
+
+    Base class for codecs.
+
+    dumps(obj) must return a string or a list of strings and buffers, which are sent in order.
+    loads(data) receives a string or a buffer. A buffer is only valid until loads returns.
+    """
+    def __init__(self, name, id):
+        if not 0 <= id <= 0xFF:
+            raise InfoException("Codec ids are limited to the range 0-255")
+        self.name = name
+        self.id = id
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def loads_buffer(self, payload):
+        """
+        Decodes a payload received into a pooled buffer, which is released afterwards.
+        """
+        try:
+            return self.loads(payload.view())
+        finally:
+            payload.release()
+
+    def __repr__(self):
+        return "<pycsp.codec.Codec %s id:%d>" % (self.name, self.id)
+
+
+class PickleCodec(Codec):
+    """
+    Any picklable object. Uses the highest pickle protocol available.
+
+    Bytearrays and NumPy arrays of at least OOB_BUFFER_SIZE bytes are sent out-of-band.
+    The pickle stream only references them, while their data follows as separate frames
+    sent directly from the memory of the objects.
+
+    Framed payload:
+      FRAMED (1 byte), number of frames (4 bytes), length of every frame (8 bytes each),
+      the pickle stream and the out-of-band frames, each aligned to FRAME_ALIGNMENT.
+    """
+    def dumps(self, obj):
+        buffers = []
+        f = StringIO.StringIO()
+        p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        # cPickle only invokes inst_persistent_id for objects which are not builtin types
+        p.inst_persistent_id = p.persistent_id = lambda o: _oob_id(o, buffers)
+        p.dump(obj)
+        data = f.getvalue()
+
+        if not buffers:
+            return data
+
+        frames = [data] + buffers
+        parts = [_frame_count.pack(FRAMED, len(frames))]
+        parts.extend([_frame_len.pack(len(frame)) for frame in frames])
+        offset = _frame_count.size + _frame_len.size * len(frames)
+        for frame in frames:
+            pad = -offset % FRAME_ALIGNMENT
+            if pad:
+                parts.append("\0" * pad)
+            parts.append(frame)
+            offset += pad + len(frame)
+        return parts
+
+    def loads(self, data):
+        if data[0] == FRAMED:
+            return self._loads_framed(data, None)
+        if type(data) == str:
+            return pickle.loads(data)
+        # Read directly from the buffer
+        return pickle.load(StringIO.StringIO(data))
+
+    def loads_buffer(self, payload):
+        view = payload.view()
+        if view[0] == FRAMED:
+            # The out-of-band objects are created on top of the buffer, thus it is
+            # not returned to the pool
+            return self._loads_framed(view, payload.detach())
+        return Codec.loads_buffer(self, payload)
+
+    def _loads_framed(self, data, buf):
+        """
+        If buf is provided, it is the writable buffer containing data, which is
+        shared with the NumPy arrays created.
+        """
+        _, count = _frame_count.unpack_from(data, 0)
+        offset = _frame_count.size + _frame_len.size * count
+        frames = []
+        for i in xrange(count):
+            length, = _frame_len.unpack_from(data, _frame_count.size + _frame_len.size * i)
+            offset += -offset % FRAME_ALIGNMENT
+            frames.append((offset, length))
+            offset += length
+
+        def persistent_load(pid):
+            offset, length = frames[pid[1] + 1]
+            if pid[0] == OOB_BYTEARRAY:
+                return bytearray(data[offset:offset+length])
+
+            dtype, shape = pid[2:]
+            if buf is None:
+                source, offset = bytearray(data[offset:offset+length]), 0
+            else:
+                source = buf
+            numpy = __import__("numpy")
+            return numpy.frombuffer(source, dtype, length // dtype.itemsize, offset).reshape(shape)
+
+        offset, length = frames[0]
+        u = pickle.Unpickler(StringIO.StringIO(data[offset:offset+length]))
+        u.persistent_load = persistent_load
+        return u.load()
+
+
+# Out-of-band framing
+FRAMED = "F"
+FRAME_ALIGNMENT = 16
+OOB_BYTEARRAY, OOB_NDARRAY = range(2)
+_frame_count = struct.Struct("!cI")
+_frame_len = struct.Struct("!Q")
+
+def _oob_id(obj, buffers):
+    """
+    Returns a persistent id for objects sent out-of-band, after adding their data to buffers.
+    """
+    t = type(obj)
+    if t is bytearray:
+        if len(obj) >= OOB_BUFFER_SIZE:
+            buffers.append(memoryview(obj))
+            return (OOB_BYTEARRAY, len(buffers) - 1)
+    else:
+        # NumPy is not imported here. If it has not been imported, no arrays can be sent.
+        numpy = sys.modules.get("numpy")
+        if numpy is not None and t is numpy.ndarray and not obj.dtype.hasobject and obj.nbytes >= OOB_BUFFER_SIZE:
+            obj = numpy.ascontiguousarray(obj)
+            buffers.append(memoryview(obj.reshape(-1).view(numpy.uint8)))
+            return (OOB_NDARRAY, len(buffers) - 1, obj.dtype, obj.shape)
+    return None
+
+
+class MarshalCodec(Codec):
+    """
+    Faster than pickle, but limited to builtin types (numbers, strings, tuples, lists, dicts, ..)
+    """
+    def dumps(self, obj):
+        return marshal.dumps(obj)
+
+    def loads(self, data):
+        if type(data) == str:
+            return marshal.loads(data)
+        return marshal.loads(data.tobytes())
+
+
+class BytesCodec(Codec):
+    """
+    Passes strings through unchanged.
+    """
+    def dumps(self, obj):
+        if not isinstance(obj, str):
+            raise InfoException("The bytes codec can only communicate strings, got %s" % type(obj))
+        return obj
+
+    def loads(self, data):
+        if type(data) == str:
+            return data
+        return data.tobytes()
+
+
+class StructCodec(Codec):
+    """ StructCodec(name, id, format)
+
+    Messages with a fixed layout, which are communicated as tuples.
+
+    Usage:
+      >>> register_codec(StructCodec("point", 64, "!dd"))
+      >>> C = Channel(codec="point")
+      >>> cout = C.writer()
+      >>> cout((1.0, 2.0))
+    """
+    def __init__(self, name, id, format):
+        Codec.__init__(self, name, id)
+        self.struct = struct.Struct(format)
+
+    def dumps(self, obj):
+        return self.struct.pack(*obj)
+
+    def loads(self, data):
+        return self.struct.unpack_from(data)
+
+
+# Registry
+_codecs_by_id = {}
+_codecs_by_name = {}
+
+def register_codec(codec):
+    """ register_codec(codec)
+
+    Registers a codec, which can then be selected with Channel(codec=codec.name).
+
+    A codec replaces a registered codec with the same name and id. Registering a codec
+    with an id or name already used by another codec raises an InfoException.
+    """
+    for other in (_codecs_by_id.get(codec.id), _codecs_by_name.get(codec.name)):
+        if other is not None and (other.id, other.name) != (codec.id, codec.name):
+            raise InfoException("Codec %s conflicts with the registered codec %s" % (repr(codec), repr(other)))
+
+    _codecs_by_id[codec.id] = codec
+    _codecs_by_name[codec.name] = codec
+
+def get_codec(codec):
+    """
+    Returns the registered codec for a codec object, name or id
+    """
+    if isinstance(codec, Codec):
+        if _codecs_by_id.get(codec.id) is not codec:
+            raise InfoException("Codec %s is not registered" % repr(codec))
+        return codec
+
+    if type(codec) == int:
+        table = _codecs_by_id
+    else:
+        table = _codecs_by_name
+
+    try:
+        return table[codec]
+    except KeyError:
+        raise InfoException("Unknown codec %s" % repr(codec))
+
+register_codec(PickleCodec("pickle", CODEC_PICKLE))
+register_codec(MarshalCodec("marshal", CODEC_MARSHAL))
+register_codec(BytesCodec("bytes", CODEC_BYTES))
@@ -15,6 +15,17 @@ PYCSP_PORT = 5
 PYCSP_HOST = 6
 
 SOCKETS_STRICT_MODE = 4
+SOCKETS_SHM_TRANSPORT = 7
+SOCKETS_HEARTBEAT_TIMEOUT = 8
+SOCKETS_POOL_SIZE = 9
+SOCKETS_POOL_IDLE_TIMEOUT = 10
+PYCSP_ENGINE = 11
+PYCSP_ENGINE_WORKERS = 12
+
+# Values of PYCSP_ENGINE. See help(pycsp.parallel.engine)
+ENGINE_THREADS = "threads"
+ENGINE_EVENTS = "events"
+ENGINE_POOL = "pool"
 
 # Classes
 class Configuration(object):
@@ -58,7 +69,13 @@ class Configuration(object):
                 SOCKETS_BIND_RETRY_DELAY:0.2,
                 PYCSP_PORT:0,
                 PYCSP_HOST:'',
-                SOCKETS_STRICT_MODE:False
+                SOCKETS_STRICT_MODE:False,
+                SOCKETS_SHM_TRANSPORT:False,
+                SOCKETS_HEARTBEAT_TIMEOUT:0,
+                SOCKETS_POOL_SIZE:512,
+                SOCKETS_POOL_IDLE_TIMEOUT:600,
+                PYCSP_ENGINE:ENGINE_POOL,
+                PYCSP_ENGINE_WORKERS:4
                 }
             
         return cls.__instance
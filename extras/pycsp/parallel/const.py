@@ -6,19 +6,64 @@ Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
 See LICENSE.txt for licensing details (MIT License). 
 """
 
+import os
+import binascii
+import itertools
 import threading
 try:
     import multiprocessing
+    import multiprocessing.util
 except:
     pass
 
 ENVVAL_PORT = 'PYCSP_PORT'
 ENVVAL_HOST = 'PYCSP_HOST'
 
+# Address of this interpreter, until the server sockets are bound
+LOCAL_ADDR = ('', 0)
+
 # Setup (consider moving to configuration.py)
-PICKLE_PROTOCOL= 2
 ENABLE_CACHE = 1
 
+# Connect to processes on the same host through unix domain sockets
+ENABLE_UNIX_SOCKETS = 1
+
+# Bytes in every direction of a shared memory connection (SOCKETS_SHM_TRANSPORT)
+SHM_RING_SIZE = 4*1024*1024
+
+# Buffers up to this size are coalesced with neighbouring buffers into one send
+INLINE_PAYLOAD_SIZE = 1024
+
+# Max. number of bytes received from a connection in one read by the SocketThread
+RECV_BUFFER_SIZE = 65536
+
+# Max. number of bytes kept for reuse in pooled payload buffers
+PAYLOAD_POOL_SIZE = 128*1024*1024
+
+# Bytearrays and NumPy arrays of at least this size are sent out-of-band by the pickle codec
+OOB_BUFFER_SIZE = 65536
+
+# Max. number of bytes kept for messages to a channel or process, which has not been registered
+UNKNOWN_MAX_BYTES_PER_ID = 1024*1024
+
+# Max. number of bytes kept for messages to unregistered channels and processes in total
+UNKNOWN_MAX_BYTES = 32*1024*1024
+
+# Seconds before messages to a channel or process, which has not been registered, are discarded
+UNKNOWN_TTL = 60.0
+
+# Number of heartbeats sent to every peer within SOCKETS_HEARTBEAT_TIMEOUT
+HEARTBEATS_PER_TIMEOUT = 4
+
+# Seconds between timeout ticks, when the SocketThread is idle
+SOCKETTHREAD_TIMEOUT = 10.0
+
+# Max. number of messages handled by a task, before the event loop handles other tasks
+TASK_STEPS = 64
+
+# Max. number of offers a channel home waits for concurrently (events and pool engines)
+OFFERS_IN_FLIGHT = 16
+
 # Operation type
 READ, WRITE = range(2)
 
@@ -26,7 +71,77 @@ READ, WRITE = range(2)
 READY, FAIL, SUCCESS, POISON, RETIRE = range(5)
 
 
+# Prefix and counter used for creating unique ids. Recreated when the OS process changes.
+_id_pid = None
+_id_prefix = None
+_id_counter = None
+
+def unique_id():
+    """
+    Returns a string, which is unique across all PyCSP interpreters.
+
+    The string is a random prefix, created once for every OS process, followed by a counter.
+    """
+    global _id_pid, _id_prefix, _id_counter
+    pid = os.getpid()
+    if pid != _id_pid:
+        _id_prefix = binascii.hexlify(os.urandom(8))
+        _id_counter = itertools.count(1)
+        _id_pid = pid
+    return "%s.%x" % (_id_prefix, _id_counter.next())
+
+
+class ProcessContext(object):
+    """
+    The process executed by a thread and the socket dispatcher of this interpreter.
+
+    It is cached for every thread by getThreadAndName, once the process has been
+    initialised, to avoid looking up the threading and multiprocessing modules in
+    every channel operation.
+    """
+    __slots__ = ('process', 'name', 'dispatch')
+
+    def __init__(self, process, name):
+        from pycsp.parallel.dispatch import SocketDispatcher
+        self.process = process
+        self.name = name
+        self.dispatch = SocketDispatcher().getThread()
+
+_context = threading.local()
+
+def _reset_context(context):
+    context.__dict__.clear()
+
+try:
+    # The thread starting a multiprocessing process continues as the main thread of
+    # the new interpreter, where its cached context is stale
+    multiprocessing.util.register_after_fork(_context, _reset_context)
+except:
+    pass
+
+def resetProcessContext():
+    """
+    Forgets the cached process of the current thread, which must be looked up again.
+    """
+    _reset_context(_context)
+
+def getDispatch():
+    """
+    Returns the socket dispatcher of this interpreter.
+    """
+    try:
+        return _context.current.dispatch
+    except AttributeError:
+        from pycsp.parallel.dispatch import SocketDispatcher
+        return SocketDispatcher().getThread()
+
 def getThreadAndName(init=True):
+    try:
+        context = _context.current
+        return (context.process, context.name)
+    except AttributeError:
+        pass
+
     thread = None
     name = None
 
@@ -66,7 +181,7 @@ def getThreadAndName(init=True):
 
     try:
         if thread.id:
-            pass
+            _context.current = ProcessContext(thread, name)
     except AttributeError:
         if init:
             # Engaging auto init
@@ -206,3 +206,9 @@ class SocketBindException(SocketException):
 class SocketSendException(SocketException):
     def __init__(self):
         pass
+
+class SocketProtocolException(SocketException):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
@@ -6,10 +6,12 @@ Copyright (c) 2009 John Markus Bjoerndalen <jmb@cs.uit.no>,
 See LICENSE.txt for licensing details (MIT License). 
 """
 
-import ctypes
+import struct
 from pycsp.parallel.const import *
+from pycsp.parallel.exceptions import SocketProtocolException
 
 # Bit patters for selecting types
+SOCKETTHREAD_CMD = 1<<14
 GUARD_CMD   = 1<<13
 PROCESS_CMD = 1<<12
 CHANNEL_CMD = 1<<11
@@ -22,11 +24,11 @@ IGN_UNKNOWN = 1<<6
 ERROR_CMD = 0
 
 """
-GUARD_CMD, PROCESS_CMD and CHANNEL_CMD encodes the destination.
+GUARD_CMD, PROCESS_CMD, CHANNEL_CMD and SOCKETTHREAD_CMD encodes the destination.
 HAS_PAYLOAD tells the receiver, that it must read N bytes containing a payload message
 REQ_REPLY informs that if the destination is not available, an error must be returned, such that the sender does not deadlock by waiting eternally for a reply
 IS_REPLY informs which queue to post the incoming message to.
-NATFIX informs that the receiving socket should also be used as a sending socket  
+NATFIX is kept for compatibility. Every receiving socket is also used as a sending socket
 IGN_UNKNOWN informs that it is ok to drop this message, if the destination is not found
 """
 
@@ -39,10 +41,17 @@ LOCKTHREAD_NOTIFY_SUCCESS = PROCESS_CMD | 3 | IS_REPLY | HAS_PAYLOAD
 LOCKTHREAD_POISON         = PROCESS_CMD | 4 | IS_REPLY
 LOCKTHREAD_RETIRE         = PROCESS_CMD | 5 | IS_REPLY
 LOCKTHREAD_RELEASE_LOCK   = PROCESS_CMD | 6 | IS_REPLY | IGN_UNKNOWN
+
+# Sent without acquiring the lock, for requests posted outside an Alternation
+LOCKTHREAD_DIRECT_NOTIFY  = PROCESS_CMD | 7 | HAS_PAYLOAD
+LOCKTHREAD_DIRECT_POISON  = PROCESS_CMD | 8
+LOCKTHREAD_DIRECT_RETIRE  = PROCESS_CMD | 9
 LOCKTHREAD_QUIT           = PROCESS_CMD | 30
 LOCKTHREAD_ACK            = PROCESS_CMD | 42
-SOCKETTHREAD_SHUTDOWN     = PROCESS_CMD | CHANNEL_CMD | 7
-SOCKETTHREAD_PING         = PROCESS_CMD | CHANNEL_CMD | 20
+
+# CMDs for the SocketThread of an interpreter
+SOCKETTHREAD_PING         = SOCKETTHREAD_CMD | 1
+SOCKETTHREAD_PONG         = SOCKETTHREAD_CMD | 2 | IS_REPLY
 
 # CMDs for channels
 CHANTHREAD_JOIN_READER    = CHANNEL_CMD | 8
@@ -57,9 +66,15 @@ CHANTHREAD_POST_READ      = CHANNEL_CMD | 18
 CHANTHREAD_POST_WRITE     = CHANNEL_CMD | 19 | HAS_PAYLOAD
 CHANTHREAD_POST_ACK_READ      = CHANNEL_CMD | 40
 CHANTHREAD_POST_ACK_WRITE     = CHANNEL_CMD | 41 | HAS_PAYLOAD
+CHANTHREAD_POST_DIRECT_READ   = CHANNEL_CMD | 20
+CHANTHREAD_POST_DIRECT_WRITE  = CHANNEL_CMD | 21 | HAS_PAYLOAD
 CHANTHREAD_ENTER          = CHANNEL_CMD | 24 | NATFIX
 CHANTHREAD_LEAVE          = CHANNEL_CMD | 26
 
+# Posted by a channel home to itself, when an offer run by a separate task has completed.
+# Never sent to other interpreters.
+CHANTHREAD_OFFER_DONE     = CHANNEL_CMD | 27
+
 def cmd2str(cmd):
     """
     Translate command IDs to their string representation
@@ -75,8 +90,10 @@ def cmd2str(cmd):
         LOCKTHREAD_POISON        :"LOCKTHREAD_POISON",
         LOCKTHREAD_RETIRE        :"LOCKTHREAD_RETIRE",
         LOCKTHREAD_RELEASE_LOCK  :"LOCKTHREAD_RELEASE_LOCK",
+        LOCKTHREAD_DIRECT_NOTIFY :"LOCKTHREAD_DIRECT_NOTIFY",
+        LOCKTHREAD_DIRECT_POISON :"LOCKTHREAD_DIRECT_POISON",
+        LOCKTHREAD_DIRECT_RETIRE :"LOCKTHREAD_DIRECT_RETIRE",
         LOCKTHREAD_QUIT          :"LOCKTHREAD_QUIT ",
-        SOCKETTHREAD_SHUTDOWN    :"SOCKETTHREAD_SHUTDOWN",
         CHANTHREAD_JOIN_READER   :"CHANTHREAD_JOIN_READER",
         CHANTHREAD_JOIN_WRITER   :"CHANTHREAD_JOIN_WRITER",
         CHANTHREAD_RETIRE_READER :"CHANTHREAD_RETIRE_READER",
@@ -87,30 +104,252 @@ def cmd2str(cmd):
         CHANTHREAD_DEREGISTER    :"CHANTHREAD_DEREGISTER",
         CHANTHREAD_POST_READ     :"CHANTHREAD_POST_READ",
         CHANTHREAD_POST_WRITE    :"CHANTHREAD_POST_WRITE",
+        CHANTHREAD_POST_DIRECT_READ :"CHANTHREAD_POST_DIRECT_READ",
+        CHANTHREAD_POST_DIRECT_WRITE:"CHANTHREAD_POST_DIRECT_WRITE",
         CHANTHREAD_ENTER         :"CHANTHREAD_ENTER",
-        CHANTHREAD_LEAVE         :"CHANTHREAD_LEAVE"
+        CHANTHREAD_LEAVE         :"CHANTHREAD_LEAVE",
+        CHANTHREAD_OFFER_DONE    :"CHANTHREAD_OFFER_DONE",
+        SOCKETTHREAD_PING        :"SOCKETTHREAD_PING",
+        SOCKETTHREAD_PONG        :"SOCKETTHREAD_PONG"
         }
 
     return D[cmd]
 
 
-class Header(ctypes.Structure):
+class Header(object):
     """
     cmd          : type of package
-    id           : string, uuid1 in bytes format
+    id           : string, unique id of the destination
     seq_number   : sequence number used for ignoring channel requests, that was left behind.
     arg          : contains the payload size following this header
     _source_host,_source_port,_source_id enables the receiver to reply to a message
     _result_id   : updated with the chosen channel in an offer and match
+    codec        : id of the codec used to encode the payload
+    """
+    __slots__ = ['cmd', 'id', 'seq_number', 'arg', '_source_host', '_source_port', '_source_id', '_result_id', 'codec']
+
+    def __init__(self, cmd=ERROR_CMD, id="", seq_number=0, arg=0, _source_host="", _source_port=0, _source_id="", _result_id="", codec=0):
+        self.cmd = cmd
+        self.id = id
+        self.seq_number = seq_number
+        self.arg = arg
+        self._source_host = _source_host
+        self._source_port = _source_port
+        self._source_id = _source_id
+        self._result_id = _result_id
+        self.codec = codec
+
+    def __repr__(self):
+        return "<pycsp.header.Header cmd:%d id:%s seq:%d arg:%d>" % (self.cmd, self.id, self.seq_number, self.arg)
+
+
+"""
+Wire format
+
+Every connection starts with WIRE_HELLO announcing the format used by the sender in
+this direction. It is followed by compact headers, each encoded as:
+
+  flags (2 bytes), cmd (2 bytes) and the fields enabled in flags, in the order of the F_ bits below.
+
+Fields set to their default value (0 or "") are not sent. Strings (ids and hosts) are
+interned per connection. A string is sent once along with its new index, and later as
+the 2 byte index only. A payload follows the header, with its length stored in arg.
+"""
+WIRE_MAGIC = "PCSP"
+WIRE_VERSION = 3
+WIRE_HELLO = struct.pack("!4sB", WIRE_MAGIC, WIRE_VERSION)
+WIRE_HELLO_SIZE = len(WIRE_HELLO)
+
+F_ID        = 1<<0
+F_SEQ       = 1<<1
+F_SEQ_WIDE  = 1<<2
+F_ARG_SHORT = 1<<3
+F_ARG       = 1<<4
+F_SOURCE    = 1<<5
+F_SOURCE_ID = 1<<6
+F_RESULT_ID = 1<<7
+F_CODEC     = 1<<8
+
+# String references. Below STR_DEFINE is an index to an interned string.
+STR_DEFINE  = 0x8000
+STR_LITERAL = 0xFFFF
+MAX_INTERNED = STR_DEFINE - 1
+
+_flags_cmd = struct.Struct("!HH")
+_u8 = struct.Struct("!B")
+_u16 = struct.Struct("!H")
+_u32 = struct.Struct("!I")
+_s64 = struct.Struct("!q")
+_ref_def = struct.Struct("!HH")
+
+class HeaderEncoder(object):
+    """
+    Encodes headers sent on one connection.
+
+    Must only be used by one thread at a time and only for one connection, as
+    the interned strings are shared with the HeaderDecoder at the receiver.
+    """
+    def __init__(self):
+        self.interned = {}
+        self.hello = WIRE_HELLO
+
+    def _str(self, s, parts):
+        idx = self.interned.get(s)
+        if idx is not None:
+            parts.append(_u16.pack(idx))
+        elif len(self.interned) < MAX_INTERNED:
+            idx = len(self.interned)
+            self.interned[s] = idx
+            parts.append(_ref_def.pack(STR_DEFINE | idx, len(s)))
+            parts.append(s)
+        else:
+            parts.append(_ref_def.pack(STR_LITERAL, len(s)))
+            parts.append(s)
+
+    def encode(self, header):
+        """
+        Returns the header encoded as a string. The first header includes the hello.
+        """
+        flags = 0
+        parts = []
+
+        if header.id:
+            flags |= F_ID
+            self._str(header.id, parts)
+
+        seq = header.seq_number
+        if seq:
+            if 0 < seq <= 0xFFFFFFFF:
+                flags |= F_SEQ
+                parts.append(_u32.pack(seq))
+            else:
+                flags |= F_SEQ_WIDE
+                parts.append(_s64.pack(seq))
+
+        arg = header.arg
+        if arg:
+            if 0 < arg <= 0xFF:
+                flags |= F_ARG_SHORT
+                parts.append(_u8.pack(arg))
+            else:
+                flags |= F_ARG
+                parts.append(_s64.pack(arg))
+
+        if header._source_host:
+            flags |= F_SOURCE
+            self._str(header._source_host, parts)
+            parts.append(_u16.pack(header._source_port))
+
+        if header._source_id:
+            flags |= F_SOURCE_ID
+            self._str(header._source_id, parts)
+
+        if header._result_id:
+            flags |= F_RESULT_ID
+            self._str(header._result_id, parts)
+
+        if header.codec:
+            flags |= F_CODEC
+            parts.append(_u8.pack(header.codec))
+
+        data = _flags_cmd.pack(flags, header.cmd) + "".join(parts)
+        if self.hello:
+            data = self.hello + data
+            self.hello = None
+        return data
+
+
+class HeaderDecoder(object):
     """
-    _fields_ = [
-        ("cmd", ctypes.c_short),
-        ("id", ctypes.c_char * 64),
-        ("seq_number", ctypes.c_long),
-        ("arg", ctypes.c_long),
-        ("_source_host", ctypes.c_char * 16),
-        ("_source_port", ctypes.c_int),
-        ("_source_id", ctypes.c_char * 64),
-        ("_result_id", ctypes.c_char * 64)
-        ]
+    Decodes headers received on one connection.
+    """
+    def __init__(self):
+        self.interned = []
+        self.version = None
+
+    def _str(self, data, offset, defined):
+        if len(data) - offset < 2:
+            raise IndexError
+        ref, = _u16.unpack_from(data, offset)
+        offset += 2
+        if ref < STR_DEFINE:
+            if ref < len(self.interned):
+                return self.interned[ref], offset
+            # May be defined earlier in the same header
+            for idx, s in defined:
+                if idx == ref:
+                    return s, offset
+            raise SocketProtocolException("Unknown interned string %d" % ref)
+
+        if len(data) - offset < 2:
+            raise IndexError
+        length, = _u16.unpack_from(data, offset)
+        offset += 2
+        if len(data) - offset < length:
+            raise IndexError
+        s = data[offset:offset+length]
+        offset += length
+        if ref != STR_LITERAL:
+            defined.append((ref & ~STR_DEFINE, s))
+        return s, offset
+
+    def decode(self, data, offset):
+        """
+        Decodes the header at offset in data.
+
+        Returns (header, new offset). header is None, if data does not contain the entire header.
+        """
+        if self.version is None:
+            if len(data) - offset < WIRE_HELLO_SIZE:
+                return None, offset
+            magic, version = struct.unpack_from("!4sB", data, offset)
+            if magic != WIRE_MAGIC or version != WIRE_VERSION:
+                raise SocketProtocolException("Unsupported wire format (%s, %d)" % (repr(magic), version))
+            self.version = version
+            offset += WIRE_HELLO_SIZE
+
+        start = offset
+        try:
+            flags, cmd = _flags_cmd.unpack_from(data, offset)
+            offset += 4
+
+            # Strings defined in this header are only interned, if the entire header has been received
+            defined = []
+            header = Header(cmd)
+
+            if flags & F_ID:
+                header.id, offset = self._str(data, offset, defined)
+            if flags & F_SEQ:
+                header.seq_number, = _u32.unpack_from(data, offset)
+                offset += 4
+            elif flags & F_SEQ_WIDE:
+                header.seq_number, = _s64.unpack_from(data, offset)
+                offset += 8
+            if flags & F_ARG_SHORT:
+                header.arg, = _u8.unpack_from(data, offset)
+                offset += 1
+            elif flags & F_ARG:
+                header.arg, = _s64.unpack_from(data, offset)
+                offset += 8
+            if flags & F_SOURCE:
+                header._source_host, offset = self._str(data, offset, defined)
+                header._source_port, = _u16.unpack_from(data, offset)
+                offset += 2
+            if flags & F_SOURCE_ID:
+                header._source_id, offset = self._str(data, offset, defined)
+            if flags & F_RESULT_ID:
+                header._result_id, offset = self._str(data, offset, defined)
+            if flags & F_CODEC:
+                header.codec, = _u8.unpack_from(data, offset)
+                offset += 1
+
+        except (IndexError, struct.error):
+            # Incomplete header
+            return None, start
+
+        for idx, s in defined:
+            if idx != len(self.interned):
+                raise SocketProtocolException("Interned string %d defined out of order" % idx)
+            self.interned.append(s)
 
+        return header, offset
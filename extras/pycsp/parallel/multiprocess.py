@@ -8,13 +8,13 @@ See LICENSE.txt for licensing details (MIT License).
 
 # Imports
 import types
-import uuid
 import threading
 
 import multiprocessing
 
 from pycsp.parallel.dispatch import SocketDispatcher
 from pycsp.parallel.protocol import RemoteLock
+from pycsp.parallel.channel import channel_home_addresses
 from pycsp.parallel.const import *
 from pycsp.parallel.configuration import *
 from pycsp.parallel.exceptions import *
@@ -99,14 +99,15 @@ class MultiProcess(multiprocessing.Process):
         # Create return pipe for return value
         self.return_pipe = multiprocessing.Pipe()
 
-        # Create 64 byte unique id based on network address, sequence number and time sample.
-        self.id = uuid.uuid1().hex + "." + fn.func_name[:31]
+        # Create unique id from the interpreter prefix, a counter and the function name.
+        self.id = unique_id() + "." + fn.func_name[:31]
 
         # Channel request state
         self.cond = None
         self.state = FAIL
         self.result_ch_idx = None
         self.result_msg = None
+        self.result_codec = 0
         
         # Used to wait for acknowledgements from the RemoteLock
         self.ack = False
@@ -122,7 +123,7 @@ class MultiProcess(multiprocessing.Process):
         self.registeredChanConnectList = []
 
         # Protect against early termination of processes leaving channelhomes in an invalid state
-        self.activeChanList = []
+        self.activeChanSet = set()
         self.closedChanList = []
 
         # Identify this as a wrapped pycsp process, which must not be terminated by shutdown
@@ -131,6 +132,9 @@ class MultiProcess(multiprocessing.Process):
         # report execution error
         self._error = multiprocessing.RawValue('i', 0)
 
+        # Set by the new interpreter, when a configured port has been bound
+        self._bound = None
+
     def update(self, **kwargs):
         if self.cond:
             raise FatalException("Can not update process settings after it has been started")
@@ -145,6 +149,20 @@ class MultiProcess(multiprocessing.Process):
         # Return updated process
         return self
 
+    def start(self):
+        # The new interpreter connects to the channels hosted by this interpreter
+        SocketDispatcher().getThread().listen()
+
+        if self.kwargs.get("pycsp_port"):
+            # Return, when the port is in use, such that processes started later
+            # can not take it
+            self._bound = multiprocessing.Event()
+            multiprocessing.Process.start(self)
+            while not self._bound.wait(0.1) and self.is_alive():
+                pass
+        else:
+            multiprocessing.Process.start(self)
+
     def wait_ack(self):
         self.cond.acquire()
         while not self.ack:
@@ -205,6 +223,9 @@ class MultiProcess(multiprocessing.Process):
             self._error.value = 1001
             self.return_pipe[1].send(None)
             return
+        finally:
+            if self._bound:
+                self._bound.set()
 
         # Create remote lock
         self.cond = threading.Condition()        
@@ -212,6 +233,9 @@ class MultiProcess(multiprocessing.Process):
         self.addr = dispatch.server_addr
         dispatch.registerProcess(self.id, RemoteLock(self))
 
+        # Hide the connect latency from the first communication on every channel
+        dispatch.preconnect(channel_home_addresses([self.args, self.kwargs]))
+
         return_value = None
         try:
             return_value = self.fn(*self.args, **self.kwargs)
@@ -231,12 +255,12 @@ class MultiProcess(multiprocessing.Process):
             p.join_report()
 
         # Initiate clean up and waiting for channels to finish outstanding operations.
-        for channel in self.activeChanList:
+        for channel in self.activeChanSet:
             channel._CM.leave(channel, self)
 
         # Wait for channels        
         self.cond.acquire()
-        X = len(self.activeChanList)
+        X = len(self.activeChanSet)
         while len(self.closedChanList) < X:
             self.cond.wait()
         self.cond.release()
@@ -10,14 +10,24 @@ See LICENSE.txt for licensing details (MIT License).
 
 import time
 import errno
-import os, platform
+import heapq
+import random
+import os
 import socket
+import select
 import sys
+import threading
 from pycsp.parallel.exceptions import *
 from pycsp.parallel.configuration import *
 from pycsp.parallel.const import *
-
-PLATFORM_SYSTEM = platform.system()
+from pycsp.parallel import shm
+
+# platform.system() without importing platform, which is slow to import
+if hasattr(os, 'uname'):
+    PLATFORM_SYSTEM = os.uname()[0]
+else:
+    import platform
+    PLATFORM_SYSTEM = platform.system()
 STDERR_OUTPUT = False
 
 conf = Configuration()    
@@ -50,49 +60,171 @@ def _get_ip():
     return ip
     
 
+# Unix domain sockets in the abstract namespace are only available on Linux
+UNIX_SOCKETS = ENABLE_UNIX_SOCKETS and PLATFORM_SYSTEM == 'Linux' and hasattr(socket, 'AF_UNIX')
+
+def _unix_path(addr):
+    """
+    Returns the unix domain socket path for the server listening on the TCP address addr.
+
+    The path is in the abstract namespace, thus no file is created and the path
+    is released when the server socket is closed.
+    """
+    return "\0pycsp.%s.%d" % (addr[0], addr[1])
+
+def _connect_unix(addr):
+    """
+    Connect to the unix domain socket of a server on this host.
+
+    Returns None, if no server on this host listens for addr.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(_unix_path(addr))
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def _connect_local(addr):
+    """
+    Connect through the unix domain socket of a server on this host.
+    If SOCKETS_SHM_TRANSPORT is enabled, the connection is upgraded to shared memory.
+
+    Returns None, if no server on this host listens for addr.
+    """
+    sock = _connect_unix(addr)
+    if sock and conf.get(SOCKETS_SHM_TRANSPORT):
+        conn = shm.connect(sock, conf.get(SOCKETS_CONNECT_TIMEOUT))
+        if conn is None:
+            # No answer to the handshake. Use a new plain connection.
+            sock.close()
+            sock = _connect_unix(addr)
+        else:
+            sock = conn
+    return sock
+
+def _connect_tcp(addrs, timeout, reconnect=True):
+    """
+    Connect to addrs concurrently with non-blocking connects.
+
+    A refused connection is retried after a delay, which starts at a sixteenth of
+    SOCKETS_CONNECT_RETRY_DELAY and is doubled for every retry up to
+    SOCKETS_CONNECT_RETRY_DELAY. The delays are randomized, such that many processes
+    connecting at the same time do not retry in lockstep.
+
+    Returns (connected, failed), where connected maps addresses to connected sockets
+    and failed maps addresses to the errno of a failure, which is not retried.
+    Addresses which could not be connected within timeout seconds are in neither.
+    """
+    max_delay = conf.get(SOCKETS_CONNECT_RETRY_DELAY)
+    deadline = time.time() + timeout
+
+    connected = {}
+    failed = {}
+    connecting = {}
+    delays = {}
+    retries = [(0, addr) for addr in addrs]
+    poller = Poller(writable=True)
+
+    def done(sock, addr, err):
+        if err == 0:
+            sock.setblocking(1)
+            connected[addr] = sock
+            return
+
+        sock.close()
+        if STDERR_OUTPUT:
+            sys.stderr.write("PyCSP socket issue (%d): %s\n" % (err, os.strerror(err)))
+        if err != errno.ECONNREFUSED or not reconnect:
+            failed[addr] = err
+        else:
+            delay = delays.get(addr, max_delay / 16.0)
+            delays[addr] = min(delay * 2, max_delay)
+            heapq.heappush(retries, (time.time() + delay * random.uniform(0.5, 1.0), addr))
+
+    try:
+        while retries or connecting:
+            now = time.time()
+            while retries and retries[0][0] <= now:
+                _, addr = heapq.heappop(retries)
+
+                # Create IPv4 TCP socket (TODO: add support for IPv6)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+                # Disable Nagle's algorithem, to enable faster send
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                sock.setblocking(0)
+                err = sock.connect_ex(addr)
+                if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EINTR):
+                    connecting[sock] = addr
+                    poller.register(sock)
+                else:
+                    done(sock, addr, err)
+
+            wait = deadline - now
+            if wait <= 0:
+                break
+            if retries:
+                wait = max(0, min(wait, retries[0][0] - now))
+
+            if not connecting:
+                time.sleep(wait)
+                continue
+
+            for sock in poller.poll(wait):
+                poller.unregister(sock)
+                addr = connecting.pop(sock)
+                done(sock, addr, sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))
+    finally:
+        poller.close()
+        for sock in connecting:
+            sock.close()
+
+    return connected, failed
 
 def _connect(addr, reconnect=True):
     """
     Make a connection with the Nagle algorithm disabled.
 
+    A server on the same host is connected through its unix domain socket, if available.
+    If SOCKETS_SHM_TRANSPORT is enabled, the connection is upgraded to shared memory.
+
     Retries connecting, if the connection is refused. Aborts after a specified time.
     """
-    connected = False
-    t1 = None
-    sock = None
-
-    while (not connected):
-        try:
-            
-
-            # Create IPv4 TCP socket (TODO: add support for IPv6)
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if UNIX_SOCKETS:
+        sock = _connect_local(addr)
+        if sock:
+            return sock
 
-            # Disable Nagle's algorithem, to enable faster send
-            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connected, failed = _connect_tcp([addr], conf.get(SOCKETS_CONNECT_TIMEOUT), reconnect)
+    if addr in connected:
+        return connected[addr]
+    if not reconnect:
+        return False
+    if addr in failed:
+        raise Exception("Fatal error: Could not open socket: " + os.strerror(failed[addr]))
+    raise SocketConnectException()
 
-            # Connect to addr
-            sock.connect(addr)
+def _connect_many(addrs, reconnect=True):
+    """
+    Connect to addrs concurrently. Returns a dict of the connected sockets.
+    """
+    connected = {}
+    remote = []
+    for addr in addrs:
+        sock = None
+        if UNIX_SOCKETS:
+            sock = _connect_local(addr)
+        if sock:
+            connected[addr] = sock
+        else:
+            remote.append(addr)
 
-            connected = True
-        except socket.error as e:
-            if not reconnect:
-                return False
-            
-            if STDERR_OUTPUT:
-                sys.stderr.write("PyCSP socket issue (%d): %s\n" % (e.errno, e.message))
-            if sock:
-                sock.close()
-            if e.errno != errno.ECONNREFUSED:            
-                raise Exception("Fatal error: Could not open socket: " + e.message)
-        if not connected:
-            if t1 == None:
-                t1 = time.time()
-            else:
-                if (time.time()-t1) > conf.get(SOCKETS_CONNECT_TIMEOUT):
-                    raise SocketConnectException()
-            time.sleep(conf.get(SOCKETS_CONNECT_RETRY_DELAY))
-    return sock
+    if remote:
+        connected.update(_connect_tcp(remote, conf.get(SOCKETS_CONNECT_TIMEOUT), reconnect)[0])
+    return connected
 
 
 
@@ -127,8 +259,9 @@ def start_server(server_addr=('', 0)):
             # Bind to address
             sock.bind(server_addr)
 
-            # Initiate listening for connections. Create queue of 5 for unaccepted connections
-            sock.listen(5)
+            # Initiate listening for connections. Create a large queue for unaccepted connections,
+            # as many processes may connect at the same time.
+            sock.listen(socket.SOMAXCONN)
 
             ok = True
             
@@ -156,6 +289,27 @@ def start_server(server_addr=('', 0)):
 
     return sock, address
 
+def start_unix_server(server_addr):
+    """
+    Listen on the unix domain socket for the TCP address server_addr, such that
+    processes on the same host can connect without using the TCP stack.
+
+    Returns None, if unix domain sockets are unavailable.
+    """
+    if not UNIX_SOCKETS:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(_unix_path(server_addr))
+        sock.listen(socket.SOMAXCONN)
+    except socket.error as e:
+        if STDERR_OUTPUT:
+            sys.stderr.write("PyCSP socket issue (%d): %s\n" % (e.errno, e.message))
+        sock.close()
+        return None
+    return sock
+
 def connectNOcache(addr):
     """
     Connect to addr circumventing the cached sockets
@@ -185,54 +339,423 @@ def sendallNOcache(sock, data):
 
 def recvall(sock, msg_len):
     """
-    A fast string concatenation in a loop that continues until the entire msg has been received
+    Receives msg_len bytes directly into a preallocated buffer, which is returned
     """
+    msg = bytearray(msg_len)
+    view = memoryview(msg)
     msg_len_received = 0
-    msg_chunks = []
     try:
         while msg_len_received < msg_len:
-            chunk = sock.recv(msg_len - msg_len_received)
-            if chunk == '':
+            n = sock.recv_into(view[msg_len_received:])
+            if n == 0:
                 raise SocketClosedException()
-            msg_chunks.append(chunk)
-            msg_len_received += len(chunk)
+            msg_len_received += n
     except socket.error as e:
         if STDERR_OUTPUT:
             sys.stderr.write("PyCSP socket issue (%d): %s\n" % (e.errno, e.message))
         raise SocketClosedException()
         
-    return "".join(msg_chunks)
+    return msg
+
+
+# Flags used when reading from a readable socket. MSG_DONTWAIT makes a single
+# recv non-blocking, without changing the blocking mode of a socket, which may
+# be shared with sending threads.
+RECV_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# Errors which tells, that a non-blocking operation would have blocked
+WOULDBLOCK_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def accept_all(server_sock):
+    """
+    Accept all pending connections on a non-blocking server socket.
+
+    Returns the list of accepted sockets in blocking mode with the Nagle algorithm disabled.
+    """
+    accepted = []
+    while True:
+        try:
+            conn, _ = server_sock.accept()
+        except socket.error as e:
+            if e.errno in WOULDBLOCK_ERRORS or e.errno == errno.ECONNABORTED:
+                break
+            raise
+        conn.setblocking(1)
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
+        accepted.append(conn)
+    return accepted
+
+
+class Poller(object):
+    """
+    Wait for incoming data on a set of sockets.
+
+    Uses epoll if available, then poll and at last select. The epoll and poll
+    implementations are not limited by the FD_SETSIZE of select.
+
+    Objects registered must provide a fileno() method. The objects are returned from
+    poll(timeout), when they are ready for reading or have failed. With writable=True,
+    the objects are returned when they are ready for writing instead.
+    """
+    def __init__(self, writable=False):
+        self.fd_map = {}
+        self.writable = writable
+        if hasattr(select, 'epoll'):
+            self.impl = select.epoll()
+            if writable:
+                self.mask = select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP
+            else:
+                self.mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self.timeout_scale = 1.0
+        elif hasattr(select, 'poll'):
+            self.impl = select.poll()
+            if writable:
+                self.mask = select.POLLOUT | select.POLLERR | select.POLLHUP
+            else:
+                self.mask = select.POLLIN | select.POLLERR | select.POLLHUP
+            # select.poll takes the timeout in milliseconds
+            self.timeout_scale = 1000.0
+        else:
+            self.impl = None
+
+    def register(self, obj):
+        fd = obj.fileno()
+        if not fd in self.fd_map:
+            self.fd_map[fd] = obj
+            if self.impl:
+                self.impl.register(fd, self.mask)
+
+    def unregister(self, obj):
+        fd = obj.fileno()
+        if fd in self.fd_map:
+            del self.fd_map[fd]
+            if self.impl:
+                self.impl.unregister(fd)
+
+    def poll(self, timeout):
+        """
+        Returns a list of ready objects. An empty list is returned on timeout.
+        """
+        if self.impl:
+            try:
+                events = self.impl.poll(timeout * self.timeout_scale)
+            except (IOError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            return [self.fd_map[fd] for fd, _ in events if fd in self.fd_map]
+        else:
+            try:
+                if self.writable:
+                    _, ready, exceptready = select.select([], self.fd_map.values(), self.fd_map.values(), timeout)
+                else:
+                    ready, _, exceptready = select.select(self.fd_map.values(), [], self.fd_map.values(), timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            for obj in exceptready:
+                if not obj in ready:
+                    ready.append(obj)
+            return ready
+
+    def close(self):
+        if self.impl and hasattr(self.impl, 'close'):
+            self.impl.close()
+        self.fd_map = {}
+
+
+class Waker(object):
+    """
+    Wakes a thread blocked in Poller.poll, by writing to a connected socket pair.
+
+    The reading end must be registered in the Poller and drained with drain(),
+    when reported ready.
+    """
+    def __init__(self):
+        if hasattr(socket, 'socketpair'):
+            self.reader, self.writer = socket.socketpair()
+        else:
+            # Create a connected pair on the loopback interface
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self.writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.writer.connect(listener.getsockname())
+            self.reader, _ = listener.accept()
+            listener.close()
+            self.writer.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.reader.setblocking(0)
+        self.writer.setblocking(0)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def wake(self):
+        try:
+            self.writer.send('x')
+        except socket.error as e:
+            # A full socket buffer means that the reader has not yet been woken.
+            if not e.errno in WOULDBLOCK_ERRORS:
+                raise
+
+    def drain(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error as e:
+            if not e.errno in WOULDBLOCK_ERRORS:
+                raise
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+# Vectored sends are only available from Python 3.3
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+IOV_MAX = 1024
+
+def _consume(buffers, sent):
+    """
+    Returns the buffers remaining after sent bytes have been written
+    """
+    i = 0
+    while i < len(buffers) and sent >= len(buffers[i]):
+        sent -= len(buffers[i])
+        i += 1
+    buffers = buffers[i:]
+    if sent:
+        buffers[0] = memoryview(buffers[0])[sent:]
+    return buffers
+
+def _coalesce(buffers):
+    """
+    Joins neighbouring small buffers, such that they are written by one system call.
+
+    Buffers larger than INLINE_PAYLOAD_SIZE are passed on without copying.
+    """
+    chunks = []
+    pending = []
+    for data in buffers:
+        if len(data) > INLINE_PAYLOAD_SIZE:
+            if pending:
+                chunks.append("".join(pending))
+                pending = []
+            chunks.append(data)
+        else:
+            pending.append(data)
+    if pending:
+        chunks.append("".join(pending))
+    return chunks
+
+
+def _shutdown(sock, how=socket.SHUT_RDWR):
+    """
+    Shuts down a connection read by the SocketThread, which then closes it
+    """
+    try:
+        sock.shutdown(how)
+    except socket.error:
+        pass
 
 
 class ConnHandler(object):
+    """
+    Pool of connections to remote addresses, shared by all threads.
+
+    At most SOCKETS_POOL_SIZE connections are kept. When exceeded, the least recently
+    used connections are closed. Connections which have been idle for longer than
+    SOCKETS_POOL_IDLE_TIMEOUT seconds are closed as well. A connection is never closed
+    by the pool, while its send lock is held.
+    """
     def __init__(self):
         self.cacheSockets = {}
 
+        # Reverse index of cacheSockets
+        self.cacheAddrs = {}
+
+        # Time of the last use of every cached connection
+        self.lastUsed = {}
+
+        # Cached connections, which are also read by the SocketThread. These are shut
+        # down instead of closed, such that the SocketThread closes them.
+        self.shared = set()
+
+        # Protects modifications of the pool
+        self.poolLock = threading.Lock()
+        self.nextIdleCheck = 0
+
+        # Send locks per destination address
+        self.sendLocks = {}
+
+        # Protocol state of cached connections. Removed when the connection is closed.
+        self.connState = {}
+
+    def lock(self, addr):
+        """
+        Returns the send lock for addr.
+
+        The lock must be held while sending a message to addr, such that messages
+        sent concurrently to the same destination are not interleaved. Sends to
+        different destinations do not block each other.
+        """
+        try:
+            return self.sendLocks[addr]
+        except KeyError:
+            # setdefault is atomic, thus concurrent callers get the same lock
+            return self.sendLocks.setdefault(addr, threading.RLock())
+
     def updateCache(self, addr, sock):
+        """
+        Adds a connection accepted by the SocketThread, which is used for sending to addr
+        """
         if ENABLE_CACHE:
-            if not addr in self.cacheSockets:
-                self.cacheSockets[addr] = sock
+            self.poolLock.acquire()
+            try:
+                if not addr in self.cacheSockets and not sock in self.cacheAddrs:
+                    self._add(addr, sock)
+                    self.shared.add(sock)
+            finally:
+                self.poolLock.release()
+            self.expire(addr)
+
+    def share(self, sock):
+        """
+        Marks a cached connection as also read by the SocketThread
+        """
+        self.poolLock.acquire()
+        try:
+            if sock in self.cacheAddrs:
+                self.shared.add(sock)
+        finally:
+            self.poolLock.release()
+
+    def preconnect(self, addrs):
+        """
+        Connect concurrently to the addresses, which are not cached. Refused
+        connections are not retried and failures are ignored, as the following sends
+        connect again.
+        """
+        locks = []
+        todo = []
+        try:
+            for addr in set(addrs):
+                if addr in self.cacheSockets:
+                    continue
+
+                # A locked address is being connected or used by another thread
+                lock = self.lock(addr)
+                if lock.acquire(False):
+                    locks.append(lock)
+                    if not addr in self.cacheSockets:
+                        todo.append(addr)
+
+            if todo and ENABLE_CACHE:
+                connected = _connect_many(todo, reconnect=False)
+                self.poolLock.acquire()
+                try:
+                    for addr, sock in connected.items():
+                        self._add(addr, sock)
+                finally:
+                    self.poolLock.release()
+        finally:
+            for lock in locks:
+                lock.release()
+
+        self.expire()
 
     def connect(self, addr, reconnect=True):
         """
         Retrieve old connection or acquire new connection
 
         If reconnect = False, connect returns False instead of socket, when unable to connect to host.
+
+        The send lock for addr must be held by the caller.
         """
 
         # Lookup connection
-        if addr in self.cacheSockets:
-            sock = self.cacheSockets[addr]
+        sock = self.cacheSockets.get(addr)
+        if sock is not None:
+            self.lastUsed[addr] = time.time()
             return sock
 
         sock = _connect(addr, reconnect)
 
         # Save connection
-        if ENABLE_CACHE:
-            self.cacheSockets[addr] = sock
+        if ENABLE_CACHE and sock:
+            self.poolLock.acquire()
+            try:
+                self._add(addr, sock)
+            finally:
+                self.poolLock.release()
+            self.expire(addr)
 
         return sock
 
+    def _add(self, addr, sock):
+        self.cacheSockets[addr] = sock
+        self.cacheAddrs[sock] = addr
+        self.lastUsed[addr] = time.time()
+
+    def _remove(self, addr, how=socket.SHUT_RDWR):
+        """
+        Removes addr from the pool. Returns a function closing its connection.
+
+        A connection read by the SocketThread is shut down in the direction how.
+        """
+        sock = self.cacheSockets.pop(addr)
+        del self.cacheAddrs[sock]
+        self.lastUsed.pop(addr, None)
+        self.connState.pop(sock, None)
+
+        if sock in self.shared:
+            self.shared.discard(sock)
+            return lambda: _shutdown(sock, how)
+        return sock.close
+
+    def expire(self, keep=None):
+        """
+        Closes idle connections and the least recently used connections exceeding the
+        pool size. Connections in use by other threads and the connection to keep are
+        not closed.
+        """
+        now = time.time()
+        size = conf.get(SOCKETS_POOL_SIZE)
+        idle = conf.get(SOCKETS_POOL_IDLE_TIMEOUT)
+        check_idle = idle and now >= self.nextIdleCheck
+        if len(self.cacheSockets) <= size and not check_idle:
+            return
+
+        lastUsed = self.lastUsed.items()
+        victims = set()
+        if check_idle:
+            self.nextIdleCheck = now + idle / 4.0
+            victims.update([addr for addr, t in lastUsed if now - t > idle])
+
+        excess = len(lastUsed) - len(victims) - size
+        if excess > 0:
+            # Evict a batch, such that the pool is not sorted for every new connection
+            excess = max(excess, size // 8)
+            lastUsed.sort(key=lambda item: item[1])
+            victims.update([addr for addr, t in lastUsed if not addr in victims][:excess])
+
+        victims.discard(keep)
+        for addr in victims:
+            lock = self.lock(addr)
+            if lock.acquire(False):
+                try:
+                    # The peer may be sending on the connection as well. Only the sending
+                    # direction is shut down, such that messages in flight are still read,
+                    # until the peer has closed its end.
+                    self.forceclose(addr, socket.SHUT_WR)
+                finally:
+                    lock.release()
+
     
     def sendallNOreconnect(self, sock, data):
         """
@@ -241,23 +764,41 @@ class ConnHandler(object):
         try:
             sock.sendall(data)
         except socket.error as e:
-            if STDERR_OUTPUT:
-                sys.stderr.write("PyCSP socket issue (%d): %s\n" % (e.errno, e.message))
-            # TODO make exceptions depending on the error value
+            self._expire(sock, e)
 
-            # Expire socket
-            addr = None
-            for item in self.cacheSockets.items():
-                if (item[1] == sock):
-                    addr = item[0]
-                    self.forceclose(addr)
+    def sendallvNOreconnect(self, sock, buffers):
+        """
+        Send all buffers on socket in order, using as few system calls as possible.
+        Do not reconnect on error.
 
-            if addr == None:
-                raise Exception("Fatal error: Could not find cached socket " + str(sock))
+        Small buffers are coalesced, while large buffers are sent without copying.
+        """
+        try:
+            if type(sock) == shm.ShmSocket:
+                # Written directly into shared memory, thus not coalesced
+                sock.sendallv(buffers)
+            elif HAS_SENDMSG:
+                while buffers:
+                    sent = sock.sendmsg(buffers[:IOV_MAX])
+                    buffers = _consume(buffers, sent)
+            else:
+                for data in _coalesce(buffers):
+                    sock.sendall(data)
+        except socket.error as e:
+            self._expire(sock, e)
 
-            raise SocketSendException()
+    def _expire(self, sock, e):
+        if STDERR_OUTPUT:
+            sys.stderr.write("PyCSP socket issue (%d): %s\n" % (e.errno, e.message))
+        # TODO make exceptions depending on the error value
 
+        # Expire socket
+        addr = self.cacheAddrs.get(sock)
+        if addr == None:
+            raise Exception("Fatal error: Could not find cached socket " + str(sock))
+        self.forceclose(addr)
 
+        raise SocketSendException()
 
 
     def sendall(self, sock, data):
@@ -285,14 +826,10 @@ class ConnHandler(object):
                     raise SocketSendException()
                 else:
                     # Expire socket
-                    addr = None
-                    for item in self.cacheSockets.items():
-                        if (item[1] == sock):
-                            addr = item[0]
-                            self.forceclose(addr)
-
+                    addr = self.cacheAddrs.get(sock)
                     if addr == None:
                         raise Exception("Fatal error: Could not find cached socket " + str(sock))
+                    self.forceclose(addr)
 
                     # Reconnect
                     sock = self.connect(addr)
@@ -309,25 +846,29 @@ class ConnHandler(object):
         pass
 
     
-    def forceclose(self, addr):
+    def forceclose(self, addr, how=socket.SHUT_RDWR):
         """
         Close socket and remove cached socket
         """
-        if addr in self.cacheSockets:
-            sock = self.cacheSockets[addr]
-
-            del self.cacheSockets[addr]
-
-            sock.close()
+        self.poolLock.acquire()
+        try:
+            if not addr in self.cacheSockets:
+                return
+            close = self._remove(addr, how)
+        finally:
+            self.poolLock.release()
+        close()
 
     def closeall(self):
         """
         Close all sockets owned by thread
         """
-        for addr in self.cacheSockets:
-            sock = self.cacheSockets[addr]
-            sock.close()
-
-        self.cacheSockets = {}
+        self.poolLock.acquire()
+        try:
+            closers = [self._remove(addr) for addr in self.cacheSockets.keys()]
+        finally:
+            self.poolLock.release()
+        for close in closers:
+            close()
 
 
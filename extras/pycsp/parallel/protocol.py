@@ -9,13 +9,18 @@ See LICENSE.txt for licensing details (MIT License).
 """
 
 import sys
+import operator
 import threading
+import itertools
+import collections
 
 from pycsp.parallel.exceptions import *
 from pycsp.parallel.header import *
 from pycsp.parallel.dispatch import *
+from pycsp.parallel.engine import Return, Wait
 from pycsp.parallel.const import *
 from pycsp.parallel.configuration import *
+from pycsp.parallel import engine
 
 conf = Configuration()
 
@@ -26,13 +31,20 @@ class ChannelMessenger(object):
     def restore(self):
         """
         Restore dispatch thread, if the current thread is stale. This can happen when channelends are mobile and sent to other processes.
+        The dispatch thread of this interpreter is cached in the context of the current process.
         """
-        if self.dispatch:
-            if not self.dispatch.is_alive():
-                self.dispatch = SocketDispatcher().getThread()
+        self.dispatch = getDispatch()
+
+    def send(self, channel, header, payload=""):
+        """
+        Sends a message to the channel home. A channel home hosted by this interpreter
+        is given the message directly.
+        """
+        home = channel._channelhomethread
+        if home and home.server.dispatch is self.dispatch:
+            home.server.post(header, payload)
         else:
-            self.dispatch = SocketDispatcher().getThread()
-            
+            self.dispatch.send(channel.address, header, payload)
 
     def register(self, channel):
         """
@@ -41,8 +53,7 @@ class ChannelMessenger(object):
         self.restore()
 
         try:
-            self.dispatch.send(channel.address, 
-                                        Header(CHANTHREAD_REGISTER, channel.name))
+            self.send(channel, Header(CHANTHREAD_REGISTER, channel.name))
         except SocketException:
             # Unable to register at channel home thread
             raise ChannelConnectException(channel.address, "PyCSP (register channel) unable to reach channel home thread (%s at %s)" % (channel.name, str(channel.address)))
@@ -51,8 +62,7 @@ class ChannelMessenger(object):
         self.restore()
 
         try:
-            self.dispatch.send(channel.address,
-                                        Header(CHANTHREAD_DEREGISTER, channel.name))
+            self.send(channel, Header(CHANTHREAD_DEREGISTER, channel.name))
         except SocketException:
             # Unable to deregister at channel home thread
             # The channel thread may have been terminated forcefully, thus this is an acceptable situation.
@@ -63,11 +73,9 @@ class ChannelMessenger(object):
 
         try:
             if direction == READ:
-                self.dispatch.send(channel.address,
-                                            Header(CHANTHREAD_JOIN_READER, channel.name))
+                self.send(channel, Header(CHANTHREAD_JOIN_READER, channel.name))
             elif direction == WRITE:
-                self.dispatch.send(channel.address,
-                                            Header(CHANTHREAD_JOIN_WRITER, channel.name))
+                self.send(channel, Header(CHANTHREAD_JOIN_WRITER, channel.name))
         except SocketException:
             # Unable to join channel
             raise ChannelLostException(channel.address, "PyCSP (join channel) unable to reach channel home thread (%s at %s)" % (channel.name, str(channel.address)))
@@ -78,11 +86,9 @@ class ChannelMessenger(object):
         try:
             #print("CM RETIRE %s" % channel.name)
             if direction == READ:
-                self.dispatch.send(channel.address,
-                                            Header(CHANTHREAD_RETIRE_READER, channel.name))
+                self.send(channel, Header(CHANTHREAD_RETIRE_READER, channel.name))
             elif direction == WRITE:      
-                self.dispatch.send(channel.address,
-                                            Header(CHANTHREAD_RETIRE_WRITER, channel.name))
+                self.send(channel, Header(CHANTHREAD_RETIRE_WRITER, channel.name))
 
         except SocketException:
             # Unable to retire from channel
@@ -96,11 +102,9 @@ class ChannelMessenger(object):
 
         try:
             if direction == READ:
-                self.dispatch.send(channel.address,
-                                            Header(CHANTHREAD_POISON_READER, channel.name))
+                self.send(channel, Header(CHANTHREAD_POISON_READER, channel.name))
             elif direction == WRITE:
-                self.dispatch.send(channel.address,
-                                            Header(CHANTHREAD_POISON_WRITER, channel.name))
+                self.send(channel, Header(CHANTHREAD_POISON_WRITER, channel.name))
 
         except SocketException:
             # Unable to poison channel
@@ -110,40 +114,48 @@ class ChannelMessenger(object):
                 sys.stderr.write("PyCSP (poison channel) unable to reach channel home thread (%s at %s)\n" % (channel.name, str(channel.address)))
 
 
-    def post_read(self, channel, process, ack=False):
+    def post_read(self, channel, process, ack=False, direct=False):
+        """
+        Posts a read request. A direct request is committed by the channel home
+        without acquiring the lock of the process, thus it must only be used when
+        the process waits for this request alone, outside any Alternation.
+        """
         self.restore()
 
         # Enter channel and update NAT socket
-        if not channel in process.activeChanList:
-            process.activeChanList.append(channel)
+        if not channel in process.activeChanSet:
+            process.activeChanSet.add(channel)
             self.enter(channel, process)
 
         try:
-            if ack:
-                self.dispatch.send(channel.address,
-                                   Header(CHANTHREAD_POST_ACK_READ, channel.name, process.sequence_number, _source_id=process.id))                
+            if direct:
+                self.send(channel, Header(CHANTHREAD_POST_DIRECT_READ, channel.name, process.sequence_number, _source_id=process.id))
+            elif ack:
+                self.send(channel, Header(CHANTHREAD_POST_ACK_READ, channel.name, process.sequence_number, _source_id=process.id))                
             else:
-                self.dispatch.send(channel.address,
-                                   Header(CHANTHREAD_POST_READ, channel.name, process.sequence_number, _source_id=process.id))            
+                self.send(channel, Header(CHANTHREAD_POST_READ, channel.name, process.sequence_number, _source_id=process.id))            
         except SocketException:
             # Unable to post read request to channel home thread
             raise FatalException("PyCSP (post read request) unable to reach channel home thread (%s at %s)" % (channel.name, str(channel.address)))        
 
-    def post_write(self, channel, process, msg, ack=False):
+    def post_write(self, channel, process, msg, ack=False, direct=False):
+        """
+        Posts a write request. See post_read for direct requests.
+        """
         self.restore()
 
         # Enter channel and update NAT socket
-        if not channel in process.activeChanList:
-            process.activeChanList.append(channel)
+        if not channel in process.activeChanSet:
+            process.activeChanSet.add(channel)
             self.enter(channel, process)
             
         try:
-            if ack:
-                self.dispatch.send(channel.address,
-                                   Header(CHANTHREAD_POST_ACK_WRITE, channel.name, process.sequence_number, _source_id=process.id), payload=[msg])            
+            if direct:
+                self.send(channel, Header(CHANTHREAD_POST_DIRECT_WRITE, channel.name, process.sequence_number, _source_id=process.id, codec=channel.codec.id), payload=[msg])
+            elif ack:
+                self.send(channel, Header(CHANTHREAD_POST_ACK_WRITE, channel.name, process.sequence_number, _source_id=process.id, codec=channel.codec.id), payload=[msg])
             else:
-                self.dispatch.send(channel.address,
-                                   Header(CHANTHREAD_POST_WRITE, channel.name, process.sequence_number, _source_id=process.id), payload=[msg])
+                self.send(channel, Header(CHANTHREAD_POST_WRITE, channel.name, process.sequence_number, _source_id=process.id, codec=channel.codec.id), payload=[msg])
         except SocketException:
             # Unable to post read request to channel home thread
             raise FatalException("PyCSP (post write request) unable to reach channel home thread (%s at %s)" % (channel.name, str(channel.address)))
@@ -151,15 +163,14 @@ class ChannelMessenger(object):
 
     def enter(self, channel, process):
         """
-        The enter command is also used to update the reverse socket for traversing NAT
+        Announces the process at the channel home. The channel home replies on the
+        connection used, which also traverses NAT
         """
         self.restore()
 
         
         try:
-            self.dispatch.send(channel.address,
-                               Header(CHANTHREAD_ENTER, channel.name, _source_id=process.id))
-            # The reverse socket is added to the message at the destination dispatch thread
+            self.send(channel, Header(CHANTHREAD_ENTER, channel.name, _source_id=process.id))
 
         except SocketException:
             # Unable to enter channel
@@ -172,8 +183,7 @@ class ChannelMessenger(object):
         self.restore()
 
         try:
-            self.dispatch.send(channel.address,
-                               Header(CHANTHREAD_LEAVE, channel.name, _source_id=process.id))
+            self.send(channel, Header(CHANTHREAD_LEAVE, channel.name, _source_id=process.id))
 
         except SocketException:
             # Unable to decrement writer count on channel
@@ -191,9 +201,6 @@ class LockMessenger(object):
         self.channel_id = channel_id
         self.input = self.dispatch.getChannelQueue(channel_id)
 
-    def set_reverse_socket(self, addr, reverse_socket):
-        self.dispatch.add_reverse_socket(addr, reverse_socket)
-
     def ack(self, dest):
         """
         Send acknowledgement to process, that the posted request have been checked for
@@ -209,10 +216,28 @@ class LockMessenger(object):
         except SocketException:
             raise FatalException("Process %s is unavailable!", str(dest.id))
 
+    def begin_batch(self):
+        """
+        Collect the following notifications and releases, such that messages to the
+        same destination are sent together by flush_batch. No lock may be acquired
+        before the batch is flushed.
+        """
+        self.dispatch.begin_batch()
+
+    def flush_batch(self):
+        """
+        Send the collected messages. Raises AddrUnavailableException if a destination
+        is unreachable.
+        """
+        self.dispatch.flush_batch()
+
     def remote_acquire_and_get_state(self, dest):
+        """
+        Coroutine. Returns (header, state, sequence number) of the remote lock of dest.
+        """
         #sys.stderr.write("\nENTER REMOTE ACQUIRE\n")
         if not dest.active:
-            return (None, FAIL, 0)
+            raise Return((None, FAIL, 0))
 
         header = Header()
         try:
@@ -222,7 +247,7 @@ class LockMessenger(object):
             h._source_id = self.channel_id
             self.dispatch.send(dest.hostNport, h)
 
-            msg = self.input.pop_reply()
+            msg = yield Wait(self.input, True, dest.hostNport)
             if msg == None:
                 header.cmd = LOCKTHREAD_UNAVAILABLE
             else:
@@ -241,20 +266,21 @@ class LockMessenger(object):
             
             #sys.stderr.write("\nEXIT REMOTE ACQUIRE FAIL\n")
 
-            return (None, FAIL, 0)
+            raise Return((None, FAIL, 0))
 
         if header.cmd != LOCKTHREAD_ACCEPT_LOCK:
             raise Exception("Fatal error!")
 
         #sys.stderr.write("\nEXIT REMOTE ACQUIRE SUCCESS\n")
-        return (header, header.arg, header.seq_number)
+        raise Return((header, header.arg, header.seq_number))
 
-    def remote_notify(self, source_header, dest, result_ch, result_msg=""):
+    def remote_notify(self, source_header, dest, result_ch, result_msg="", codec=0):
         if dest.active:
             try:
                 h = Header(LOCKTHREAD_NOTIFY_SUCCESS, dest.id)
                 h._source_id = self.channel_id
                 h._result_id = result_ch
+                h.codec = codec
                 self.dispatch.reply(source_header, h, payload=result_msg)
             except SocketException:
                 raise AddrUnavailableException(dest)
@@ -289,6 +315,38 @@ class LockMessenger(object):
             except SocketException:
                 pass
 
+    def direct_notify(self, dest, seq_number, result_ch, result_msg="", codec=0):
+        """
+        Commits the direct request seq_number of dest, without holding its lock
+        """
+        if dest.active:
+            try:
+                h = Header(LOCKTHREAD_DIRECT_NOTIFY, dest.id, seq_number)
+                h._source_id = self.channel_id
+                h._result_id = result_ch
+                h.codec = codec
+                self.dispatch.send(dest.hostNport, h, payload=result_msg)
+            except SocketException:
+                raise AddrUnavailableException(dest)
+
+    def direct_poison(self, dest, seq_number):
+        if dest.active:
+            try:
+                h = Header(LOCKTHREAD_DIRECT_POISON, dest.id, seq_number)
+                h._source_id = self.channel_id
+                self.dispatch.send(dest.hostNport, h)
+            except SocketException:
+                raise AddrUnavailableException(dest)
+
+    def direct_retire(self, dest, seq_number):
+        if dest.active:
+            try:
+                h = Header(LOCKTHREAD_DIRECT_RETIRE, dest.id, seq_number)
+                h._source_id = self.channel_id
+                self.dispatch.send(dest.hostNport, h)
+            except SocketException:
+                raise AddrUnavailableException(dest)
+
     def remote_final(self, dest):
         """
         Tell remote lock, that this is the last communication
@@ -314,11 +372,20 @@ class RemoteLock:
         self.waiting = []
         self.lock_acquired = None
 
+        # Messages may be delivered concurrently from the SocketThread and local threads
+        self.lock = threading.RLock()
+
     def __repr__(self):
         return repr("<pycsp.protocol.RemoteLock for process id:%s acquired:%s waiting:%s, fn:%s>" % (self.process.id, self.lock_acquired, str(self.waiting), self.process.fn))
 
+    def handle(self, message):
+        self.lock.acquire()
+        try:
+            self._handle(message)
+        finally:
+            self.lock.release()
 
-    def handle(self, message):        
+    def _handle(self, message):        
         header = message.header
 
         # Check id
@@ -351,8 +418,12 @@ class RemoteLock:
                 self.waiting.append(message)
             else:
                 self.lock_acquired = header._source_id                
-                # Send reply
-                self.dispatch.reply(header, Header(LOCKTHREAD_ACCEPT_LOCK, header._source_id, self.process.sequence_number, self.process.state))
+                # Send reply. The process starts a request by incrementing its sequence
+                # number and then setting READY without the lock, thus the state is read
+                # first. A READY state is never reported with the sequence number of an
+                # earlier request.
+                state = self.process.state
+                self.dispatch.reply(header, Header(LOCKTHREAD_ACCEPT_LOCK, header._source_id, self.process.sequence_number, state))
         elif header.cmd == LOCKTHREAD_NOTIFY_SUCCESS:
             #print("%s NOTIFY\n" % (self.process.id))
             if self.lock_acquired == header._source_id:
@@ -362,8 +433,9 @@ class RemoteLock:
     
                 self.process.result_ch = header._result_id 
                 
-                # The unpickling must be postponed to the @process
+                # The decoding must be postponed to the @process
                 self.process.result_msg = message.payload
+                self.process.result_codec = header.codec
 
                 self.process.state = SUCCESS
                 self.cond.notify()
@@ -372,6 +444,31 @@ class RemoteLock:
                 #print "'%s','%s'" %(self.lock_acquired, ) 
                 raise Exception("Fatal error!, Remote lock has not been acquired!")
 
+        elif header.cmd == LOCKTHREAD_DIRECT_NOTIFY:
+            # Only the channel home of a direct request commits it, thus the lock is not needed
+            self.cond.acquire()
+            if self.process.state != READY or self.process.sequence_number != header.seq_number:
+                raise Exception("PyCSP Panic")
+
+            self.process.result_ch = header._result_id
+            self.process.result_msg = message.payload
+            self.process.result_codec = header.codec
+
+            self.process.state = SUCCESS
+            self.cond.notify()
+            self.cond.release()
+
+        elif header.cmd == LOCKTHREAD_DIRECT_POISON or header.cmd == LOCKTHREAD_DIRECT_RETIRE:
+            # Ignored, if the request has already been committed
+            self.cond.acquire()
+            if self.process.state == READY and self.process.sequence_number == header.seq_number:
+                if header.cmd == LOCKTHREAD_DIRECT_POISON:
+                    self.process.state = POISON
+                else:
+                    self.process.state = RETIRE
+                self.cond.notify()
+            self.cond.release()
+
         elif header.cmd == LOCKTHREAD_POISON:
             #print("%s POISON\n" % (self.process.id))
             if self.lock_acquired == header._source_id:
@@ -400,7 +497,7 @@ class RemoteLock:
                 self.lock_acquired = None
 
                 if self.waiting:
-                    self.handle(self.waiting.pop(0))
+                    self._handle(self.waiting.pop(0))
             else:
                 raise Exception("Fatal error!, Remote lock has not been acquired!")
 
@@ -429,27 +526,31 @@ class Buffer(object):
         if len(self.items) < self.max:
 
             try:
-                w_conn, w_state, w_seq = self.LM.remote_acquire_and_get_state(writer.process)
+                w_conn, w_state, w_seq = yield writer.acquire()
 
                 if w_seq != writer.seq_check:
                     w_state = FAIL
 
-                if (w_state == READY):
-                    self.items.append(writer.msg)
-                    self.LM.remote_notify(w_conn, writer.process, writer.ch_id)
-                    success = True
+                self.LM.begin_batch()
+                try:
+                    if (w_state == READY):
+                        self.items.append((writer.msg, writer.codec))
+                        writer.notify(w_conn)
+                        success = True
 
-                    w_state = SUCCESS
+                        w_state = SUCCESS
 
-                # Schedule removal of NOT READY requests from channel
-                if (w_state != READY):
-                    remove_write = True
+                    # Schedule removal of NOT READY requests from channel
+                    if (w_state != READY):
+                        remove_write = True
 
-                self.LM.remote_release(w_conn, writer.process)
+                    writer.release(w_conn)
+                finally:
+                    self.LM.flush_batch()
             except AddrUnavailableException:
                 remove_write = True
 
-        return (remove_write, success)
+        raise Return((remove_write, success))
 
     def putinto(self, reader):
         success = False
@@ -459,33 +560,101 @@ class Buffer(object):
         if self.items:
 
             try:
-                r_conn, r_state, r_seq = self.LM.remote_acquire_and_get_state(reader.process)
+                r_conn, r_state, r_seq = yield reader.acquire()
                 
                 if r_seq != reader.seq_check:
                     r_state = FAIL
 
-                if (r_state == READY):
-                    msg = self.items.pop(0)
-                    self.LM.remote_notify(r_conn, reader.process, reader.ch_id, msg)
-                    success = True
+                self.LM.begin_batch()
+                try:
+                    if (r_state == READY):
+                        msg, codec = self.items.pop(0)
+                        reader.notify(r_conn, msg, codec)
+                        success = True
 
-                    r_state = SUCCESS
+                        r_state = SUCCESS
 
-                # Schedule removal of NOT READY requests from channel
-                if (r_state != READY):
-                    remove_read = True
+                    # Schedule removal of NOT READY requests from channel
+                    if (r_state != READY):
+                        remove_read = True
 
-                self.LM.remote_release(r_conn, reader.process)
+                    reader.release(r_conn)
+                finally:
+                    self.LM.flush_batch()
             except AddrUnavailableException:
                 remove_read = True
 
-        return (remove_read, success)
+        raise Return((remove_read, success))
     
-        
+
+
+_is_queued = operator.attrgetter('queued')
+
+class RequestQueue(object):
+    """
+    FIFO queue of the requests posted to a channel home.
+
+    A removed request is only marked and skipped, until it is dropped from the head of
+    the deque or the deque is compacted by append. Thus requests may be removed, while
+    the queue is iterated. The last request of every process is indexed by process id
+    and links to the older requests of the process, such that leave does not search
+    the queue.
+    """
+    def __init__(self):
+        self.queue = collections.deque()
+        self.index = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return itertools.ifilter(_is_queued, self.queue)
+
+    def append(self, req):
+        queue = self.queue
+        if len(queue) > self.count:
+            while queue and not queue[0].queued:
+                queue.popleft()
+            if len(queue) > 2*self.count + 32:
+                self.queue = queue = collections.deque(self)
+
+        req.queued = True
+        queue.append(req)
+        self.count += 1
+
+        older = self.index.get(req.process.id)
+        while older is not None and not older.queued:
+            older = older.older
+        req.older = older
+        self.index[req.process.id] = req
+
+    def remove(self, req):
+        if req.queued:
+            req.queued = False
+            self.count -= 1
+
+    def remove_process(self, process_id):
+        """
+        Removes every request of the process
+        """
+        req = self.index.pop(process_id, None)
+        while req is not None:
+            self.remove(req)
+            req = req.older
+
+    def clear(self):
+        for req in self.queue:
+            req.queued = False
+        self.queue.clear()
+        self.index.clear()
+        self.count = 0
+
+
 class ChannelHome(object):
     def __init__(self, name, buffer):
-        self.readqueue=[]
-        self.writequeue=[]
+        self.readqueue = RequestQueue()
+        self.writequeue = RequestQueue()
         self.ispoisoned=False
         self.isretired=False
         self.readers=0
@@ -502,6 +671,18 @@ class ChannelHome(object):
         else:
             self.buffer = None
 
+        # Offers, which must wait for a reply from a process, are continued as separate
+        # tasks by the events and pool engines. Every offer in flight has its own
+        # LockMessenger, such that the replies of different processes are not mixed up.
+        # Enabled by ChannelHomeServer, when messages are no longer handled locally.
+        self.pipelined = False
+        self.slots = []
+        self.pending = 0
+
+        # Ids of the processes in offers in flight. Their requests are not offered again,
+        # until the offer has completed.
+        self.busy = set()
+
     def check_termination(self):
         """
         This method is invoked on the initial posting of a request.
@@ -514,14 +695,14 @@ class ChannelHome(object):
             # Buffer enabled
             if self.buffer.ispoisoned:
                 if self.buffer.isempty():
-                    self.poison_writer()
+                    yield self.poison_writer()
 
             if self.buffer.isretired:
                 if self.buffer.isempty():
                     self.isretired= True
                     for p in self.readqueue:
-                        p.retire()                    
-                    self.readqueue = []
+                        yield p.retire()                    
+                    self.readqueue.clear()
         
         if self.ispoisoned:
             raise ChannelPoisonException()
@@ -529,7 +710,9 @@ class ChannelHome(object):
             raise ChannelRetireException()
 
     def post_read(self, req):
-        self.check_termination()
+        # Only a buffer or a terminated channel needs the check
+        if self.buffer or self.ispoisoned or self.isretired:
+            yield self.check_termination()
 
         success = True
         if self.isretired or self.ispoisoned:
@@ -538,13 +721,15 @@ class ChannelHome(object):
             self.readqueue.append(req)
 
         if success:
-            self.match()
+            yield self.match()
         else:
-            self.check_termination()
+            yield self.check_termination()
 
 
     def post_write(self, req):
-        self.check_termination()
+        # Only a buffer or a terminated channel needs the check
+        if self.buffer or self.ispoisoned or self.isretired:
+            yield self.check_termination()
 
         success = True
         if self.isretired or self.ispoisoned:
@@ -553,13 +738,13 @@ class ChannelHome(object):
             self.writequeue.append(req)
 
         if success:
-            self.match()
+            yield self.match()
         else:
-            self.check_termination()
+            yield self.check_termination()
 
     def leave(self, process_id):
-        self.readqueue  = [x for x in self.readqueue if not x.process.id == process_id]
-        self.writequeue = [x for x in self.writequeue if not x.process.id == process_id]
+        self.readqueue.remove_process(process_id)
+        self.writequeue.remove_process(process_id)
                 
     def match(self):
         if self.buffer:
@@ -567,32 +752,32 @@ class ChannelHome(object):
             
             if self.buffer.isfull():
                 # Extract item
-                for r in self.readqueue[:]:
-                    remove_read, success = self.buffer.putinto(r)
+                for r in self.readqueue:
+                    remove_read, success = yield self.buffer.putinto(r)
                     if remove_read:
                         self.readqueue.remove(r)
                     if success:
                         break
                 
                 # Insert item
-                for w in self.writequeue[:]:
-                    remove_write, success = self.buffer.insertfrom(w)
+                for w in self.writequeue:
+                    remove_write, success = yield self.buffer.insertfrom(w)
                     if remove_write:
                         self.writequeue.remove(w)
                     if success:
                         break
             else:
                 # Insert item
-                for w in self.writequeue[:]:
-                    remove_write, success = self.buffer.insertfrom(w)
+                for w in self.writequeue:
+                    remove_write, success = yield self.buffer.insertfrom(w)
                     if remove_write:
                         self.writequeue.remove(w)
                     if success:
                         break
 
                 # Extract item
-                for r in self.readqueue[:]:
-                    remove_read, success = self.buffer.putinto(r)
+                for r in self.readqueue:
+                    remove_read, success = yield self.buffer.putinto(r)
                     if remove_read:
                         self.readqueue.remove(r)
                     if success:
@@ -600,9 +785,28 @@ class ChannelHome(object):
 
         else:
             # Standard matching if no buffer
-            for w in self.writequeue[:]:
-                for r in self.readqueue[:]:
-                    remove_write, remove_read, success = w.offer(r)
+            busy = self.busy
+            for w in self.writequeue:
+                if w.process.id in busy:
+                    continue
+                for r in self.readqueue:
+                    if r.process.id in busy:
+                        continue
+
+                    # Offers to direct requests do not wait. Requests of a prioritized
+                    # select must have been offered, before they are acknowledged.
+                    if w.direct and r.direct:
+                        result = w.commit(r)
+                    elif (self.pipelined and self.pending < OFFERS_IN_FLIGHT
+                          and not (w.ack or r.ack)):
+                        result = self.start_offer(w, r)
+                        if result is None:
+                            # In flight. Continue with the next writer.
+                            break
+                    else:
+                        result = yield w.offer(r)
+
+                    remove_write, remove_read, success = result
                     if remove_read:
                         self.readqueue.remove(r)
                     if remove_write:
@@ -613,6 +817,71 @@ class ChannelHome(object):
                     if success:
                         return # break match loop on first success
 
+    def start_offer(self, writer, reader):
+        """
+        Runs writer.offer(reader) until it must wait for a reply from a process. The offer
+        is then continued by a separate task and None is returned. When completed,
+        CHANTHREAD_OFFER_DONE is posted to the channel home, which must invoke offer_done.
+
+        Returns the result of offers, which were completed without waiting.
+        """
+        if self.slots:
+            LM = self.slots.pop()
+        else:
+            slot_id = unique_id()
+            self.LM.dispatch.registerChannel(slot_id)
+            LM = LockMessenger(slot_id)
+
+        self.pending += 1
+        self.busy.add(writer.process.id)
+        self.busy.add(reader.process.id)
+
+        # Set to the result by _offer, if completed by this thread in task.step()
+        inline = [threading.current_thread()]
+        task = engine.Task(self.LM.dispatch.executor, self._offer(LM, writer, reader, inline))
+        task.step()
+
+        if len(inline) == 1:
+            inline[0] = None
+            return None
+
+        self._end_offer(LM, writer, reader)
+        return inline[1]
+
+    def _offer(self, LM, writer, reader, inline):
+        result = (False, False, False)
+        try:
+            result = yield writer.offer(reader, LM)
+        finally:
+            if inline[0] is threading.current_thread():
+                inline.append(result)
+            else:
+                self.LM.input.put_normal(Message(Header(CHANTHREAD_OFFER_DONE, self.name),
+                                                 (LM, writer, reader, result)))
+
+    def _end_offer(self, LM, writer, reader):
+        self.slots.append(LM)
+        self.pending -= 1
+        self.busy.discard(writer.process.id)
+        self.busy.discard(reader.process.id)
+
+    def offer_done(self, LM, writer, reader, result):
+        remove_write, remove_read, success = result
+        self._end_offer(LM, writer, reader)
+
+        if remove_read:
+            self.readqueue.remove(reader)
+        if remove_write:
+            self.writequeue.remove(writer)
+
+    def close(self):
+        """
+        Deregisters the LockMessengers of offers. No offers may be in flight.
+        """
+        for LM in self.slots:
+            self.LM.dispatch.deregisterChannel(LM.channel_id)
+        self.slots = []
+
     # The method for poisoning non-buffered channels is identical
     # for both the reading and writing end, while the method differs
     # for buffered channels.
@@ -626,14 +895,14 @@ class ChannelHome(object):
     def poison_reader(self):
         self.ispoisoned=True
         for p in self.readqueue:
-            p.poison()
+            yield p.poison()
 
         for p in self.writequeue:
-            p.poison()
+            yield p.poison()
 
         # flush all requests
-        self.readqueue = []
-        self.writequeue = []
+        self.readqueue.clear()
+        self.writequeue.clear()
 
     def poison_writer(self):
         if self.buffer and not self.buffer.isempty():
@@ -641,23 +910,23 @@ class ChannelHome(object):
             self.buffer.ispoisoned = True
 
             for p in self.writequeue:
-                p.poison()
+                yield p.poison()
     
             # flush all write requests
-            self.writequeue = []
+            self.writequeue.clear()
 
         else:
             self.ispoisoned=True
 
             for p in self.readqueue:
-                p.poison()
+                yield p.poison()
 
             for p in self.writequeue:
-                p.poison()
+                yield p.poison()
 
             # flush all requests
-            self.readqueue = []
-            self.writequeue = []
+            self.readqueue.clear()
+            self.writequeue.clear()
 
     def retire_reader(self):
         self.readers-=1
@@ -668,7 +937,7 @@ class ChannelHome(object):
                 self.isretired= True
                 #print "WRITEQUEUE",self.writequeue
                 for p in self.writequeue:
-                    p.retire()                                        
+                    yield p.retire()                                        
                 #self.writequeue = []
                 
     def retire_writer(self):
@@ -686,7 +955,7 @@ class ChannelHome(object):
                     self.isretired= True
                     #print "READQUEUE",self.readqueue
                     for p in self.readqueue:
-                        p.retire()                    
+                        yield p.retire()                    
                     #self.readqueue = []
                 
     def join_reader(self):
@@ -713,20 +982,53 @@ class AddrID(object):
     
 
 class ChannelReq(object):
-    def __init__(self, LM, process_src, process_seq, ch_id, msg = None):
+    def __init__(self, LM, process_src, process_seq, ch_id, msg = None, codec = 0, direct = False, ack = False):
         self.process = process_src
         self.ch_id = ch_id
         self.msg = msg
+        self.codec = codec
 
         # check_sequence contains a number which must be equivalent with the sequence
         # number returned by remote_acquire_and_get_state.
         self.seq_check = process_seq
+
+        # A direct request was not posted by an Alternation. The process waits for it
+        # alone, thus it is ready until committed by this channel home and no lock is needed.
+        self.direct = direct
+
+        # Posted by a prioritized select, which waits for an acknowledgement
+        self.ack = ack
+
+        # Set while the request is in a RequestQueue of the channel home. Links to
+        # the previous request of the process in the queue.
+        self.queued = False
+        self.older = None
         
         self.LM = LM
 
+    def acquire(self, LM=None):
+        """
+        Coroutine. Returns (header, state, sequence number) of the lock of the process.
+        The lock is acquired through LM, which defaults to the LockMessenger of the request.
+        """
+        if self.direct:
+            raise Return((None, READY, self.seq_check))
+        result = yield (LM or self.LM).remote_acquire_and_get_state(self.process)
+        raise Return(result)
+
+    def notify(self, conn, result_msg="", codec=0, LM=None):
+        if self.direct:
+            (LM or self.LM).direct_notify(self.process, self.seq_check, self.ch_id, result_msg, codec)
+        else:
+            (LM or self.LM).remote_notify(conn, self.process, self.ch_id, result_msg, codec)
+
+    def release(self, conn, LM=None):
+        if not self.direct:
+            (LM or self.LM).remote_release(conn, self.process)
+
     def cancel(self):
         try:
-            conn, state, seq = self.LM.remote_acquire_and_get_state(self.process)
+            conn, state, seq = yield self.LM.remote_acquire_and_get_state(self.process)
             if seq == self.seq_check:
                 self.LM.remote_cancel(conn, self.process)
             self.LM.remote_release(conn, self.process)
@@ -739,13 +1041,23 @@ class ChannelReq(object):
  
     def poison(self):
         try:
+            if self.direct:
+                self.LM.direct_poison(self.process, self.seq_check)
+                return
+
             #print("\n%s:REQUESTING LOCK" % self.ch_id)
-            conn, state, seq = self.LM.remote_acquire_and_get_state(self.process)
+            conn, state, seq = yield self.LM.remote_acquire_and_get_state(self.process)
             #print("\n%s:ACQUIRED LOCK" % self.ch_id)
-            if seq == self.seq_check:
-                self.LM.remote_poison(conn, self.process)
-            #Ignore if sequence is incorrect
-            self.LM.remote_release(conn, self.process)
+            self.LM.begin_batch()
+            try:
+                # A request, which has already been committed, must not be poisoned, as
+                # the process may have posted its next request
+                if seq == self.seq_check and state == READY:
+                    self.LM.remote_poison(conn, self.process)
+                #Ignore if sequence is incorrect
+                self.LM.remote_release(conn, self.process)
+            finally:
+                self.LM.flush_batch()
         except AddrUnavailableException:
             # Unable to reach process to notify poison
             if conf.get(SOCKETS_STRICT_MODE):
@@ -755,12 +1067,20 @@ class ChannelReq(object):
             
     def retire(self):
         try:
-            conn, state, seq = self.LM.remote_acquire_and_get_state(self.process)
+            if self.direct:
+                self.LM.direct_retire(self.process, self.seq_check)
+                return
+
+            conn, state, seq = yield self.LM.remote_acquire_and_get_state(self.process)
             #print "remote retire"
-            if seq == self.seq_check:
-                self.LM.remote_retire(conn, self.process)
-            #Ignore if sequence is incorrect
-            self.LM.remote_release(conn, self.process)
+            self.LM.begin_batch()
+            try:
+                if seq == self.seq_check and state == READY:
+                    self.LM.remote_retire(conn, self.process)
+                #Ignore if sequence is incorrect
+                self.LM.remote_release(conn, self.process)
+            finally:
+                self.LM.flush_batch()
         except AddrUnavailableException:
             # Unable to reach process to notify retire
             if conf.get(SOCKETS_STRICT_MODE):
@@ -769,20 +1089,26 @@ class ChannelReq(object):
                 sys.stderr.write("PyCSP (retire notification) unable to reach process (%s)\n" % str(self.process))
             
 
-    def offer(self, reader):
+    def offer(self, reader, LM=None):
+        """
+        Coroutine. Commits this write request and the read request reader, if both are
+        still active. The locks are acquired through LM, if given.
+
+        Returns (remove_write, remove_read, success).
+        """
         success = False
         remove_write = False
         remove_read = False
 
         
         try:
-            # Acquire double lock
+            # Acquire double lock. Direct requests are committed without their lock.
             if (self.process.id < reader.process.id):
-                w_conn, w_state, w_seq = self.LM.remote_acquire_and_get_state(self.process)
-                r_conn, r_state, r_seq = self.LM.remote_acquire_and_get_state(reader.process)
+                w_conn, w_state, w_seq = yield self.acquire(LM)
+                r_conn, r_state, r_seq = yield reader.acquire(LM)
             else:
-                r_conn, r_state, r_seq = self.LM.remote_acquire_and_get_state(reader.process)
-                w_conn, w_state, w_seq = self.LM.remote_acquire_and_get_state(self.process)
+                r_conn, r_state, r_seq = yield reader.acquire(LM)
+                w_conn, w_state, w_seq = yield self.acquire(LM)
             
             # Check sequence numbers
             if r_seq != reader.seq_check:
@@ -790,200 +1116,301 @@ class ChannelReq(object):
             if w_seq != self.seq_check:
                 w_state = FAIL
             
-            # Success?
-            if (r_state == READY and w_state == READY):
-                self.LM.remote_notify(r_conn, reader.process, reader.ch_id, self.msg)
-                self.LM.remote_notify(w_conn, self.process, self.ch_id)
-                
-                success = True
+            # Notifications and releases are sent together, when both processes are at the same address
+            self.LM.begin_batch()
+            try:
+                # Success?
+                if (r_state == READY and w_state == READY):
+                    reader.notify(r_conn, self.msg, self.codec, LM)
+                    self.notify(w_conn, LM=LM)
 
-                r_state = SUCCESS 
-                w_state = SUCCESS
+                    success = True
 
-            # Schedule removal of NOT READY requests from channel
-            if (r_state != READY):
-                remove_read = True
-            if (w_state != READY):
-                remove_write = True
+                    r_state = SUCCESS 
+                    w_state = SUCCESS
 
-            
-            # Release double lock
-            if (self.process.id < reader.process.id):
-                self.LM.remote_release(r_conn, reader.process)
-                self.LM.remote_release(w_conn, self.process)
-            else:
-                self.LM.remote_release(w_conn, self.process)
-                self.LM.remote_release(r_conn, reader.process)
+                # Schedule removal of NOT READY requests from channel
+                if (r_state != READY):
+                    remove_read = True
+                if (w_state != READY):
+                    remove_write = True
+
+
+                # Release double lock
+                if (self.process.id < reader.process.id):
+                    reader.release(r_conn, LM)
+                    self.release(w_conn, LM)
+                else:
+                    self.release(w_conn, LM)
+                    reader.release(r_conn, LM)
+            finally:
+                self.LM.flush_batch()
 
         except AddrUnavailableException as e:
-            # Unable to reach process during offer
-            # The primary reason is probably because a request were part of an alting and the process have exited.
-            if conf.get(SOCKETS_STRICT_MODE):
-                raise FatalException("PyCSP unable to reach process during offer(%s)" % str(self.process))
-            else:
-                sys.stderr.write("PyCSP unable to reach process during offer(%s)\n" % str(self.process))
+            lost_write, lost_read, success = self._unavailable(reader, e)
+            remove_write = remove_write or lost_write
+            remove_read = remove_read or lost_read
 
-            success = False
-            if e.addr == self.process.hostNport:
-                remove_write = True
-            if e.addr == reader.process.hostNport:
-                remove_read = True
+        raise Return((remove_write, remove_read, success))
+
+    def commit(self, reader):
+        """
+        Commits this direct write request and the direct read request reader. No locks
+        are needed, thus this is not a coroutine.
+
+        Returns (remove_write, remove_read, success) as offer.
+        """
+        try:
+            self.LM.begin_batch()
+            try:
+                reader.notify(None, self.msg, self.codec)
+                self.notify(None)
+            finally:
+                self.LM.flush_batch()
+        except AddrUnavailableException as e:
+            return self._unavailable(reader, e)
 
-        return (remove_write, remove_read, success)
+        return (True, True, True)
 
+    def _unavailable(self, reader, e):
+        # Unable to reach process during offer
+        # The primary reason is probably because a request were part of an alting and the process have exited.
+        if conf.get(SOCKETS_STRICT_MODE):
+            raise FatalException("PyCSP unable to reach process during offer(%s)" % str(self.process))
+        else:
+            sys.stderr.write("PyCSP unable to reach process during offer(%s)\n" % str(self.process))
 
+        return (e.addr == self.process.hostNport, e.addr == reader.process.hostNport, False)
 
 
-class ChannelHomeThread(threading.Thread):
-    def __init__(self, name, buffer, addr = None):
-        threading.Thread.__init__(self)
 
-        # This may cause the thread to terminate unexpectedly and thus
-        # leave processes in an inconsistent state.
-        # To enforce a nice shutdown, the Shutdown function must be called
-        # by the user
-        self.daemon = False
 
+# Requests, which a channel home may accept while offers are in flight
+POST_CMDS = frozenset([CHANTHREAD_POST_READ, CHANTHREAD_POST_WRITE,
+                       CHANTHREAD_POST_DIRECT_READ, CHANTHREAD_POST_DIRECT_WRITE])
+
+def create_channel_home(name, buffer):
+    """
+    Returns a channel home for the engine of the interpreter. It must be started
+    with start() and joined with join().
+    """
+    if SocketDispatcher().getThread().engine != ENGINE_THREADS:
+        return ChannelHomeTask(name, buffer)
+    return ChannelHomeThread(name, buffer)
+
+
+class ChannelHomeServer(object):
+    """
+    Handles the messages to a channel home. Run by a ChannelHomeThread or a ChannelHomeTask.
+    """
+    def __init__(self, name, buffer):
         self.id = name
 
         self.dispatch = SocketDispatcher().getThread()
-        self.addr = self.dispatch.server_addr
+
+        # The messages to the channel home are sent within this interpreter
+        self.addr = self.dispatch.local_addr
 
         # Returns synchronized Queue object where messages are retrieved from.
         self.input = self.dispatch.registerChannel(self.id)
 
         self.channel = ChannelHome(name, buffer)
 
-    def run(self):
-        LM = self.channel.LM
+        # While every message has come from threads of this interpreter, the messages
+        # are handled by the posting threads under the monitor (see post), as no message
+        # must wait for a reply from another interpreter. The first message received
+        # through input ends this mode. The event loop must never wait for the monitor,
+        # thus the events engine always receives through input.
+        self.local = self.dispatch.engine != ENGINE_EVENTS
+        self.monitor = threading.Lock()
+        self.channel.pipelined = not self.local
+
+    def post(self, header, payload=""):
+        """
+        Handles a message from this interpreter in the calling thread, while the channel
+        home is local. Otherwise the message is sent to the channel home.
+        """
+        header._source_host, header._source_port = self.addr
+
+        self.monitor.acquire()
+        try:
+            if self.local:
+                if header.cmd == CHANTHREAD_DEREGISTER and self.channel.channelreferences == 1:
+                    # The last reference terminates the channel home, which must return
+                    # from serve.
+                    self.local = False
+                else:
+                    engine.run(self.handle(Message(header, payload)))
+                    return
+            self.dispatch.send(self.addr, header, payload)
+        finally:
+            self.monitor.release()
+
+    def serve(self):
+        """
+        Coroutine. Returns, when the last channel reference has been deregistered.
+        """
+        # Messages, which must wait for the offers in flight to complete
+        deferred = collections.deque()
+        rematch = False
 
         while(True):
-            msg = self.input.pop_normal()
+            if rematch and not deferred:
+                # Offers completed, while messages were deferred
+                rematch = False
+                yield self.channel.match()
+
+            if deferred and not self.channel.pending:
+                msg = deferred.popleft()
+            else:
+                msg = yield Wait(self.input)
             header = msg.header
 
-            #print("GOT %s for %s" % (cmd2str(header.cmd), self.id))
-
-            if header.cmd == CHANTHREAD_JOIN_READER:
-                self.channel.join_reader()
-            elif header.cmd == CHANTHREAD_JOIN_WRITER:
-                self.channel.join_writer()
-            elif header.cmd == CHANTHREAD_RETIRE_READER:
-                self.channel.retire_reader()
-            elif header.cmd == CHANTHREAD_RETIRE_WRITER:
-                self.channel.retire_writer()
-            elif header.cmd == CHANTHREAD_REGISTER:
-                self.channel.register()
-            elif header.cmd == CHANTHREAD_DEREGISTER:
-
-                is_final = self.channel.deregister()
-                if is_final:
-                    #print "SHUTDOWN"
-                    # TODO: Ensure that the channel is unused
-                    # TODO: Check if any unread messages is left in channel?
-                    self.dispatch.deregisterChannel(self.id)
-                    return
+            if self.local:
+                # The first message through input. From now on, every message is
+                # handled here.
+                self.monitor.acquire()
+                self.local = False
+                self.channel.pipelined = self.dispatch.engine != ENGINE_THREADS
+                self.monitor.release()
+
+            if header.cmd == CHANTHREAD_OFFER_DONE:
+                self.channel.offer_done(*msg.payload)
+                if deferred:
+                    rematch = True
+                else:
+                    yield self.channel.match()
+                continue
 
-            elif header.cmd == CHANTHREAD_POISON_READER:
-                self.channel.poison_reader()
+            # New requests may be matched while offers are in flight. Any other message,
+            # including requests of a prioritized select, waits for the offers in flight
+            # and is handled in the order received.
+            if self.channel.pending and (deferred or not header.cmd in POST_CMDS):
+                deferred.append(msg)
+                continue
 
-            elif header.cmd == CHANTHREAD_POISON_WRITER:
-                self.channel.poison_writer()
+            is_final = yield self.handle(msg)
+            if is_final:
+                return
 
-            elif header.cmd == CHANTHREAD_POST_WRITE or header.cmd == CHANTHREAD_POST_ACK_WRITE:
-                process = AddrID((header._source_host, header._source_port), header._source_id)
-                msg = msg.payload
+    def handle(self, msg):
+        """
+        Coroutine. Returns True, when the last channel reference has been deregistered.
+        """
+        header = msg.header
+        LM = self.channel.LM
 
-                try:
-                    #print "posted write1"
-                    self.channel.post_write(ChannelReq(LM, process, header.seq_number, self.channel.name, msg))
-                    #print "posted write2"
-                except ChannelPoisonException:
-                    try:                    
-                        lock_s, state, seq = LM.remote_acquire_and_get_state(process)
-                        if seq == header.seq_number:
-                            if state == READY:
-                                LM.remote_poison(lock_s, process)
-                        # Ignore if wrong sequence number
-
-                        LM.remote_release(lock_s, process)
-                    except AddrUnavailableException:
-                        # Unable to reach process to notify poison
-                        if conf.get(SOCKETS_STRICT_MODE):
-                            raise FatalException("PyCSP (poison notification:2) unable to reach process (%s)" % str(process))
-                        else:
-                            sys.stderr.write("PyCSP (poison notification:2) unable to reach process (%s)\n" % str(process))
-
-                except ChannelRetireException:
-                    try:                    
-                        lock_s, state, seq = LM.remote_acquire_and_get_state(process)
-                        if seq == header.seq_number:
-                            if state == READY:
-                                LM.remote_retire(lock_s, process)
-                        # Ignore if wrong sequence number
-
-                        LM.remote_release(lock_s, process)
-                    except AddrUnavailableException:
-                        # Unable to reach process to notify retire
-                        if conf.get(SOCKETS_STRICT_MODE):
-                            raise FatalException("PyCSP (retire notification:2) unable to reach process (%s)" % str(process))
-                        else:
-                            sys.stderr.write("PyCSP (retire notification:2) unable to reach process (%s)\n" % str(process))
-
-                # Send acknowledgement to process. (used to ensure prioritized select)
-                if header.cmd == CHANTHREAD_POST_ACK_WRITE:
-                    LM.ack(process)
-
-            elif header.cmd == CHANTHREAD_POST_READ or header.cmd == CHANTHREAD_POST_ACK_READ:
-                process = AddrID((header._source_host, header._source_port), header._source_id)
+        #print("GOT %s for %s" % (cmd2str(header.cmd), self.id))
+
+        if header.cmd == CHANTHREAD_JOIN_READER:
+            self.channel.join_reader()
+        elif header.cmd == CHANTHREAD_JOIN_WRITER:
+            self.channel.join_writer()
+        elif header.cmd == CHANTHREAD_RETIRE_READER:
+            yield self.channel.retire_reader()
+        elif header.cmd == CHANTHREAD_RETIRE_WRITER:
+            yield self.channel.retire_writer()
+        elif header.cmd == CHANTHREAD_REGISTER:
+            self.channel.register()
+        elif header.cmd == CHANTHREAD_DEREGISTER:
+
+            is_final = self.channel.deregister()
+            if is_final:
+                #print "SHUTDOWN"
+                # TODO: Ensure that the channel is unused
+                # TODO: Check if any unread messages is left in channel?
+                self.channel.close()
+                self.dispatch.deregisterChannel(self.id)
+                raise Return(True)
+
+        elif header.cmd == CHANTHREAD_POISON_READER:
+            yield self.channel.poison_reader()
+
+        elif header.cmd == CHANTHREAD_POISON_WRITER:
+            yield self.channel.poison_writer()
+
+        elif header.cmd == CHANTHREAD_POST_WRITE or header.cmd == CHANTHREAD_POST_ACK_WRITE or header.cmd == CHANTHREAD_POST_DIRECT_WRITE:
+            process = AddrID((header._source_host, header._source_port), header._source_id)
+            msg = msg.payload
+            req = ChannelReq(LM, process, header.seq_number, self.channel.name, msg, header.codec,
+                             direct=(header.cmd == CHANTHREAD_POST_DIRECT_WRITE),
+                             ack=(header.cmd == CHANTHREAD_POST_ACK_WRITE))
 
-                try:
-                    self.channel.post_read(ChannelReq(LM, process, header.seq_number, self.channel.name))
-                except ChannelPoisonException:
-                    try:                    
-                        lock_s, state, seq = LM.remote_acquire_and_get_state(process)
-                        if seq == header.seq_number:
-                            if state == READY:
-                                LM.remote_poison(lock_s, process)
-                        # Ignore if wrong sequence number
-
-                        LM.remote_release(lock_s, process)
-                    except AddrUnavailableException:
-                        # Unable to reach process to notify poison
-                        if conf.get(SOCKETS_STRICT_MODE):
-                            raise FatalException("PyCSP (poison notification:3) unable to reach process (%s)" % str(process))
-                        else:
-                            sys.stderr.write("PyCSP (poison notification:3) unable to reach process (%s)\n" % str(process))
-
-                except ChannelRetireException:
-                    try:
-                        lock_s, state, seq = LM.remote_acquire_and_get_state(process)
-                        if seq == header.seq_number:
-                            if state == READY:
-                                LM.remote_retire(lock_s, process)
-                        # Ignore if wrong sequence number
-
-                        LM.remote_release(lock_s, process)
-                    except AddrUnavailableException:
-                        # Unable to reach process to notify retire
-                        if conf.get(SOCKETS_STRICT_MODE):
-                            raise FatalException("PyCSP (retire notification:3) unable to reach process (%s)" % str(process))
-                        else:
-                            sys.stderr.write("PyCSP (retire notification:3) unable to reach process (%s)\n" % str(process))
-
-                # Send acknowledgement to process. (used to ensure prioritized select)
-                if header.cmd == CHANTHREAD_POST_ACK_READ:
-                    LM.ack(process)
-
-            elif header.cmd == CHANTHREAD_ENTER:
-                socket = msg.natfix
-                addr = (header._source_host, header._source_port)
-                if socket:
-                    LM.set_reverse_socket(addr, socket)
-                # Possible code to register process at channel
-
-            elif header.cmd == CHANTHREAD_LEAVE:
-                paddr = AddrID((header._source_host, header._source_port), header._source_id)
-                # Final communication to process. Poison or retire can never come after leave.
-                self.channel.leave(paddr.id)
-                LM.remote_final(paddr)
+            try:
+                #print "posted write1"
+                yield self.channel.post_write(req)
+                #print "posted write2"
+            except ChannelPoisonException:
+                yield req.poison()
+            except ChannelRetireException:
+                yield req.retire()
+
+            # Send acknowledgement to process. (used to ensure prioritized select)
+            if header.cmd == CHANTHREAD_POST_ACK_WRITE:
+                LM.ack(process)
+
+        elif header.cmd == CHANTHREAD_POST_READ or header.cmd == CHANTHREAD_POST_ACK_READ or header.cmd == CHANTHREAD_POST_DIRECT_READ:
+            process = AddrID((header._source_host, header._source_port), header._source_id)
+            req = ChannelReq(LM, process, header.seq_number, self.channel.name,
+                             direct=(header.cmd == CHANTHREAD_POST_DIRECT_READ),
+                             ack=(header.cmd == CHANTHREAD_POST_ACK_READ))
+
+            try:
+                yield self.channel.post_read(req)
+            except ChannelPoisonException:
+                yield req.poison()
+            except ChannelRetireException:
+                yield req.retire()
+
+            # Send acknowledgement to process. (used to ensure prioritized select)
+            if header.cmd == CHANTHREAD_POST_ACK_READ:
+                LM.ack(process)
+
+        elif header.cmd == CHANTHREAD_ENTER:
+            # The connection of the process is used for replies, as for every peer.
+            # Possible code to register process at channel
+            pass
+
+        elif header.cmd == CHANTHREAD_LEAVE:
+            paddr = AddrID((header._source_host, header._source_port), header._source_id)
+            # Final communication to process. Poison or retire can never come after leave.
+            self.channel.leave(paddr.id)
+            LM.remote_final(paddr)
+
+        raise Return(False)
+
+
+class ChannelHomeThread(threading.Thread):
+    def __init__(self, name, buffer, addr = None):
+        threading.Thread.__init__(self)
+
+        # This may cause the thread to terminate unexpectedly and thus
+        # leave processes in an inconsistent state.
+        # To enforce a nice shutdown, the Shutdown function must be called
+        # by the user
+        self.daemon = False
+
+        self.id = name
+        self.server = ChannelHomeServer(name, buffer)
+        self.addr = self.server.addr
+
+    def run(self):
+        engine.run(self.server.serve())
+
+
+class ChannelHomeTask(object):
+    """
+    Channel home run as a task on the event loop of the SocketThread or on the
+    WorkerPool, depending on the engine
+    """
+    def __init__(self, name, buffer):
+        self.id = name
+        self.server = ChannelHomeServer(name, buffer)
+        self.addr = self.server.addr
+        self.task = None
+
+    def start(self):
+        self.task = self.server.dispatch.spawn(self.server.serve())
 
+    def join(self):
+        self.task.join()